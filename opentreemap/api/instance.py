@@ -4,7 +4,7 @@ from __future__ import unicode_literals
 from __future__ import division
 
 from django.conf import settings
-from django.contrib.gis.geos import Point
+from django.contrib.gis.geos import Point, Polygon
 from django.contrib.gis.measure import D
 
 from treemap.exceptions import HttpBadRequestException
@@ -50,14 +50,20 @@ def instances_closest_to_point(request, lat, lng):
         raise HttpBadRequestException(
             'The distance parameter must be a number')
 
+    # Instances whose bounding boxes can't be within the distance are
+    # ruled out by the spatial index before computing exact distances
+    search_box = _bbox_around(point, distance)
+
     instances = Instance.objects.distance(point)\
         .filter(is_public=True)\
         .exclude(pk__in=user_instance_ids)\
+        .filter(bounds__bboverlaps=search_box)\
         .filter(bounds__distance_lte=(point, D(m=distance)))\
         .order_by('distance')[0:max_instances]
 
     my_instances = Instance.objects.distance(point)\
         .filter(pk__in=user_instance_ids)\
+        .filter(bounds__bboverlaps=search_box)\
         .filter(bounds__distance_lte=(point, D(m=distance)))\
         .order_by('distance')
 
@@ -126,9 +132,20 @@ def instance_info(request, instance):
     return info
 
 
+def _bbox_around(point, distance):
+    """
+    The box (in the srid of Instance.bounds) containing everything
+    within 'distance' meters of the point
+    """
+    center = point.transform(3857, clone=True)
+    box = Polygon.from_bbox((center.x - distance, center.y - distance,
+                             center.x + distance, center.y + distance))
+    box.srid = 3857
+    return box
+
+
 def _instance_info_dict(instance):
-    center = instance.center
-    center.transform(4326)
+    center = instance.center_lat_lng
 
     info = {'geoRev': instance.geo_rev_hash,
             'id': instance.pk,
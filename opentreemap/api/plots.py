@@ -40,6 +40,9 @@ def plots_closest_to_point(request, instance, lat, lng):
                         .filter(geom__distance_lte=(point, D(m=distance)))\
                         .order_by('distance')[0:max_plots]
 
+    if request.user.is_authenticated():
+        plots = plots.mask_unauthorized_fields(request.user)
+
     def ctxt_for_plot(plot):
         return context_dict_for_plot(
             request.instance,
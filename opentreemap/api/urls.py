@@ -10,6 +10,7 @@ from opentreemap.util import route
 from api.views import (status, version,
                        remove_current_tree_from_plot, add_tree_photo,
                        get_tree_image, plots_endpoint, species_list_endpoint,
+                       species_search_endpoint,
                        approve_pending_edit, reject_pending_edit,
                        geocode_address, reset_password, login_endpoint,
                        register, add_profile_photo, update_password,
@@ -52,6 +53,7 @@ urlpatterns = patterns(
     # OTM2/instance endpoints
     (instance_pattern + '$', instance_info_endpoint),
     (instance_pattern + '/species$', species_list_endpoint),
+    (instance_pattern + '/species/search$', species_search_endpoint),
     (instance_pattern + r'/plots$', plots_endpoint),
     (instance_pattern + r'/plots/(?P<plot_id>\d+)$',
      plot_endpoint),
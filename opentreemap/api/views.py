@@ -26,7 +26,8 @@ from opentreemap.util import route
 
 from treemap.models import Plot, Tree
 from treemap.views import (create_user, get_tree_photos, species_list,
-                           upload_user_photo, context_dict_for_plot)
+                           species_search, upload_user_photo,
+                           context_dict_for_plot)
 
 from treemap.decorators import instance_request, json_api_call
 from treemap.exceptions import HttpBadRequestException
@@ -377,6 +378,9 @@ def get_plot_list(request, instance):
     plots = Plot.objects.filter(instance=instance)\
                         .order_by('id')[start:end]
 
+    if request.user.is_authenticated():
+        plots = plots.mask_unauthorized_fields(request.user)
+
     def ctxt_for_plot(plot):
         return context_dict_for_plot(
             request.instance,
@@ -588,3 +592,7 @@ plot_endpoint = json_api_call(
 species_list_endpoint = instance_request(
     json_api_call(
         route(GET=species_list)))
+
+species_search_endpoint = instance_request(
+    json_api_call(
+        route(GET=species_search)))
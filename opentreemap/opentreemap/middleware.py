@@ -55,3 +55,27 @@ class InternetExplorerRedirectMiddleware:
                     return HttpResponseRedirect(redirect_path)
         else:
             request.from_ie = False
+
+
+class InstanceUserCacheMiddleware:
+    """
+    Caches InstanceUser lookups for the duration of each request.
+
+    When DEBUG is on, the number of lookups that were answered from the
+    cache is added to the response in the X-InstanceUser-Lookups header
+    (as "saved/total").
+    """
+    def process_request(self, request):
+        # Imported here since models can't be loaded before settings
+        from treemap.models import instance_user_cache
+        instance_user_cache.begin_request()
+
+    def process_response(self, request, response):
+        from treemap.models import instance_user_cache
+        lookups, saved_lookups = instance_user_cache.end_request()
+
+        if settings.DEBUG:
+            response['X-InstanceUser-Lookups'] = '%s/%s' % (saved_lookups,
+                                                            lookups)
+
+        return response
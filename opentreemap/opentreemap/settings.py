@@ -40,6 +40,25 @@ NEARBY_INSTANCE_RADIUS = 100000
 # Default nearby tree distance in meters
 NEARBY_TREE_DISTANCE = 6.096  # 20ft
 
+# The number of ids each process takes from a sequence at once when
+# reserving ids for pending inserts. Unused ids are lost when the
+# process exits, leaving gaps in the sequence.
+MODEL_ID_RESERVATION_BLOCK_SIZE = 50
+
+# How many seconds a process reuses a user's InstanceUser and role
+# before looking them up again. Changes made in other processes can
+# take this long to be seen. Set to 0 to only cache within a request.
+INSTANCE_USER_CACHE_TTL = 5
+
+# How many seconds a process reuses the reputation metrics of an
+# instance before looking them up again
+REPUTATION_METRIC_CACHE_TTL = 60
+
+# Mirror the values of numeric, date and choice scalar UDFs into typed
+# columns so sorting and MIN/MAX filters on them compare values and can
+# use an index. Run the sync_typed_udfs command after turning this on.
+UDF_TYPED_STORAGE = False
+
 DEBUG = True
 TEMPLATE_DEBUG = True
 AUTH_USER_MODEL = 'treemap.User'
@@ -103,6 +122,14 @@ SCSS_ROOT = os.path.join(PROJECT_ROOT, 'treemap', 'css', 'sass')
 # Entry point .scss file for on-the-fly compilation to CSS
 SCSS_ENTRY = 'main'
 
+# Directory shared by all processes for the CSS compiled from the SCSS
+# (see treemap.scss). Set to None to only cache compiled CSS in memory.
+SCSS_CACHE_ROOT = os.path.join(PROJECT_ROOT, 'scss_cache')
+
+# How many seconds browsers may use compiled CSS without asking again.
+# Stylesheet URLs change when the SCSS sources do.
+SCSS_CACHE_MAX_AGE = 60 * 60 * 24 * 365
+
 # Absolute filesystem path to the directory that will hold user-uploaded files.
 # Example: "/var/www/example.com/media/"
 MEDIA_ROOT = '/usr/local/otm/media'
@@ -158,6 +185,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'opentreemap.middleware.InstanceUserCacheMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'opentreemap.middleware.InternetExplorerRedirectMiddleware',
     # Uncomment the next line for simple clickjacking protection:
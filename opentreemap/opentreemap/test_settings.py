@@ -5,3 +5,10 @@ from opentreemap.settings import *  # NOQA
 PASSWORD_HASHERS = (
     'django.contrib.auth.hashers.MD5PasswordHasher',
 )
+
+# Tests change permissions with queryset updates, which can't
+# invalidate the cross-request InstanceUser cache
+INSTANCE_USER_CACHE_TTL = 0
+
+# Don't share compiled CSS with other test runs or the development server
+SCSS_CACHE_ROOT = None
@@ -14,7 +14,7 @@ from django.conf import settings
 from django.db.transaction import commit_on_success
 
 from treemap.models import (User, Plot, Tree, Species, InstanceUser, Audit)
-from treemap.audit import model_hasattr
+from treemap.audit import model_hasattr, compact_insert_audits
 from treemap.management.util import InstanceDataCommand
 
 # TODO: should not require a utility from the tests
@@ -237,7 +237,8 @@ def save_user_hash_to_model(model_name, model_hash,
         user = system_user
 
     with more_permissions(user, instance, commander_role) as elevated_user:
-        model.save_with_user(elevated_user)
+        with compact_insert_audits():
+            model.save_with_user(elevated_user)
 
     return model
 
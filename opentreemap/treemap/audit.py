@@ -2,24 +2,34 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import os
 import hashlib
+import operator
+import threading
+import time
+from itertools import islice
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
 from functools import partial
 
+from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import GEOSGeometry
 
 from django.forms.models import model_to_dict
 from django.utils.translation import ugettext as trans
 from django.dispatch import receiver
-from django.db.models import OneToOneField
-from django.db.models.signals import post_save
+from django.db.models import OneToOneField, Q, Sum
+from django.db.models.signals import post_save, post_delete
 from django.db.models.fields import FieldDoesNotExist
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
 
 from treemap.units import (is_convertible, is_convertible_or_formattable,
                            get_display_value, get_units)
 from treemap.util import leaf_subclasses
+from treemap.json_field import JSONField
 
 
 def model_hasattr(obj, name):
@@ -55,24 +65,110 @@ def get_id_sequence_name(model_class):
     return id_seq_name
 
 
+class _ModelIdPool(object):
+    """
+    Ids taken from the database sequences in blocks and handed out one
+    at a time, so that reserving an id usually doesn't need a query.
+
+    Sequences are not transactional, so an id is never handed out twice
+    even if the transaction that fetched its block is rolled back. The
+    pool is emptied when the process id changes, so forked workers
+    (e.g. gunicorn with preload) don't share the ids of their parent.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._ids = {}
+
+    def take(self, model_class):
+        key = (connection.settings_dict['NAME'],
+               get_id_sequence_name(model_class))
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._ids = {}
+                self._pid = os.getpid()
+
+            ids = self._ids.setdefault(key, deque())
+            if not ids:
+                ids.extend(_reserve_model_ids(
+                    model_class, settings.MODEL_ID_RESERVATION_BLOCK_SIZE))
+
+            return ids.popleft()
+
+
+_model_id_pool = _ModelIdPool()
+
+
 def _reserve_model_id(model_class):
     """
-    queries the database to get id from the audit id sequence.
+    Gets an id from the model's id sequence.
     this is used to reserve an id for a record that hasn't been
     created yet, in order to make references to that record.
+
+    Ids are fetched from the database in blocks of
+    MODEL_ID_RESERVATION_BLOCK_SIZE, so ids reserved by one process
+    are not necessarily in order with those created by other processes.
     """
+    return _model_id_pool.take(model_class)
+
+
+# Fields that are always written as separate insert audits, even when
+# insert audits are compacted, since other code looks them up directly
+# (e.g. the plot of a tree when building the history of a plot)
+_UNCOMPACTED_FIELDS = {('Tree', 'plot')}
+
+_compaction = threading.local()
+
+
+def _is_compactable(model_name, field):
+    return field != 'id' and (model_name, field) not in _UNCOMPACTED_FIELDS
+
+
+def _audit_string(value):
+    # The string an audit would store for the value
+    return Audit._meta.get_field('current_value').to_python(value)
+
+
+@contextmanager
+def compact_insert_audits():
+    """
+    While active, objects created with save_with_user get a single
+    'id' audit instead of one audit per field. The other field values
+    are stored together in a CompactedInsert row and are expanded back
+    into audits by Audit.expand_compacted.
+
+    Meant for bulk imports, where the per-field insert audits make up
+    most of the audit table.
+    """
+    previous = getattr(_compaction, 'active', False)
+    _compaction.active = True
+    try:
+        yield
+    finally:
+        _compaction.active = previous
+
+
+def _reserve_model_ids(model_class, count):
+    """
+    queries the database to reserve a block of ids from the model's
+    id sequence with a single query
+    """
+    if count == 0:
+        return []
+
     try:
         id_seq_name = get_id_sequence_name(model_class)
         cursor = connection.cursor()
-        cursor.execute("select nextval('%s');" % id_seq_name)
-        results = cursor.fetchone()
-        model_id = results[0]
-        assert(type(model_id) in [int, long])
+        cursor.execute("select nextval('%s') from generate_series(1, %%s);"
+                       % id_seq_name, [count])
+        model_ids = [row[0] for row in cursor.fetchall()]
+        assert(len(model_ids) == count)
     except:
-        msg = "There was a database error while retrieving a unique audit ID."
+        msg = "There was a database error while retrieving unique audit IDs."
         raise IntegrityError(msg)
 
-    return model_id
+    return model_ids
 
 
 @transaction.commit_on_success
@@ -109,6 +205,69 @@ def approve_or_reject_audits_and_apply(audits, user, approved):
         approve_or_reject_audit_and_apply(audit, user, approved)
 
 
+def sync_field_permissions(role, permissions, instance=None):
+    """
+    Make sure a role has the given field permissions, a list of
+    (model_name, field_name, permission_level) tuples.
+
+    The permissions are compared with the role's existing field
+    permissions, missing ones are created with a single insert and
+    ones with a different permission level are updated with one
+    update per level. Other field permissions of the role are left
+    alone.
+
+    Only the field permissions of 'instance' (or of the role's
+    instance if it isn't given) are compared and created, since a
+    role can be shared by several instances.
+
+    Returns the list of created field permissions and the number of
+    field permissions that were updated.
+    """
+    # Delayed import to prevent circular imports
+    from treemap.models import instance_user_cache
+
+    if instance is None:
+        instance = role.instance
+
+    existing = defaultdict(list)
+    perms = FieldPermission.objects\
+        .filter(role=role, instance=instance)\
+        .values_list('pk', 'model_name', 'field_name', 'permission_level')
+    for pk, model_name, field_name, level in perms:
+        existing[(model_name, field_name)].append((pk, level))
+
+    created = []
+    pks_by_level = defaultdict(list)
+    for model_name, field_name, level in permissions:
+        key = (model_name, field_name)
+        if key not in existing:
+            perm = FieldPermission(model_name=model_name,
+                                   field_name=field_name,
+                                   permission_level=level,
+                                   role=role, instance=instance)
+            perm.clean()
+            created.append(perm)
+            existing[key] = [(None, level)]
+        else:
+            pks_by_level[level] += [pk for pk, current in existing[key]
+                                    if pk is not None and current != level]
+
+    FieldPermission.objects.bulk_create(created, batch_size=_BULK_BATCH_SIZE)
+
+    n_updated = 0
+    for level, pks in pks_by_level.iteritems():
+        if pks:
+            n_updated += FieldPermission.objects.filter(pk__in=pks)\
+                                                .update(permission_level=level)
+
+    # Bulk inserts and updates don't send the signals that would
+    # normally drop the role from the cache
+    if created or n_updated:
+        instance_user_cache.invalidate()
+
+    return created, n_updated
+
+
 def add_all_permissions_on_model_to_role(
         Model, role, permission_level, instance=None):
     """
@@ -129,12 +288,9 @@ def add_all_permissions_on_model_to_role(
 
     model_fields = set(mobj.tracked_fields + udfs)
 
-    for field_name in model_fields:
-        FieldPermission.objects.get_or_create(
-            model_name=model_name,
-            field_name=field_name,
-            permission_level=permission_level, role=role,
-            instance=role.instance)
+    sync_field_permissions(
+        role, [(model_name, field_name, permission_level)
+               for field_name in model_fields])
 
     return role
 
@@ -338,6 +494,543 @@ def get_related_audits(insert_audit, approved_only=False):
     return related_audits
 
 
+# Largest number of rows referenced in a single bulk statement
+_BULK_BATCH_SIZE = 1000
+
+
+def _group_audits_by_object(audits):
+    """
+    Group audits by the object they apply to, returning an ordered dict
+    of (model, model_id) => [audit, ...].
+
+    As with approve_or_reject_audits_and_apply, plots come before
+    trees so that a pending plot can be created before its tree.
+    Audits for an object are ordered by creation, so applying them in
+    order yields the net change to the object.
+    """
+    model_order = ['Plot', 'Tree']
+
+    def sort_key(audit):
+        if audit.model in model_order:
+            order = model_order.index(audit.model)
+        else:
+            order = len(model_order)
+        return (order, audit.model, audit.model_id, audit.created)
+
+    groups = OrderedDict()
+    for audit in sorted(audits, key=sort_key):
+        groups.setdefault((audit.model, audit.model_id), []).append(audit)
+
+    return groups
+
+
+def _object_keys_filter(keys):
+    """
+    Build a Q object matching audits on any of the given
+    (model, model_id) pairs
+    """
+    ids_by_model = defaultdict(set)
+    for model_name, model_id in keys:
+        ids_by_model[model_name].add(model_id)
+
+    return reduce(operator.or_,
+                  [Q(model=model_name, model_id__in=list(ids))
+                   for model_name, ids in ids_by_model.iteritems()])
+
+
+def _load_objects(keys):
+    """
+    Fetch the objects for the given (model, model_id) pairs with one
+    query per model. Objects that don't exist are left out.
+    """
+    ids_by_model = defaultdict(list)
+    for model_name, model_id in keys:
+        ids_by_model[model_name].append(model_id)
+
+    objects = {}
+    for model_name, ids in ids_by_model.iteritems():
+        TheModel = _get_auditable_class(model_name)
+        for pk, obj in TheModel.objects.in_bulk(ids).iteritems():
+            objects[(model_name, pk)] = obj
+
+    return objects
+
+
+def _verify_user_can_apply_audits(audits, user):
+    """
+    Equivalent to calling _verify_user_can_apply_audit for each audit,
+    but only checks each field once
+    """
+    verified = set()
+    for audit in audits:
+        key = (audit.instance_id, audit.model, audit.field)
+        if key not in verified:
+            _verify_user_can_apply_audit(audit, user)
+            verified.add(key)
+
+
+def _bulk_review(audits, user, action):
+    """
+    Create a review audit of type 'action' for each audit and point
+    the audit's ref at it, using one INSERT for the reviews and one
+    UPDATE per batch of audits.
+
+    Since bulk inserts don't send post_save, the plot tree history is
+    updated here directly and reputation must be handled by the caller.
+    """
+    # Delayed import to prevent circular imports
+    from treemap.models import PlotTreeHistory
+
+    review_ids = _reserve_model_ids(Audit, len(audits))
+    reviews = [Audit(pk=review_id, model=audit.model,
+                     model_id=audit.model_id,
+                     instance_id=audit.instance_id, field=audit.field,
+                     previous_value=audit.previous_value,
+                     current_value=audit.current_value,
+                     user=user, action=action)
+               for audit, review_id in zip(audits, review_ids)]
+
+    Audit.objects.bulk_create(reviews)
+
+    now = timezone.now()
+    cursor = connection.cursor()
+    pairs = [(audit.pk, review.pk) for audit, review in zip(audits, reviews)]
+
+    for start in xrange(0, len(pairs), _BULK_BATCH_SIZE):
+        batch = pairs[start:start + _BULK_BATCH_SIZE]
+        values = ', '.join(['(%s, %s)'] * len(batch))
+        params = [now] + [value for pair in batch for value in pair]
+
+        cursor.execute(
+            'UPDATE treemap_audit SET ref_id = v.ref_id, updated = %%s '
+            'FROM (VALUES %s) AS v (id, ref_id) '
+            'WHERE treemap_audit.id = v.id' % values, params)
+
+    for audit, review in zip(audits, reviews):
+        audit.ref = review
+        audit.updated = now
+        PlotTreeHistory.record_audit(review)
+
+    return reviews
+
+
+def _apply_reputation_in_bulk(audits, reviews):
+    """
+    Record the reputation changes that saving each review and each
+    reviewed audit would have made via ReputationMetric.apply_adjustment,
+    with a single INSERT into the reputation ledger.
+    """
+    _record_reputation_changes(
+        reviewed for audit, review in zip(audits, reviews)
+        for reviewed in (review, audit))
+
+
+def _record_reputation_changes(audits):
+    entries = []
+
+    for audit in audits:
+        delta = ReputationMetric.reputation_change(audit)
+        if delta:
+            entries.append(ReputationLedgerEntry(
+                instance_id=audit.instance_id,
+                user_id=audit.user_id, delta=delta))
+
+    ReputationLedgerEntry.objects.bulk_create(entries,
+                                              batch_size=_BULK_BATCH_SIZE)
+
+
+def bulk_create_audits(audits):
+    """
+    Insert new audits in batches and record the reputation they earn,
+    as saving each of them would (bulk inserts don't send post_save).
+    Use for audits of models without plot tree history (i.e. not Tree).
+    """
+    Audit.objects.bulk_create(audits, batch_size=_BULK_BATCH_SIZE)
+    _record_reputation_changes(audits)
+
+
+def _apply_pending_audits(audits):
+    """
+    Apply the net change from a set of pending audits to each of their
+    objects with a single save per object, creating objects whose
+    pending insert ('id' audit) is being approved.
+    """
+    groups = _group_audits_by_object(audits)
+    objects = _load_objects(groups.keys())
+
+    insert_keys = [key for key, group in groups.iteritems()
+                   if key not in objects
+                   and any(audit.field == 'id' for audit in group)]
+
+    # Fields of a pending insert that were approved before the insert
+    # itself are applied when the object is created
+    previously_approved = defaultdict(list)
+    if insert_keys:
+        approved_audits = Audit.objects\
+            .filter(_object_keys_filter(insert_keys))\
+            .filter(action=Audit.Type.Insert,
+                    ref__action=Audit.Type.PendingApprove)\
+            .order_by('created')
+
+        for audit in approved_audits:
+            previously_approved[(audit.model, audit.model_id)].append(audit)
+
+    for key, group in groups.iteritems():
+        model_name, model_id = key
+        obj = objects.get(key)
+
+        if obj is None and key in insert_keys:
+            TheModel = _get_auditable_class(model_name)
+            obj = TheModel(pk=model_id)
+            if model_hasattr(obj, 'instance'):
+                obj.instance = group[0].instance
+
+            for audit in previously_approved[key] + group:
+                if audit.field != 'id':
+                    obj.apply_change(audit.field, audit.clean_current_value)
+
+            obj.validate_foreign_keys_exist()
+            obj.save_base()
+
+        elif obj is not None:
+            for audit in group:
+                if audit.field != 'id':
+                    obj.apply_change(audit.field, audit.clean_current_value)
+
+            obj.save_base()
+
+
+def _revert_existing_audits(audits):
+    """
+    Revert a set of applied audits with a single save per object. As
+    with approve_or_reject_existing_edit, rejecting an 'id' audit
+    deletes the object and a field is only reverted if the rejected
+    audit is the most recent audit on that field.
+    """
+    groups = _group_audits_by_object(audits)
+
+    deleted_ids = defaultdict(list)
+    for (model_name, model_id), group in groups.iteritems():
+        if any(audit.field == 'id' for audit in group):
+            deleted_ids[model_name].append(model_id)
+
+    # Delete outside of the audit system
+    for model_name, ids in deleted_ids.iteritems():
+        TheModel = _get_auditable_class(model_name)
+        TheModel.objects.filter(pk__in=ids).delete()
+
+    objects = _load_objects(groups.keys())
+
+    if not objects:
+        return
+
+    fields = {audit.field for audit in audits if audit.field != 'id'}
+    most_recent_pks = set(
+        Audit.objects
+        .filter(_object_keys_filter(objects.keys()))
+        .filter(field__in=fields)
+        .order_by('model', 'model_id', 'field', '-created')
+        .distinct('model', 'model_id', 'field')
+        .values_list('pk', flat=True))
+
+    for key, obj in objects.iteritems():
+        reverted = [audit for audit in groups[key]
+                    if audit.pk in most_recent_pks]
+
+        for audit in reverted:
+            obj.apply_change(audit.field, audit.clean_previous_value)
+
+        if reverted:
+            models.Model.save(obj)
+
+
+@transaction.commit_on_success
+def bulk_approve_or_reject_audits_and_apply(audits, user, approved):
+    """
+    A set based version of approve_or_reject_audits_and_apply for
+    clearing large numbers of pending audits at once.
+
+    Audits are grouped by object and the net change to each object is
+    applied with a single save. Review audits are written in bulk and
+    reputation is adjusted once per user. Rejecting a pending insert
+    also rejects the other pending audits that are part of the insert.
+
+    Audits that are not pending are ignored. Returns the review audits.
+    """
+    return _bulk_approve_or_reject_pending_audits(audits, user, approved)
+
+
+def _bulk_approve_or_reject_pending_audits(audits, user, approved):
+    audits = [audit for audit in audits
+              if audit.requires_auth and audit.ref_id is None]
+
+    if not approved:
+        insert_keys = {(audit.model, audit.model_id) for audit in audits
+                       if audit.field == 'id'}
+        if insert_keys:
+            audit_pks = {audit.pk for audit in audits}
+            related_audits = Audit.objects\
+                .filter(_object_keys_filter(insert_keys))\
+                .filter(action=Audit.Type.Insert, requires_auth=True,
+                        ref__isnull=True)\
+                .exclude(pk__in=audit_pks)
+            audits += list(related_audits)
+
+    if not audits:
+        return []
+
+    _verify_user_can_apply_audits(audits, user)
+
+    if approved:
+        _apply_pending_audits(audits)
+        action = Audit.Type.PendingApprove
+    else:
+        action = Audit.Type.PendingReject
+
+    reviews = _bulk_review(audits, user, action)
+    _apply_reputation_in_bulk(audits, reviews)
+
+    return reviews
+
+
+@transaction.commit_on_success
+def bulk_approve_or_reject_existing_edits(audits, user, approved):
+    """
+    A set based version of approve_or_reject_existing_edit for
+    reviewing large numbers of applied audits at once.
+
+    Audits that are pending or have already been reviewed are ignored.
+    Returns the review audits.
+    """
+    audits = [audit for audit in audits
+              if not audit.requires_auth and audit.ref_id is None]
+
+    if not audits:
+        return []
+
+    _verify_user_can_apply_audits(audits, user)
+
+    if approved:
+        action = Audit.Type.ReviewApprove
+    else:
+        action = Audit.Type.ReviewReject
+        _revert_existing_audits(audits)
+
+    reviews = _bulk_review(audits, user, action)
+    _apply_reputation_in_bulk(audits, reviews)
+
+    return reviews
+
+
+def _audit_value_to_python(field, value):
+    """
+    Convert an audit value string to a python value for a model field,
+    using the id for foreign keys instead of loading the related object
+    """
+    if value is None:
+        return None
+    elif isinstance(field, models.ForeignKey):
+        return field.rel.to._meta.pk.to_python(value)
+    elif isinstance(field, models.GeometryField):
+        geom = GEOSGeometry(value)
+        if geom.srid is None:
+            geom.srid = field.srid
+        return geom
+    else:
+        return field.to_python(value)
+
+
+# For each field edited by the audits being reverted, find the value
+# from before the first of those audits that came after the last change
+# to the field that isn't being reverted. Fields that were changed
+# again after the reverted audits are left alone.
+_NET_INVERSE_SQL = """
+WITH reverted AS (
+    SELECT id, model, model_id, field, previous_value, created
+    FROM treemap_audit
+    WHERE id = ANY(%(audit_ids)s)
+), edited_fields AS (
+    SELECT DISTINCT model, model_id, field FROM reverted
+), kept AS (
+    SELECT a.model, a.model_id, a.field, MAX(a.created) AS created
+    FROM treemap_audit a
+    JOIN edited_fields f
+      ON a.model = f.model AND a.model_id = f.model_id AND a.field = f.field
+    WHERE a.instance_id = %(instance_id)s
+      AND ((a.action IN %(edit_actions)s AND NOT a.requires_auth)
+           OR a.action IN %(review_actions)s)
+      AND NOT EXISTS (SELECT 1 FROM reverted r WHERE r.id = a.id)
+    GROUP BY a.model, a.model_id, a.field
+)
+SELECT DISTINCT ON (r.model, r.model_id, r.field)
+       r.model, r.model_id, r.field, r.previous_value
+FROM reverted r
+LEFT JOIN kept k
+  ON r.model = k.model AND r.model_id = k.model_id AND r.field = k.field
+WHERE k.created IS NULL OR r.created > k.created
+ORDER BY r.model, r.model_id, r.field, r.created, r.id
+"""
+
+
+def _update_field_values(model_class, field_values):
+    """
+    Set field values, given as (model_id, field name, audit value) for
+    objects of model_class, with one UPDATE per field and batch of
+    objects. UDFs are set in the model's hstore column, and their typed
+    copies are synced afterwards.
+    """
+    # Delayed import to prevent circular imports
+    from treemap.udf import (UserDefinedCollectionValue, UDFModel,
+                             sync_typed_udf_values)
+
+    values_by_field = defaultdict(list)
+    udf_model_ids = set()
+    for model_id, field_name, value in field_values:
+        values_by_field[field_name].append((model_id, value))
+        if field_name.startswith('udf:'):
+            udf_model_ids.add(model_id)
+
+    cursor = connection.cursor()
+
+    for field_name, values in values_by_field.iteritems():
+        if field_name.startswith('udf:'):
+            if model_class is UserDefinedCollectionValue:
+                field = model_class._meta.get_field('data')
+            else:
+                field = model_class._meta.get_field('udfs')
+            rows = [(model_id, field_name[4:], value)
+                    for model_id, value in values]
+            row_sql = '(%s, %s, CAST(%s AS text))'
+            set_sql = ('{col} = CASE WHEN v.value IS NULL '
+                       'THEN delete(t.{col}, v.key) '
+                       'ELSE t.{col} || hstore(v.key, v.value) END')
+            columns = '(id, key, value)'
+        else:
+            try:
+                field = model_class._meta.get_field(field_name)
+            except FieldDoesNotExist:
+                continue
+            rows = [(model_id, field.get_db_prep_value(
+                _audit_value_to_python(field, value), connection))
+                for model_id, value in values]
+            row_sql = '(%%s, CAST(%%s AS %s))' % field.db_type(connection)
+            set_sql = '{col} = v.value'
+            columns = '(id, value)'
+
+        # Inherited fields live in the parent model's table
+        meta = field.model._meta
+        sql = ('UPDATE %s t SET %s FROM (VALUES %%s) AS v %s '
+               'WHERE t.%s = v.id'
+               % (meta.db_table, set_sql.format(col=field.column),
+                  columns, meta.pk.column))
+
+        for start in xrange(0, len(rows), _BULK_BATCH_SIZE):
+            batch = rows[start:start + _BULK_BATCH_SIZE]
+            cursor.execute(sql % ', '.join([row_sql] * len(batch)),
+                           [value for row in batch for value in row])
+
+    # Raw updates don't send the signals that keep typed values in sync
+    if (settings.UDF_TYPED_STORAGE and udf_model_ids
+            and issubclass(model_class, UDFModel)):
+        sync_typed_udf_values(
+            model_class.objects.filter(pk__in=list(udf_model_ids)))
+
+
+def _revert_audits_to_net_inverse(instance, audits):
+    """
+    Undo the combined effect of a set of applied audits. Objects
+    created by the audits are deleted and every other field is set back
+    to its value from before the audits, unless it has been changed
+    since.
+    """
+    created_ids = defaultdict(set)
+    for audit in audits:
+        if audit.field == 'id':
+            created_ids[audit.model].add(audit.model_id)
+
+    # Delete outside of the audit system
+    for model_name, ids in created_ids.iteritems():
+        TheModel = _get_auditable_class(model_name)
+        TheModel.objects.filter(pk__in=list(ids)).delete()
+
+    field_audit_ids = [audit.pk for audit in audits
+                       if audit.field != 'id'
+                       and audit.model_id not in created_ids[audit.model]]
+
+    if not field_audit_ids:
+        return
+
+    cursor = connection.cursor()
+    cursor.execute(_NET_INVERSE_SQL, {
+        'audit_ids': field_audit_ids,
+        'instance_id': instance.pk,
+        'edit_actions': (Audit.Type.Insert, Audit.Type.Update),
+        'review_actions': (Audit.Type.PendingApprove,
+                           Audit.Type.ReviewReject)})
+
+    values_by_model = defaultdict(list)
+    for model_name, model_id, field_name, value in cursor.fetchall():
+        values_by_model[model_name].append((model_id, field_name, value))
+
+    for model_name, field_values in values_by_model.iteritems():
+        _update_field_values(_get_auditable_class(model_name), field_values)
+
+
+@transaction.commit_on_success
+def revert_user_edits(user, instance, start, end, reviewer, progress=None):
+    """
+    Roll back every unreviewed edit that 'user' made to 'instance'
+    between 'start' and 'end', for example to clean up after vandalism.
+
+    Pending edits are rejected. Applied edits are reverted to their net
+    inverse per object with set based updates and rejected with review
+    audits written in bulk, all in a single transaction. Deletes can't
+    be reverted and are left alone.
+
+    If given, 'progress' is called with the number of edits reviewed so
+    far and the total number of edits. Returns the review audits.
+    """
+    audits = Audit.objects.filter(instance=instance, user=user,
+                                  created__gte=start, created__lte=end,
+                                  ref__isnull=True,
+                                  action__in=[Audit.Type.Insert,
+                                              Audit.Type.Update])\
+                          .order_by('created', 'pk')
+
+    pending = [audit for audit in audits if audit.requires_auth]
+    applied = [audit for audit in audits if not audit.requires_auth]
+
+    total = len(pending) + len(applied)
+    done = 0
+    reviews = []
+
+    _verify_user_can_apply_audits(applied, reviewer)
+
+    # Rejecting a pending insert also rejects the rest of its audits,
+    # so the pending audits are rejected together rather than in batches
+    if pending:
+        reviews += _bulk_approve_or_reject_pending_audits(
+            pending, reviewer, False)
+        done += len(pending)
+        if progress:
+            progress(done, total)
+
+    if applied:
+        _revert_audits_to_net_inverse(instance, applied)
+
+    for start_pos in xrange(0, len(applied), _BULK_BATCH_SIZE):
+        batch = applied[start_pos:start_pos + _BULK_BATCH_SIZE]
+        batch_reviews = _bulk_review(batch, reviewer,
+                                     Audit.Type.ReviewReject)
+        _apply_reputation_in_bulk(batch, batch_reviews)
+        reviews += batch_reviews
+        done += len(batch)
+        if progress:
+            progress(done, total)
+
+    return reviews
+
+
 def _verify_user_can_apply_audit(audit, user):
     """
     Make sure that user has "write direct" permissions
@@ -360,24 +1053,16 @@ def _verify_user_can_apply_audit(audit, user):
         field = audit.field
         model = audit.model
 
-    perms = user.get_instance_permissions(audit.instance,
-                                          model_name=model)
+    perms = user.get_permission_matrix(audit.instance, model)
 
-    foundperm = False
-    for perm in perms:
-        if perm.field_name == field:
-            if perm.permission_level == FieldPermission.WRITE_DIRECTLY:
-                foundperm = True
-                break
-            else:
-                raise AuthorizeException(
-                    "User %s can't edit field %s on model %s" %
-                    (user, field, model))
-
-    if not foundperm:
+    if field not in perms.fields:
         raise AuthorizeException(
             "User %s can't edit field %s on model %s (No permissions found)" %
             (user, field, model))
+    elif field not in perms.direct:
+        raise AuthorizeException(
+            "User %s can't edit field %s on model %s" %
+            (user, field, model))
 
 
 class UserTrackingException(Exception):
@@ -497,6 +1182,11 @@ class Role(models.Model):
     instance = models.ForeignKey('Instance', null=True, blank=True)
     rep_thresh = models.IntegerField()
 
+    # Incremented by a database trigger whenever one of the role's
+    # field permissions changes (see migration 0065), so cached
+    # permission matrices can tell when they are out of date
+    rev = models.IntegerField(default=1)
+
     @property
     def tree_permissions(self):
         return self.model_permissions('Tree')
@@ -508,6 +1198,9 @@ class Role(models.Model):
     def model_permissions(self, model):
         return self.fieldpermission_set.filter(model_name=model)
 
+    def permission_matrix(self, model_name):
+        return permission_matrix_cache.get_matrix(self, model_name)
+
     def __unicode__(self):
         return '%s (%s)' % (self.name, self.pk)
 
@@ -577,11 +1270,100 @@ class FieldPermission(models.Model):
         super(FieldPermission, self).save(*args, **kwargs)
 
 
+class PermissionMatrix(object):
+    """
+    The field permissions of a role on a single model, compiled into
+    sets of the fields the role can read, write (directly or with
+    audit) and write directly.
+
+    Matrices are shared between requests (see PermissionMatrixCache),
+    so they must not be modified.
+    """
+    def __init__(self, model_name, levels):
+        self.model_name = model_name
+        self._levels = dict(levels)
+
+        self.fields = frozenset(self._levels)
+        self.readable = frozenset(
+            field for field, level in self._levels.iteritems()
+            if level >= FieldPermission.READ_ONLY)
+        self.writable = frozenset(
+            field for field, level in self._levels.iteritems()
+            if level >= FieldPermission.WRITE_WITH_AUDIT)
+        self.direct = frozenset(
+            field for field, level in self._levels.iteritems()
+            if level == FieldPermission.WRITE_DIRECTLY)
+
+    def permission_level(self, field_name):
+        return self._levels.get(field_name, FieldPermission.NONE)
+
+    def __repr__(self):
+        return '<PermissionMatrix %s: %s>' % (self.model_name, self._levels)
+
+
+class PermissionMatrixCache(object):
+    """
+    Cache the permission matrices of each role.
+
+    The matrices of a role are stored with the role's revision and
+    rebuilt when a role with a newer revision is looked up, so changes
+    made by other processes are picked up as well.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cache = {}
+
+    def get_matrices_for_role(self, role):
+        rev, matrices = self.cache.get(role.pk, (None, None))
+
+        if rev != role.rev:
+            levels = defaultdict(dict)
+            perms = FieldPermission.objects\
+                .filter(role_id=role.pk)\
+                .values_list('model_name', 'field_name', 'permission_level')
+            for model_name, field_name, level in perms:
+                levels[model_name][field_name] = level
+
+            matrices = {model_name: PermissionMatrix(model_name, model_levels)
+                        for model_name, model_levels in levels.iteritems()}
+            self.cache[role.pk] = (role.rev, matrices)
+
+        return matrices
+
+    def get_matrix(self, role, model_name):
+        matrices = self.get_matrices_for_role(role)
+
+        if model_name not in matrices:
+            return PermissionMatrix(model_name, {})
+
+        return matrices[model_name]
+
+permission_matrix_cache = PermissionMatrixCache()
+
+
 class AuthorizeException(Exception):
     def __init__(self, name):
         super(Exception, self).__init__(name)
 
 
+def _mask_objects(objs, user):
+    """
+    Mask the fields that 'user' can't read on each of the authorizable
+    objects, yielding them as they are masked. The readable fields are
+    only looked up once for each model and instance.
+    """
+    readable_fields = {}
+    for obj in objs:
+        key = (obj._model_name, obj.instance_id)
+        if key not in readable_fields:
+            readable_fields[key] = obj._perms_for_user(user).readable
+
+        obj.mask_unauthorized_fields(user, readable_fields[key])
+        yield obj
+
+
 class AuthorizableQuerySet(models.query.QuerySet):
 
     def limit_fields_by_user(self, instance, user):
@@ -589,15 +1371,34 @@ class AuthorizableQuerySet(models.query.QuerySet):
         Filters a queryset based on what field permissions a user has on the
         model type.
         """
-        perms = user.get_instance_permissions(instance,
-                                              self.model.__name__)\
-                    .values_list('field_name', flat=True)
+        perms = user.get_permission_matrix(instance,
+                                           self.model.__name__).readable
 
         if perms:
             return self.values(*perms)
         else:
             return self.none()
 
+    def mask_unauthorized_fields(self, user):
+        """
+        Return a queryset whose objects have the fields that 'user'
+        can't read masked as they are loaded
+        """
+        return self._clone(_mask_user=user)
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_mask_user', getattr(self, '_mask_user', None))
+        return super(AuthorizableQuerySet, self)._clone(*args, **kwargs)
+
+    def iterator(self):
+        objs = super(AuthorizableQuerySet, self).iterator()
+        user = getattr(self, '_mask_user', None)
+
+        if user is None:
+            return objs
+        else:
+            return _mask_objects(objs, user)
+
 
 class AuthorizableManager(models.GeoManager):
     def get_query_set(self):
@@ -618,22 +1419,17 @@ class Authorizable(UserTrackable):
     def _get_perms_set(self, user, direct_only=False):
 
         try:
-            perms = user.get_instance_permissions(self.instance,
-                                                  self._model_name)
+            perms = user.get_permission_matrix(self.instance,
+                                               self._model_name)
         except ObjectDoesNotExist:
             raise AuthorizeException(trans(
                 "Cannot retrieve permissions for this object because "
                 "it does not have an instance associated with it."))
 
         if direct_only:
-            perm_set = {perm.field_name
-                        for perm in perms
-                        if perm.permission_level ==
-                        FieldPermission.WRITE_DIRECTLY}
+            return perms.direct
         else:
-            perm_set = {perm.field_name for perm in perms
-                        if perm.allows_writes}
-        return perm_set
+            return perms.writable
 
     def user_can_delete(self, user):
         """
@@ -684,57 +1480,51 @@ class Authorizable(UserTrackable):
         fields that inheriting subclasses will want to treat as
         special pending_edit fields.
         """
-        perms = user.get_instance_permissions(self.instance, self._model_name)
-        fields_to_audit = []
-        for perm in perms:
-            if ((perm.permission_level == FieldPermission.WRITE_WITH_AUDIT and
-                 perm.field_name in self._updated_fields())):
+        perms = user.get_permission_matrix(self.instance, self._model_name)
+        updated_fields = self._updated_fields()
 
-                fields_to_audit.append(perm.field_name)
+        return [field_name for field_name in perms.writable - perms.direct
+                if field_name in updated_fields]
 
-        return fields_to_audit
-
-    def mask_unauthorized_fields(self, user):
-        perms = user.get_instance_permissions(self.instance, self._model_name)
-        readable_fields = {perm.field_name for perm
-                           in perms
-                           if perm.allows_reads}
-
-        fields = set(self._previous_state.keys())
-        unreadable_fields = fields - readable_fields
+    def mask_unauthorized_fields(self, user, readable_fields=None):
+        """
+        Set the fields that 'user' can't read to None. When masking
+        many objects, pass the readable fields of the model (or use
+        mask_queryset) so they are only looked up once.
+        """
+        if readable_fields is None:
+            readable_fields = self._perms_for_user(user).readable
 
-        for field_name in unreadable_fields:
-            self.apply_change(field_name, None)
+        for field_name in self._previous_state.keys():
+            if field_name not in readable_fields:
+                self.apply_change(field_name, None)
 
         self._has_been_masked = True
 
     def _perms_for_user(self, user):
         if user is None or user.is_anonymous():
-            perms = self.instance.default_role.fieldpermission_set
+            return self.instance.default_role.permission_matrix(
+                self._model_name)
         else:
-            perms = user.get_instance_permissions(
-                self.instance, self._model_name)
-
-        return perms.filter(model_name=self._model_name)
+            return user.get_permission_matrix(self.instance,
+                                              self._model_name)
 
     def visible_fields(self, user):
-        perms = self._perms_for_user(user)
-        return [perm.field_name for perm in perms if perm.allows_reads]
+        return list(self._perms_for_user(user).readable)
 
     def field_is_visible(self, user, field):
-        return field in self.visible_fields(user)
+        return field in self._perms_for_user(user).readable
 
     def editable_fields(self, user):
-        perms = self._perms_for_user(user)
-        return [perm.field_name for perm in perms if perm.allows_writes]
+        return list(self._perms_for_user(user).writable)
 
     def field_is_editable(self, user, field):
-        return field in self.editable_fields(user)
+        return field in self._perms_for_user(user).writable
 
     @staticmethod
     def mask_queryset(qs, user):
-        for model in qs:
-            model.mask_unauthorized_fields(user)
+        for model in _mask_objects(qs, user):
+            pass
         return qs
 
     def save_with_user(self, user, *args, **kwargs):
@@ -906,16 +1696,32 @@ class Auditable(UserTrackable):
 
         def make_audit_and_save(field, prev_val, cur_val, pending):
 
-            Audit(model=self._model_name, model_id=model_id,
-                  instance=instance, field=field,
-                  previous_value=prev_val,
-                  current_value=cur_val,
-                  user=user, action=action,
-                  requires_auth=pending,
-                  ref=None).save()
+            audit = Audit(model=self._model_name, model_id=model_id,
+                          instance=instance, field=field,
+                          previous_value=prev_val,
+                          current_value=cur_val,
+                          user=user, action=action,
+                          requires_auth=pending,
+                          ref=None)
+            audit.save()
+            return audit
+
+        compact = (is_insert and not self.is_pending_insert and
+                   getattr(_compaction, 'active', False))
+        compacted_values = []
 
         for [field, values] in updates.iteritems():
-            make_audit_and_save(field, values[0], values[1], False)
+            if compact and _is_compactable(self._model_name, field):
+                compacted_values.append([field, _audit_string(values[1])])
+            else:
+                audit = make_audit_and_save(
+                    field, values[0], values[1], False)
+                if field == 'id':
+                    id_audit = audit
+
+        if compacted_values:
+            CompactedInsert.objects.create(audit_id=id_audit.pk,
+                                           values=compacted_values)
 
         for (field, (prev_val, next_val)) in pending_audits:
             make_audit_and_save(field, prev_val, next_val, True)
@@ -1158,6 +1964,282 @@ class Audit(models.Model):
     def is_pending(self):
         return self.requires_auth and not self.ref
 
+    @staticmethod
+    def expand_compacted(audits):
+        """
+        Yield the audits, each 'id' insert audit followed by the insert
+        audits that were compacted into it (see CompactedInsert).
+        The order of the audits is kept.
+        """
+        audits = iter(audits)
+        while True:
+            chunk = list(islice(audits, _BULK_BATCH_SIZE))
+            if not chunk:
+                return
+
+            id_audit_pks = [audit.pk for audit in chunk
+                            if audit.field == 'id' and
+                            audit.action == Audit.Type.Insert]
+            compacted = CompactedInsert.objects.in_bulk(id_audit_pks) \
+                if id_audit_pks else {}
+
+            for audit in chunk:
+                yield audit
+                if audit.pk in compacted and audit.field == 'id':
+                    for expanded in compacted[audit.pk].expand(audit):
+                        yield expanded
+
+
+class CompactedInsert(models.Model):
+    """
+    The field values of an object whose insert audits were compacted,
+    keyed by the id of the object's 'id' insert audit.
+
+    'values' is a list of [field, value] pairs, with each value stored
+    as the string its insert audit would have held.
+
+    There is no foreign key to the audit, since audits can be moved
+    into the archive partitions (see archive_audits).
+    """
+    audit_id = models.IntegerField(primary_key=True)
+    values = JSONField(blank=True)
+
+    def expand(self, id_audit):
+        """
+        Build the (unsaved) insert audits that were compacted into this
+        row. They share the primary key and timestamps of 'id_audit'.
+        """
+        return [Audit(pk=id_audit.pk, model=id_audit.model,
+                      model_id=id_audit.model_id,
+                      instance_id=id_audit.instance_id,
+                      field=field, previous_value=None, current_value=value,
+                      user_id=id_audit.user_id, action=Audit.Type.Insert,
+                      requires_auth=False, ref_id=None,
+                      created=id_audit.created, updated=id_audit.updated)
+                for field, value in self.values]
+
+
+class PendingEditCount(models.Model):
+    """
+    The number of pending audits on each object, which makes up the
+    moderation inbox for an instance.
+
+    Rows are maintained by a database trigger on the audit table
+    (see migration 0061), so they stay correct for bulk updates
+    and raw SQL as well as for saves through the ORM. An object's row
+    is removed when its last pending audit is reviewed.
+    """
+    instance = models.ForeignKey('Instance')
+    model = models.CharField(max_length=255)
+    model_id = models.IntegerField()
+    pending_count = models.IntegerField(default=0)
+    updated = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('instance', 'model', 'model_id')
+
+    @classmethod
+    def total_for_instance(clz, instance):
+        total = clz.objects.filter(instance=instance)\
+                           .aggregate(total=Sum('pending_count'))['total']
+        return total or 0
+
+    @classmethod
+    def pending_audits_for_entries(clz, entries):
+        """
+        Fetch the pending audits for a page of entries with a single
+        query, returning a dict of (model, model_id) => [audit, ...]
+        """
+        entries = list(entries)
+        audits_by_object = {(entry.model, entry.model_id): []
+                            for entry in entries}
+
+        if not entries:
+            return audits_by_object
+
+        instance_ids = {entry.instance_id for entry in entries}
+        audits = Audit.objects.filter(instance_id__in=instance_ids,
+                                      requires_auth=True,
+                                      ref__isnull=True)\
+                              .filter(_object_keys_filter(
+                                  audits_by_object.keys()))\
+                              .select_related('user', 'instance')\
+                              .order_by('created')
+
+        for audit in audits:
+            audits_by_object[(audit.model, audit.model_id)].append(audit)
+
+        return audits_by_object
+
+
+def _audit_archive_table_name(instance_id):
+    return 'treemap_audit_archive_%d' % instance_id
+
+
+def _ensure_audit_archive_partition(cursor, instance_id):
+    """
+    Create the archive partition for the given instance if it
+    doesn't already exist.
+
+    Partitions inherit from treemap_audit_archive (which in turn
+    inherits from treemap_audit) and are constrained to a single
+    instance. Archived rows are never updated so the pages are
+    packed completely.
+    """
+    table_name = _audit_archive_table_name(instance_id)
+
+    cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s",
+                   [table_name])
+    if cursor.fetchone() is not None:
+        return table_name
+
+    cursor.execute(
+        'CREATE TABLE %(table)s (CHECK (instance_id = %(iid)d)) '
+        'INHERITS (treemap_audit_archive) WITH (fillfactor = 100)'
+        % {'table': table_name, 'iid': instance_id})
+
+    # Neither the primary key nor its index are inherited, so archived
+    # audits would otherwise be found by id with a sequential scan
+    cursor.execute('CREATE UNIQUE INDEX %(table)s_id ON %(table)s (id)'
+                   % {'table': table_name})
+
+    for columns in ('model, model_id', 'updated', 'user_id', 'ref_id'):
+        cursor.execute(
+            'CREATE INDEX %(table)s_%(name)s ON %(table)s (%(columns)s)'
+            % {'table': table_name,
+               'name': columns.replace(', ', '_'),
+               'columns': columns})
+
+    return table_name
+
+
+@transaction.commit_on_success
+def archive_audits(instance, before):
+    """
+    Move the audit history of an instance created before the
+    'before' datetime out of the main audit table and into the
+    instance's archive partition. Returns the number of audits
+    that were moved.
+
+    Since archive partitions inherit from treemap_audit, querying
+    Audit.objects still returns archived audits. The move only
+    shrinks the table that new audits (and their indexes) are
+    written to.
+
+    Audits that are still pending are never archived, nor are
+    audits that are referenced by an audit that stays behind, since
+    foreign key constraints are not inherited by the partitions.
+    """
+    cursor = connection.cursor()
+    table_name = _ensure_audit_archive_partition(cursor, instance.pk)
+
+    cursor.execute("""
+    WITH moved AS (
+        DELETE FROM ONLY treemap_audit a
+        WHERE a.instance_id = %%s
+          AND a.created < %%s
+          AND NOT (a.requires_auth AND a.ref_id IS NULL)
+          AND NOT EXISTS (SELECT 1 FROM ONLY treemap_audit r
+                          WHERE r.ref_id = a.id)
+        RETURNING a.*)
+    INSERT INTO %s SELECT * FROM moved
+    """ % table_name, [instance.pk, before])
+
+    return cursor.rowcount
+
+
+def compact_audits(instance, before=None, user=None, batch_size=1000):
+    """
+    Compact the insert audits of objects already created in an
+    instance, as if they had been saved in compact_insert_audits mode.
+    Only objects created before 'before' and/or by 'user' are compacted
+    when those are given. Returns the number of audits removed.
+
+    An insert audit is only compacted if it was made by the same user
+    as the object's 'id' audit, was applied directly and has not been
+    reviewed. Each batch of 'batch_size' objects is committed
+    separately.
+    """
+    id_audits = Audit.objects.filter(instance=instance, field='id',
+                                     action=Audit.Type.Insert,
+                                     requires_auth=False)
+    if before is not None:
+        id_audits = id_audits.filter(created__lt=before)
+    if user is not None:
+        id_audits = id_audits.filter(user=user)
+
+    removed = 0
+    last_pk = 0
+    while True:
+        batch = list(id_audits.filter(pk__gt=last_pk)
+                              .order_by('pk')
+                              .values_list('pk', 'model', 'model_id',
+                                           'user_id')[:batch_size])
+        if not batch:
+            return removed
+
+        removed += _compact_batch(instance, batch)
+        last_pk = batch[-1][0]
+
+
+@transaction.commit_on_success
+def _compact_batch(instance, id_audits):
+    id_audit_for_object = {(model, model_id): (pk, user_id)
+                           for pk, model, model_id, user_id in id_audits}
+
+    candidates = Audit.objects.filter(
+        instance=instance,
+        model__in={row[1] for row in id_audits},
+        model_id__in={row[2] for row in id_audits},
+        action=Audit.Type.Insert,
+        requires_auth=False,
+        ref__isnull=True)\
+        .exclude(field='id')\
+        .order_by('pk')\
+        .values_list('pk', 'model', 'model_id', 'user_id',
+                     'field', 'current_value')
+
+    compacted = defaultdict(list)
+    audit_pks = []
+    for pk, model, model_id, user_id, field, value in candidates:
+        id_audit_pk, id_user_id = id_audit_for_object.get(
+            (model, model_id), (None, None))
+        if id_user_id == user_id and _is_compactable(model, field):
+            compacted[id_audit_pk].append((pk, field, value))
+            audit_pks.append(pk)
+
+    # Audits that other audits refer to have to stay in place
+    referenced = set(Audit.objects.filter(ref_id__in=audit_pks)
+                                  .values_list('ref_id', flat=True))
+
+    audit_pks = [pk for pk in audit_pks if pk not in referenced]
+    if not audit_pks:
+        return 0
+
+    existing = CompactedInsert.objects.in_bulk(compacted.keys())
+    new_rows = []
+    for id_audit_pk, values in compacted.iteritems():
+        values = [[field, value] for pk, field, value in values
+                  if pk not in referenced]
+        if not values:
+            continue
+        elif id_audit_pk in existing:
+            row = existing[id_audit_pk]
+            row.values = list(row.values) + values
+            row.save()
+        else:
+            new_rows.append(CompactedInsert(audit_id=id_audit_pk,
+                                            values=values))
+
+    CompactedInsert.objects.bulk_create(new_rows, batch_size=_BULK_BATCH_SIZE)
+
+    # Not "ONLY", so that archived audits are removed as well
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM treemap_audit WHERE id = ANY(%s)',
+                   [audit_pks])
+
+    return cursor.rowcount
+
 
 class ReputationMetric(models.Model):
     """
@@ -1176,28 +2258,23 @@ class ReputationMetric(models.Model):
         return "%s - %s - %s" % (self.instance, self.model_name, self.action)
 
     @staticmethod
-    def apply_adjustment(audit):
-        try:
-            rm = ReputationMetric.objects.get(instance=audit.instance,
-                                              model_name=audit.model,
-                                              action=audit.action)
-        except ObjectDoesNotExist:
-            return
+    def reputation_change(audit):
+        """
+        The change in reputation that saving 'audit' earns its user,
+        or None if there is no metric for the audit
+        """
+        rm = reputation_metric_cache.get_metric(
+            audit.instance_id, audit.model, audit.action)
 
-        iuser = audit.user.get_instance_user(audit.instance)
+        if rm is None:
+            return None
 
         if audit.requires_auth and audit.ref:
             review_audit = audit.ref
             if review_audit.action == Audit.Type.PendingApprove:
-                iuser.reputation += rm.approval_score
-                iuser.save_base()
+                return rm.approval_score
             elif review_audit.action == Audit.Type.PendingReject:
-                new_score = iuser.reputation - rm.denial_score
-                if new_score >= 0:
-                    iuser.reputation = new_score
-                else:
-                    iuser.reputation = 0
-                iuser.save_base()
+                return -(rm.denial_score or 0)
             else:
                 error_message = ("Referenced Audits must carry approval "
                                  "actions. They must have an action of "
@@ -1206,8 +2283,135 @@ class ReputationMetric(models.Model):
                                  "database configuration.")
                 raise IntegrityError(error_message)
         elif not audit.requires_auth:
-            iuser.reputation += rm.direct_write_score
-            iuser.save_base()
+            return rm.direct_write_score
+        else:
+            return None
+
+    @staticmethod
+    def apply_adjustment(audit):
+        delta = ReputationMetric.reputation_change(audit)
+
+        if delta:
+            ReputationLedgerEntry.objects.create(
+                instance_id=audit.instance_id, user_id=audit.user_id,
+                delta=delta)
+
+
+class ReputationMetricCache(object):
+    """
+    Cache the reputation metrics of each instance for
+    REPUTATION_METRIC_CACHE_TTL seconds. The cache is dropped whenever
+    a metric is saved or deleted in this process; changes made by
+    other processes are seen once the cached metrics expire.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cache = {}
+
+    def get_metrics_for_instance(self, instance_id):
+        now = time.time()
+        entry = self.cache.get(instance_id)
+
+        if entry is None or entry[0] <= now:
+            metrics = {(rm.model_name, rm.action): rm
+                       for rm in ReputationMetric.objects.filter(
+                           instance__pk=instance_id)}
+            entry = (now + settings.REPUTATION_METRIC_CACHE_TTL, metrics)
+            self.cache[instance_id] = entry
+
+        return entry[1]
+
+    def get_metric(self, instance_id, model_name, action):
+        metrics = self.get_metrics_for_instance(instance_id)
+        return metrics.get((model_name, unicode(action)))
+
+reputation_metric_cache = ReputationMetricCache()
+
+
+@receiver(post_save, sender=ReputationMetric)
+@receiver(post_delete, sender=ReputationMetric)
+def clear_reputation_metric_cache(*args, **kwargs):
+    reputation_metric_cache.reset()
+
+
+class ReputationLedgerEntry(models.Model):
+    """
+    An append-only record of changes to users' reputations.
+
+    Adding an entry for each reviewed audit avoids updating (and
+    locking) the InstanceUser row of busy users on every edit. Entries
+    are periodically rolled up into InstanceUser.reputation with
+    roll_up, after which they are removed.
+    """
+    instance = models.ForeignKey('Instance')
+    user = models.ForeignKey('treemap.User')
+    delta = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def apply_deltas(reputation, deltas):
+        """
+        Reputation can never drop below zero, so deltas are applied
+        one at a time in the order they were recorded
+        """
+        for delta in deltas:
+            reputation = max(0, reputation + delta)
+        return reputation
+
+    @classmethod
+    @transaction.commit_on_success
+    def roll_up(clz, instance=None):
+        """
+        Apply the entries recorded so far to InstanceUser.reputation
+        and remove them. Returns the number of entries rolled up.
+        """
+        # Delayed import to prevent circular imports
+        from treemap.models import InstanceUser, instance_user_cache
+
+        # Deleting and reading the entries in one statement means that
+        # entries committed while rolling up are left for the next time
+        where, params = '', []
+        if instance is not None:
+            where, params = 'WHERE instance_id = %s ', [instance.pk]
+
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM treemap_reputationledgerentry ' + where +
+                       'RETURNING id, instance_id, user_id, delta', params)
+        entries = sorted(cursor.fetchall())
+
+        deltas = defaultdict(list)
+        for __, instance_id, user_id, delta in entries:
+            deltas[(instance_id, user_id)].append(delta)
+
+        if not deltas:
+            return 0
+
+        iusers = InstanceUser.objects\
+            .select_for_update()\
+            .filter(instance_id__in={key[0] for key in deltas},
+                    user_id__in={key[1] for key in deltas})\
+            .values_list('pk', 'instance_id', 'user_id', 'reputation')
+
+        updates = [(pk, clz.apply_deltas(reputation,
+                                         deltas[(instance_id, user_id)]))
+                   for pk, instance_id, user_id, reputation in iusers
+                   if (instance_id, user_id) in deltas]
+
+        for start in xrange(0, len(updates), _BULK_BATCH_SIZE):
+            batch = updates[start:start + _BULK_BATCH_SIZE]
+            values = ', '.join(['(%s, %s)'] * len(batch))
+            cursor.execute(
+                'UPDATE treemap_instanceuser '
+                'SET reputation = v.reputation '
+                'FROM (VALUES %s) AS v (id, reputation) '
+                'WHERE treemap_instanceuser.id = v.id' % values,
+                [value for update in batch for value in update])
+
+        instance_user_cache.invalidate()
+
+        return len(entries)
 
 
 @receiver(post_save, sender=Audit)
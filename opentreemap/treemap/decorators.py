@@ -15,7 +15,7 @@ from django.core.exceptions import ValidationError
 from django.views.decorators.http import require_http_methods
 
 from treemap.util import (LazyEncoder, add_visited_instance,
-                          get_instance_or_404, login_redirect)
+                          get_cached_instance_or_404, login_redirect)
 from treemap.exceptions import (FeatureNotEnabledException,
                                 HttpBadRequestException)
 
@@ -23,20 +23,29 @@ from treemap.exceptions import (FeatureNotEnabledException,
 def instance_request(view_fn):
     @wraps(view_fn)
     def wrapper(request, instance_url_name, *args, **kwargs):
-        instance = get_instance_or_404(url_name=instance_url_name)
+        instance = get_cached_instance_or_404(instance_url_name)
+
+        # Drop cached UDF definitions changed by other processes
+        # (imported here for the same reason as in creates_instance_user)
+        from treemap.udf import udf_cache
+        udf_cache.validate_instance(instance)
+
         # Include the instance as both a request property and as an
         # view function argument for flexibility and to keep "template
         # only" requests simple.
         request.instance = instance
 
-        request.instance_supports_ecobenefits = instance.has_itree_region()
+        request.instance_supports_ecobenefits = instance.supports_ecobenefits
 
         user = request.user
+        instance_user = None
         if user.is_authenticated():
             instance_user = user.get_instance_user(instance)
             request.instance_user = instance_user
 
-        if instance.is_accessible_by(request.user):
+        # Members were found above, so only other users need checking
+        if (instance.is_public or instance_user is not None or
+                instance.is_accessible_by(request.user)):
             add_visited_instance(request, instance)
             return view_fn(request, instance, *args, **kwargs)
         else:
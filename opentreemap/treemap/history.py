@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Reconstruct plots and trees as they were at some point in the past by
+replaying the audit log.
+
+The state of an object is kept as a dictionary of field name to the
+string value found in the audit log ('udf:<name>' for scalar UDFs). An
+object exists if its state has an 'id'.
+
+Snapshots (see take_snapshot) store the state of every plot and tree in
+an instance at a point in time, so reconstruction only needs to replay
+the audits made since the nearest earlier snapshot.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.db import transaction
+from django.db.models.fields import FieldDoesNotExist
+
+from treemap.audit import Audit, _audit_value_to_python
+from treemap.models import Plot, Tree, AuditSnapshot, AuditSnapshotEntry
+
+
+SNAPSHOT_MODELS = (Plot, Tree)
+
+# Approving an applied edit changes nothing and a rejected pending
+# edit was never applied. Pending audits only take effect through the
+# PendingApprove audit created when they are approved.
+_NO_EFFECT_ACTIONS = (Audit.Type.ReviewApprove, Audit.Type.PendingReject)
+
+
+def _effective_audits(instance, model_name, when, since=None):
+    audits = Audit.objects.filter(instance=instance,
+                                  model=model_name,
+                                  requires_auth=False,
+                                  created__lte=when)\
+                          .exclude(action__in=_NO_EFFECT_ACTIONS)
+
+    if since is not None:
+        audits = audits.filter(created__gt=since)
+
+    return audits
+
+
+def apply_audits(state, audits):
+    """
+    Replay audits, in the order they were created, on top of an object
+    state and return the new state
+    """
+    for audit in audits:
+        if (audit.action == Audit.Type.Delete or
+                (audit.action == Audit.Type.ReviewReject and
+                 audit.field == 'id')):
+            state = {}
+        elif audit.action == Audit.Type.ReviewReject:
+            # As in approve_or_reject_existing_edit, rejecting an edit
+            # only reverts the field if it is still the current value
+            if state.get(audit.field) == audit.current_value:
+                state[audit.field] = audit.previous_value
+        else:
+            state[audit.field] = audit.current_value
+
+    return state
+
+
+def nearest_snapshot(instance, when):
+    """
+    The most recent snapshot of the instance taken at or before 'when',
+    or None if there isn't one
+    """
+    snapshots = AuditSnapshot.objects.filter(instance=instance,
+                                             taken_at__lte=when)\
+                                     .order_by('-taken_at', '-pk')[:1]
+    return snapshots[0] if snapshots else None
+
+
+def object_state_as_of(instance, model_name, model_id, when):
+    """
+    The state of an object as of 'when', or None if the object didn't
+    exist at that time
+    """
+    snapshot = nearest_snapshot(instance, when)
+
+    if snapshot is None:
+        state = {}
+        audits = _effective_audits(instance, model_name, when)
+    else:
+        entries = AuditSnapshotEntry.objects.filter(snapshot=snapshot,
+                                                    model=model_name,
+                                                    model_id=model_id)[:1]
+        state = dict(entries[0].data) if entries else {}
+        audits = _effective_audits(instance, model_name, when,
+                                   since=snapshot.taken_at)
+
+    audits = audits.filter(model_id=model_id).order_by('created', 'pk')
+    state = apply_audits(state, Audit.expand_compacted(audits))
+
+    return state if 'id' in state else None
+
+
+def build_object(model_class, instance, state):
+    """
+    Create an unsaved object from a state. Fields and UDFs that have
+    been removed since the audits were written are skipped.
+    """
+    model_id = int(state['id'])
+    obj = model_class(pk=model_id)
+    obj.id = model_id  # for e.g. Plot, where pk != id
+    obj.instance = instance
+
+    scalar_udf_names = {udf.name for udf in obj.get_user_defined_fields()
+                        if not udf.iscollection}
+
+    for field_name, value in state.iteritems():
+        if field_name == 'id':
+            continue
+        elif field_name.startswith('udf:'):
+            if field_name[4:] in scalar_udf_names:
+                obj.apply_change(field_name, value)
+        else:
+            try:
+                field = model_class._meta.get_field(field_name)
+            except FieldDoesNotExist:
+                continue
+            setattr(obj, field.attname,
+                    _audit_value_to_python(field, value))
+
+    obj.populate_previous_state()
+
+    return obj
+
+
+def reconstruct_as_of(model_class, instance, model_id, when):
+    """
+    Rebuild a plot or tree as it was at 'when' from the audit log.
+    Returns an unsaved object, or None if it didn't exist at that time.
+    """
+    state = object_state_as_of(instance, model_class.__name__,
+                               model_id, when)
+
+    if state is None:
+        return None
+
+    return build_object(model_class, instance, state)
+
+
+def _id_batches(audits, entries, batch_size):
+    """
+    Split the ids of the objects found in the audits or snapshot
+    entries into ranges (lower bound exclusive, upper bound inclusive)
+    covering at most 'batch_size' objects each
+    """
+    lower = None
+    while True:
+        batch_audits, batch_entries = audits, entries
+        if lower is not None:
+            batch_audits = batch_audits.filter(model_id__gt=lower)
+            batch_entries = batch_entries.filter(model_id__gt=lower)
+
+        ids = set()
+        for qs in (batch_audits, batch_entries):
+            ids |= set(qs.order_by('model_id')
+                         .values_list('model_id', flat=True)
+                         .distinct()[:batch_size])
+
+        if not ids:
+            return
+
+        # The smallest 'batch_size' ids of the union are always among
+        # the first 'batch_size' ids of each query
+        upper = sorted(ids)[:batch_size][-1]
+        yield lower, upper
+        lower = upper
+
+
+@transaction.commit_on_success
+def take_snapshot(instance, when, batch_size=1000):
+    """
+    Store the state of every plot and tree in the instance as of 'when'.
+
+    The snapshot is built from the nearest earlier snapshot and the
+    audits made since then, 'batch_size' objects at a time, so only the
+    audits since the earlier snapshot are replayed and memory use is
+    bounded by the batch size.
+    """
+    previous = nearest_snapshot(instance, when)
+    snapshot = AuditSnapshot.objects.create(instance=instance, taken_at=when)
+
+    for model_class in SNAPSHOT_MODELS:
+        model_name = model_class.__name__
+
+        if previous is None:
+            audits = _effective_audits(instance, model_name, when)
+            entries = AuditSnapshotEntry.objects.none()
+        else:
+            audits = _effective_audits(instance, model_name, when,
+                                       since=previous.taken_at)
+            entries = AuditSnapshotEntry.objects.filter(snapshot=previous,
+                                                        model=model_name)
+
+        for lower, upper in _id_batches(audits, entries, batch_size):
+            batch_audits = audits.filter(model_id__lte=upper)
+            batch_entries = entries.filter(model_id__lte=upper)
+            if lower is not None:
+                batch_audits = batch_audits.filter(model_id__gt=lower)
+                batch_entries = batch_entries.filter(model_id__gt=lower)
+
+            states = {entry.model_id: dict(entry.data)
+                      for entry in batch_entries}
+
+            batch_audits = batch_audits.order_by('model_id', 'created', 'pk')
+            for audit in Audit.expand_compacted(batch_audits.iterator()):
+                states[audit.model_id] = apply_audits(
+                    states.get(audit.model_id, {}), [audit])
+
+            # Fields approved before a pending insert are kept, so the
+            # insert can still be replayed from this snapshot
+            AuditSnapshotEntry.objects.bulk_create(
+                [AuditSnapshotEntry(snapshot=snapshot, model=model_name,
+                                    model_id=model_id, data=state)
+                 for model_id, state in states.iteritems() if state])
+
+    return snapshot
+
+
+def iter_snapshot_objects(snapshot, model_class):
+    """
+    Build each object of 'model_class' that existed when the snapshot
+    was taken
+    """
+    entries = AuditSnapshotEntry.objects.filter(snapshot=snapshot,
+                                                model=model_class.__name__)\
+                                        .order_by('model_id')
+
+    for entry in entries.iterator():
+        if 'id' in entry.data:
+            yield build_object(model_class, snapshot.instance,
+                               dict(entry.data))
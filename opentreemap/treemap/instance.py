@@ -7,13 +7,16 @@ from django.contrib.gis.db import models
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.core.validators import RegexValidator
 from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext as trans
 
+import copy
 import hashlib
 import json
 from urllib import urlencode
 
-from treemap.json_field import JSONField
+from treemap.json_field import JSONField, get_json_value, get_raw_json
 from treemap.species import ITREE_REGION_CHOICES
 
 URL_NAME_PATTERN = r'[a-zA-Z]+[a-zA-Z0-9\-]*'
@@ -26,6 +29,10 @@ def reserved_name_validator(name):
                                     'cannot be used') % {'instancename': name})
 
 
+def _ewkb(geom):
+    return bytes(geom.ewkb) if geom else None
+
+
 class Instance(models.Model):
     """
     Each "Tree Map" is a single instance
@@ -75,12 +82,50 @@ class Instance(models.Model):
     """
     geo_rev = models.IntegerField(default=1)
 
+    """
+    Incremented by a database trigger whenever a user defined field
+    of the instance is created, changed or deleted. Processes compare
+    it with the revision their cached UDF definitions were loaded at.
+
+    You should *not* edit this field.
+    """
+    udf_rev = models.IntegerField(default=1)
+
+    """
+    Incremented by a database trigger whenever a species of the
+    instance is created, changed or deleted. Processes compare it with
+    the revision their cached species index was built at.
+
+    You should *not* edit this field.
+    """
+    species_rev = models.IntegerField(default=1)
+
+    """
+    Incremented by a database trigger whenever the instance is saved
+    with changes to anything but its other revisions. Processes compare
+    it with the revision of the instance they have cached (see
+    InstanceCache).
+
+    You should *not* edit this field.
+    """
+    config_rev = models.IntegerField(default=1)
+
     eco_benefits_conversion = models.ForeignKey(
         'BenefitCurrencyConversion', null=True, blank=True)
 
     """ Center of the map when loading the instance """
     bounds = models.MultiPolygonField(srid=3857)
 
+    """
+    The centroid (in both web mercator and lat/lng) and the envelope of
+    the bounds, stored whenever the instance is saved with new bounds.
+    Use the center, center_lat_lng and extent_as_json properties.
+    """
+    bounds_center = models.PointField(srid=3857, null=True, blank=True)
+    bounds_center_lat_lng = models.PointField(srid=4326, null=True,
+                                              blank=True)
+    bounds_envelope = models.PolygonField(srid=3857, null=True, blank=True)
+
     default_role = models.ForeignKey('Role', related_name='default_role')
 
     users = models.ManyToManyField('User', through='InstanceUser',
@@ -107,6 +152,13 @@ class Instance(models.Model):
     itree_region_default = models.CharField(
         max_length=20, null=True, blank=True, choices=ITREE_REGION_CHOICES)
 
+    """
+    The stored result of has_itree_region, updated when the instance is
+    saved with new bounds or a new default region and when i-Tree
+    regions change
+    """
+    supports_ecobenefits = models.BooleanField(default=False)
+
     objects = models.GeoManager()
 
     def __unicode__(self):
@@ -114,7 +166,12 @@ class Instance(models.Model):
 
     def _make_config_property(prop, default=None):
         def get_config(self):
-            return self.config.get(prop, default)
+            value = get_json_value(self, 'config.' + prop, default)
+            if isinstance(value, (dict, list)):
+                # Callers may change these in place, so they must come
+                # from the config itself
+                return self.config.get(prop, default)
+            return value
 
         def set_config(self, value):
             self.config[prop] = value
@@ -135,15 +192,15 @@ class Instance(models.Model):
 
     @property
     def extent_as_json(self):
-        boundary = self.bounds.boundary
-        xmin, ymin, xmax, ymax = boundary.extent
+        envelope = self.bounds_envelope or self.bounds.envelope
+        xmin, ymin, xmax, ymax = envelope.extent
 
         return json.dumps({'xmin': xmin, 'ymin': ymin,
                            'xmax': xmax, 'ymax': ymax})
 
     @property
     def center(self):
-        return self.bounds.centroid
+        return self.bounds_center or self.bounds.centroid
 
     @property
     def geo_rev_hash(self):
@@ -151,7 +208,8 @@ class Instance(models.Model):
 
     @property
     def center_lat_lng(self):
-        return self.center.transform(4326, clone=True)
+        return (self.bounds_center_lat_lng or
+                self.center.transform(4326, clone=True))
 
     @property
     def factor_conversions(self):
@@ -166,9 +224,12 @@ class Instance(models.Model):
 
     @property
     def scss_query_string(self):
+        # Imported here because compiling SCSS isn't needed elsewhere
+        from treemap.scss import SCSS_VERSION_PARAM, scss_version
         scss_vars = ({k: val for k, val in self.scss_variables.items() if val}
                      if self.scss_variables else {})
-        return urlencode(scss_vars)
+        scss_vars[SCSS_VERSION_PARAM] = scss_version()
+        return urlencode(sorted(scss_vars.items()))
 
     def has_itree_region(self):
         from treemap.models import ITreeRegion  # prevent circular import
@@ -178,6 +239,39 @@ class Instance(models.Model):
 
         return bool(self.itree_region_default) or intersecting_regions.exists()
 
+    def _changed_bounds_and_region(self):
+        """
+        Whether the bounds and the default i-Tree region differ from
+        the ones stored in the database (both are True for an instance
+        that hasn't been saved yet)
+        """
+        if self.pk is None:
+            return True, True
+
+        saved = list(Instance.objects
+                     .filter(pk=self.pk)
+                     .values_list('bounds', 'itree_region_default')[:1])
+        if not saved:
+            return True, True
+
+        saved_bounds, saved_region = saved[0]
+        bounds_changed = _ewkb(self.bounds) != _ewkb(saved_bounds)
+        return bounds_changed, self.itree_region_default != saved_region
+
+    def _store_bounds_geometry(self):
+        self.bounds_center = self.bounds.centroid
+        self.bounds_center_lat_lng = self.bounds_center.transform(
+            4326, clone=True)
+        self.bounds_envelope = self.bounds.envelope
+
+    def update_supports_ecobenefits(self):
+        supports_ecobenefits = self.has_itree_region()
+        if supports_ecobenefits != self.supports_ecobenefits:
+            self.supports_ecobenefits = supports_ecobenefits
+            Instance.objects.filter(pk=self.pk)\
+                            .update(supports_ecobenefits=supports_ecobenefits)
+            instance_cache.reset()
+
     def is_accessible_by(self, user):
         try:
             if self.is_public:
@@ -209,4 +303,84 @@ class Instance(models.Model):
 
         self.url_name = self.url_name.lower()
 
+        # Compared with the stored row rather than a snapshot taken when
+        # the instance is loaded, since instances are loaded far more
+        # often than they are saved
+        bounds_changed, region_changed = self._changed_bounds_and_region()
+
+        if bounds_changed or self.bounds_center is None:
+            self._store_bounds_geometry()
+
+        if bounds_changed or region_changed:
+            self.supports_ecobenefits = self.has_itree_region()
+
         super(Instance, self).save(*args, **kwargs)
+
+
+class InstanceCache(object):
+    """
+    Cache the instances looked up by url name while handling requests.
+
+    Each lookup costs a single query for the revisions of the instance.
+    The cached instance is used while its config_rev is unchanged, with
+    its other revisions refreshed from the query, so instances changed
+    by other processes are reloaded on their next lookup.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.lookups = 0
+        self.saved_lookups = 0
+        self.reset()
+
+    def reset(self):
+        self.cache = {}
+
+    def get(self, url_name):
+        """
+        The instance with the given url name (ignoring case). Raises
+        Instance.DoesNotExist if there isn't one.
+        """
+        revs = Instance.objects.filter(url_name__iexact=url_name)\
+                               .values_list('pk', 'config_rev', 'geo_rev',
+                                            'udf_rev', 'species_rev')
+        try:
+            pk, config_rev, geo_rev, udf_rev, species_rev = revs.get()
+        except Instance.DoesNotExist:
+            raise Instance.DoesNotExist(
+                'No instance has the url name "%s"' % url_name)
+
+        self.lookups += 1
+        key = url_name.lower()
+        entry = self.cache.get(key)
+
+        if entry and entry[0] == pk and entry[1] == config_rev:
+            self.saved_lookups += 1
+            cached_instance, config_json = entry[2], entry[3]
+            # Callers may change the instance they get back, so each
+            # lookup gets its own copy (with its own config)
+            instance = copy.copy(cached_instance)
+            instance.config = config_json
+        else:
+            instance = Instance.objects.get(pk=pk)
+            if len(self.cache) >= self.max_size:
+                self.reset()
+            config_json = get_raw_json(instance, 'config')
+            if config_json is None:
+                config_json = json.dumps(instance.config or {})
+            self.cache[key] = (pk, instance.config_rev,
+                               copy.copy(instance), config_json)
+
+        instance.geo_rev = geo_rev
+        instance.udf_rev = udf_rev
+        instance.species_rev = species_rev
+
+        return instance
+
+
+instance_cache = InstanceCache()
+
+
+@receiver(post_save, sender=Instance)
+@receiver(post_delete, sender=Instance)
+def reset_instance_cache(*args, **kwargs):
+    instance_cache.reset()
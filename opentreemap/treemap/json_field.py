@@ -1,5 +1,4 @@
 from django.contrib.gis.db import models
-from django.utils.six import with_metaclass
 
 from south.modelsinspector import add_introspection_rules
 
@@ -7,7 +6,40 @@ import json
 from DotDict import DotDict
 
 
-class JSONField(with_metaclass(models.SubfieldBase, models.TextField)):
+class LazyJSONDescriptor(object):
+    """
+    Keeps the JSON string loaded from the database (or assigned to the
+    field) and only parses it the first time the field is read. Until
+    then the string is available through get_raw_json.
+    """
+    def __init__(self, field):
+        self.field = field
+        self.raw_name = raw_json_attname(field.name)
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+
+        name = self.field.name
+        if name not in obj.__dict__:
+            raw = obj.__dict__.pop(self.raw_name, None)
+            obj.__dict__[name] = self.field.to_python(raw or '')
+        return obj.__dict__[name]
+
+    def __set__(self, obj, value):
+        if isinstance(value, basestring):
+            obj.__dict__[self.raw_name] = value
+            obj.__dict__.pop(self.field.name, None)
+        else:
+            obj.__dict__[self.field.name] = self.field.to_python(value)
+            obj.__dict__.pop(self.raw_name, None)
+
+
+class JSONField(models.TextField):
+    def contribute_to_class(self, cls, name):
+        super(JSONField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, LazyJSONDescriptor(self))
+
     def to_python(self, value):
         if isinstance(value, basestring):
             obj = json.loads(value or "{}")
@@ -15,7 +47,16 @@ class JSONField(with_metaclass(models.SubfieldBase, models.TextField)):
         else:
             return value
 
+    def pre_save(self, model_instance, add):
+        # Values that were never read are saved without parsing them
+        raw = get_raw_json(model_instance, self.name)
+        if raw is not None:
+            return _UnparsedJSON(raw or "{}")
+        return super(JSONField, self).pre_save(model_instance, add)
+
     def get_prep_value(self, value):
+        if isinstance(value, _UnparsedJSON):
+            return value
         return json.dumps(value or {})
 
     def get_prep_lookup(self, lookup_type, value):
@@ -24,6 +65,77 @@ class JSONField(with_metaclass(models.SubfieldBase, models.TextField)):
 add_introspection_rules([], ["^treemap\.json_field\.JSONField"])
 
 
+class _UnparsedJSON(unicode):
+    pass
+
+
+def raw_json_attname(field_name):
+    return '_%s_json' % field_name
+
+
+def get_raw_json(model, field_name):
+    """
+    The JSON string of a JSON field that has not been read (and so
+    can't have been changed) since it was loaded or assigned, or None
+    if the field has been parsed
+    """
+    return model.__dict__.get(raw_json_attname(field_name))
+
+
+def _flatten(value, flat=None, prefix=''):
+    if flat is None:
+        flat = {}
+    for key, child in value.iteritems():
+        path = prefix + key
+        flat[path] = child
+        if isinstance(child, dict):
+            _flatten(child, flat, path + '.')
+    return flat
+
+
+class FlatJSONCache(object):
+    """
+    Cache the contents of JSON fields (e.g. Instance.config) flattened
+    into a dictionary from every dotted path ("a", "a.b", "a.b.c") to
+    its value, so each path is found with a single dictionary lookup.
+
+    Entries are kept per object and field, and are rebuilt when the
+    JSON they were built from changes, so each revision of a field is
+    only parsed once per process. The values are shared by every
+    lookup and must not be changed.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.reset()
+
+    def reset(self):
+        self.cache = {}
+
+    def get(self, model, field_name, raw):
+        """
+        The flattened contents of the JSON string 'raw' stored in the
+        field, or None if it doesn't contain an object
+        """
+        key = (model.__class__, model.pk, field_name)
+        entry = self.cache.get(key)
+
+        if entry is None or not (entry[0] is raw or entry[0] == raw):
+            field = model._meta.get_field(field_name)
+            value = field.to_python(raw or '')
+            flat = _flatten(value) if isinstance(value, DotDict) else None
+
+            if len(self.cache) >= self.max_size:
+                self.reset()
+            entry = (raw, flat)
+            if model.pk is not None:
+                self.cache[key] = entry
+
+        return entry[1]
+
+
+flat_json_cache = FlatJSONCache()
+
+
 def is_json_field_reference(field_path):
     return '.' in field_path
 
@@ -38,6 +150,47 @@ def _get_json_as_dotdict(model, field_path):
     return dotdict, json_path
 
 
+def _get_flat_json_value(model, field_path, raw, default):
+    field, json_path = field_path.split('.', 1)
+    flat = flat_json_cache.get(model, field, raw)
+    if flat is None:
+        raise ValueError('Field %s does not contain JSON' % field_path)
+
+    if json_path in flat:
+        return flat[json_path]
+
+    # As with DotDict.get, a missing path gives the default unless it
+    # goes through a value that isn't an object
+    parts = json_path.split('.')
+    for i in xrange(1, len(parts)):
+        prefix = '.'.join(parts[:i])
+        if prefix not in flat:
+            break
+        if not isinstance(flat[prefix], dict):
+            raise KeyError('Cannot get "%s" in "%s" (%s)' %
+                           ('.'.join(parts[i:]), prefix, repr(flat[prefix])))
+    return default
+
+
+def get_json_value(model, field_path, default=None):
+    """
+    Get specified value from a JSON field, or 'default' if the JSON
+    path is not found (see get_attr_from_json_field).
+
+    Fields that haven't been read since they were loaded are looked up
+    in their cached flattened contents without parsing them. Values
+    that are objects or lists are shared with other lookups in that
+    case, so they must not be changed.
+    """
+    field = field_path.split('.', 1)[0]
+    raw = get_raw_json(model, field)
+    if raw is not None:
+        return _get_flat_json_value(model, field_path, raw, default)
+
+    dotdict, json_path = _get_json_as_dotdict(model, field_path)
+    return dotdict.get(json_path, default)
+
+
 def get_attr_from_json_field(model, field_path):
     """
     Get specified value from a JSON field.
@@ -46,8 +199,7 @@ def get_attr_from_json_field(model, field_path):
     Deeper lookups also work, e.g. "config.foo.bar.baz".
     Returns None if the JSON path is not found.
     """
-    dotdict, json_path = _get_json_as_dotdict(model, field_path)
-    return dotdict.get(json_path, None)
+    return get_json_value(model, field_path)
 
 
 def set_attr_on_json_field(model, field_path, value):
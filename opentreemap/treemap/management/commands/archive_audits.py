@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from treemap.instance import Instance
+from treemap.audit import archive_audits
+
+
+class Command(BaseCommand):
+    """
+    Move old audit history into the per-instance archive partitions
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    help='Only archive audits for this instance id'),
+        make_option('--before',
+                    dest='before',
+                    help='Archive audits created before this date '
+                         '(YYYY-MM-DD)'),
+        make_option('--days',
+                    action='store',
+                    type='int',
+                    dest='days',
+                    help='Archive audits older than this many days'))
+
+    def handle(self, *args, **options):
+        if options.get('before'):
+            try:
+                before = datetime.strptime(options['before'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('--before must be formatted as YYYY-MM-DD')
+            before = timezone.make_aware(before,
+                                         timezone.get_default_timezone())
+        elif options.get('days') is not None:
+            before = timezone.now() - timedelta(days=options['days'])
+        else:
+            raise CommandError('Specify either --before or --days')
+
+        if options.get('instance'):
+            instances = Instance.objects.filter(pk=options['instance'])
+        else:
+            instances = Instance.objects.all()
+
+        for instance in instances.order_by('pk'):
+            n = archive_audits(instance, before)
+            self.stdout.write('Archived %s audits for "%s"'
+                              % (n, instance.url_name))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from treemap.audit import Audit
+
+# The actions that place a tree on a plot
+_ASSIGNMENT_ACTIONS = (Audit.Type.Insert, Audit.Type.Update,
+                       Audit.Type.PendingApprove)
+
+_INSERT_HISTORY_SQL = """
+INSERT INTO treemap_plottreehistory
+    (instance_id, plot_id, tree_id, assigned_at, removed_at)
+SELECT a.instance_id, a.current_value::integer, a.model_id,
+       MIN(a.created), NULL
+FROM treemap_audit a
+WHERE a.model = 'Tree'
+  AND a.field = 'plot'
+  AND a.action IN %(assignment_actions)s
+  AND a.current_value ~ '^[0-9]+$'
+  %(instance_filter)s
+GROUP BY a.instance_id, a.current_value::integer, a.model_id
+"""
+
+# A tree leaves a plot the first time it is moved somewhere else,
+# deleted or has its creation rejected after it was last placed on
+# the plot.
+_UPDATE_REMOVED_SQL = """
+WITH events AS (
+    SELECT a.model_id AS tree_id, a.created,
+           CASE WHEN a.field = 'plot'
+                THEN a.current_value::integer END AS plot_id
+    FROM treemap_audit a
+    WHERE a.model = 'Tree'
+      AND NOT a.requires_auth
+      AND ((a.field = 'plot'
+            AND a.action IN %(assignment_actions)s
+            AND a.current_value ~ '^[0-9]+$')
+           OR a.action = %(delete)s
+           OR (a.action = %(review_reject)s AND a.field = 'id'))
+      %(instance_filter)s
+), last_assigned AS (
+    SELECT tree_id, plot_id, MAX(created) AS created
+    FROM events
+    WHERE plot_id IS NOT NULL
+    GROUP BY tree_id, plot_id
+)
+UPDATE treemap_plottreehistory h
+SET removed_at = (SELECT MIN(e.created)
+                  FROM events e
+                  WHERE e.tree_id = h.tree_id
+                    AND e.created > la.created
+                    AND (e.plot_id IS NULL OR e.plot_id <> h.plot_id))
+FROM last_assigned la
+WHERE la.tree_id = h.tree_id
+  AND la.plot_id = h.plot_id
+"""
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the plot tree history table from the audit log. This only
+    needs to be run once, after which the table is maintained as trees
+    are created, moved and deleted.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    help='Only rebuild the history for this instance id'),)
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+
+        instance_id = options.get('instance')
+        if instance_id:
+            cursor.execute('DELETE FROM treemap_plottreehistory '
+                           'WHERE instance_id = %s', [instance_id])
+            instance_filter = 'AND a.instance_id = %d' % instance_id
+        else:
+            cursor.execute('DELETE FROM treemap_plottreehistory')
+            instance_filter = ''
+
+        params = {'assignment_actions': str(_ASSIGNMENT_ACTIONS),
+                  'delete': Audit.Type.Delete,
+                  'review_reject': Audit.Type.ReviewReject,
+                  'instance_filter': instance_filter}
+
+        cursor.execute(_INSERT_HISTORY_SQL % params)
+        n = cursor.rowcount
+
+        cursor.execute(_UPDATE_REMOVED_SQL % params)
+
+        self.stdout.write('Created %s plot tree history records' % n)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from treemap.models import Instance, User
+from treemap.audit import compact_audits
+
+
+class Command(BaseCommand):
+    """
+    Compact the per-field insert audits of objects in an instance
+    (e.g. after a bulk import) into a single audit per object
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    help='The instance id to compact audits for'),
+        make_option('--before',
+                    dest='before',
+                    help='Only compact objects created before this date '
+                         '(YYYY-MM-DD)'),
+        make_option('--user',
+                    dest='user',
+                    help='Only compact objects created by this username'),
+        make_option('--batch-size',
+                    action='store',
+                    type='int',
+                    dest='batch_size',
+                    default=1000,
+                    help='Number of objects to compact in each transaction'))
+
+    def handle(self, *args, **options):
+        try:
+            instance = Instance.objects.get(pk=options['instance'])
+        except Instance.DoesNotExist:
+            raise CommandError('Specify a valid instance with --instance')
+
+        before = None
+        if options.get('before'):
+            try:
+                before = datetime.strptime(options['before'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('--before must be formatted as YYYY-MM-DD')
+            before = timezone.make_aware(before,
+                                         timezone.get_default_timezone())
+
+        user = None
+        if options.get('user'):
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError('No user named "%s"' % options['user'])
+
+        n = compact_audits(instance, before=before, user=user,
+                           batch_size=options['batch_size'])
+
+        self.stdout.write('Removed %s audits from "%s"'
+                          % (n, instance.url_name))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from treemap.instance import Instance
+from treemap.scss import compiled_css_cache, normalize_scss_variables
+
+
+class Command(BaseCommand):
+    """
+    Compile the CSS for the default theme and for the colors of every
+    instance into SCSS_CACHE_ROOT, so no request has to wait for it.
+    Run after each deploy.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    help='Only compile the CSS for this instance id'),)
+
+    def handle(self, *args, **options):
+        if not settings.SCSS_CACHE_ROOT:
+            raise CommandError('SCSS_CACHE_ROOT is not set, so compiled '
+                               'CSS would not be kept')
+
+        if options.get('instance'):
+            instances = Instance.objects.filter(pk=options['instance'])
+        else:
+            instances = Instance.objects.all()
+
+        themes = {(): 'the default theme'}
+        for instance in instances.order_by('pk'):
+            scss_vars = {key: value for key, value
+                         in (instance.scss_variables or {}).items() if value}
+            try:
+                variables = normalize_scss_variables(scss_vars)
+            except ValidationError as e:
+                self.stderr.write('Skipping "%s": %s'
+                                  % (instance.url_name, '; '.join(e.messages)))
+                continue
+            themes.setdefault(tuple(variables), '"%s"' % instance.url_name)
+
+        for variables, name in themes.iteritems():
+            key, _ = compiled_css_cache.get(list(variables))
+            self.stdout.write('Compiled the CSS for %s into %s.css'
+                              % (name, key))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from treemap.models import Instance, User
+from treemap.audit import (Audit, bulk_approve_or_reject_audits_and_apply,
+                           bulk_approve_or_reject_existing_edits)
+
+
+class Command(BaseCommand):
+    """
+    Approve or reject every pending edit (or, with --existing, every
+    unreviewed applied edit) in an instance in bulk
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    help='The instance id to moderate'),
+        make_option('--approve',
+                    action='store_true',
+                    dest='approve',
+                    default=False,
+                    help='Approve the edits'),
+        make_option('--reject',
+                    action='store_true',
+                    dest='reject',
+                    default=False,
+                    help='Reject the edits'),
+        make_option('--existing',
+                    action='store_true',
+                    dest='existing',
+                    default=False,
+                    help='Review applied edits instead of pending edits'),
+        make_option('--model',
+                    dest='model',
+                    help='Only moderate edits to this model (e.g. "Plot")'),
+        make_option('--user',
+                    dest='user',
+                    help='Only moderate edits made by this username'),
+        make_option('--reviewer',
+                    dest='reviewer',
+                    help='Username to moderate as (default: system user)'))
+
+    def handle(self, *args, **options):
+        if options['approve'] == options['reject']:
+            raise CommandError('Specify exactly one of --approve or --reject')
+
+        try:
+            instance = Instance.objects.get(pk=options['instance'])
+        except Instance.DoesNotExist:
+            raise CommandError('Specify a valid instance with --instance')
+
+        if options.get('reviewer'):
+            reviewer = User.objects.get(username=options['reviewer'])
+        else:
+            reviewer = User.system_user()
+
+        audits = Audit.objects.filter(instance=instance, ref__isnull=True,
+                                      action__in=[Audit.Type.Insert,
+                                                  Audit.Type.Update])
+
+        if options.get('model'):
+            audits = audits.filter(model=options['model'])
+
+        if options.get('user'):
+            audits = audits.filter(user__username=options['user'])
+
+        if options['existing']:
+            audits = audits.filter(requires_auth=False)
+            moderate = bulk_approve_or_reject_existing_edits
+        else:
+            audits = audits.filter(requires_auth=True)
+            moderate = bulk_approve_or_reject_audits_and_apply
+
+        reviews = moderate(audits, reviewer, options['approve'])
+
+        self.stdout.write('%s %s edits'
+                          % ('Approved' if options['approve'] else 'Rejected',
+                             len(reviews)))
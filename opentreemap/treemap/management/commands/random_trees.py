@@ -10,6 +10,7 @@ import math
 from django.contrib.gis.geos import Point
 
 from treemap.models import Plot, Tree, Species
+from treemap.audit import compact_insert_audits
 
 from treemap.management.util import InstanceDataCommand
 
@@ -82,7 +83,8 @@ class Command(InstanceDataCommand):
             plot = Plot(instance=instance,
                         geom=Point(x, y))
 
-            plot.save_with_user(user)
+            with compact_insert_audits():
+                plot.save_with_user(user)
             cp += 1
 
             if mktree:
@@ -102,7 +104,8 @@ class Command(InstanceDataCommand):
                             species=species,
                             diameter=diameter,
                             instance=instance)
-                tree.save_with_user(user)
+                with compact_insert_audits():
+                    tree.save_with_user(user)
                 ct += 1
 
         self.stdout.write("Created %s trees and %s plots" % (ct, cp))
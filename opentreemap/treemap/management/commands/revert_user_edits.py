@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from treemap.models import Instance, User
+from treemap.audit import revert_user_edits
+
+
+def _parse_date(value, option_name):
+    try:
+        date = datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError('%s must be formatted as YYYY-MM-DD' % option_name)
+    return timezone.make_aware(date, timezone.get_default_timezone())
+
+
+class Command(BaseCommand):
+    """
+    Roll back every unreviewed edit a user made to an instance in a
+    period of time, for cleaning up after vandalism
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    help='The instance id to revert edits in'),
+        make_option('--user',
+                    dest='user',
+                    help='The username whose edits should be reverted'),
+        make_option('--start',
+                    dest='start',
+                    help='Revert edits made on or after this date '
+                         '(YYYY-MM-DD, default: all edits)'),
+        make_option('--end',
+                    dest='end',
+                    help='Revert edits made up to this date '
+                         '(YYYY-MM-DD, default: now)'),
+        make_option('--reviewer',
+                    dest='reviewer',
+                    help='Username to reject the edits as '
+                         '(default: system user)'))
+
+    def handle(self, *args, **options):
+        try:
+            instance = Instance.objects.get(pk=options['instance'])
+        except Instance.DoesNotExist:
+            raise CommandError('Specify a valid instance with --instance')
+
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError('Specify a valid username with --user')
+
+        if options.get('reviewer'):
+            reviewer = User.objects.get(username=options['reviewer'])
+        else:
+            reviewer = User.system_user()
+
+        if options.get('start'):
+            start = _parse_date(options['start'], '--start')
+        else:
+            start = timezone.make_aware(datetime(1970, 1, 1), timezone.utc)
+
+        if options.get('end'):
+            end = _parse_date(options['end'], '--end')
+        else:
+            end = timezone.now()
+
+        def progress(done, total):
+            self.stdout.write('Reviewed %s of %s edits' % (done, total))
+
+        reviews = revert_user_edits(user, instance, start, end, reviewer,
+                                    progress=progress)
+
+        self.stdout.write('Reverted %s edits by "%s"'
+                          % (len(reviews), user.username))
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from treemap.instance import Instance
+from treemap.audit import ReputationLedgerEntry
+
+
+class Command(BaseCommand):
+    """
+    Apply the reputation ledger to the users' stored reputations. This
+    should be run periodically to keep the ledger small.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    help='Only roll up reputation for this instance id'),)
+
+    def handle(self, *args, **options):
+        instance = None
+        if options.get('instance'):
+            try:
+                instance = Instance.objects.get(pk=options['instance'])
+            except Instance.DoesNotExist:
+                raise CommandError('Specify a valid instance with --instance')
+
+        n = ReputationLedgerEntry.roll_up(instance)
+
+        self.stdout.write('Rolled up %s reputation changes' % n)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from treemap.instance import Instance
+from treemap.history import take_snapshot
+
+
+class Command(BaseCommand):
+    """
+    Store the state of every plot and tree in an instance as of a given
+    date, so that older states can be reconstructed without replaying
+    the whole audit log. Run periodically to keep reconstruction fast.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    help='The instance id to snapshot'),
+        make_option('--date',
+                    dest='date',
+                    help='Take the snapshot as of the start of this date '
+                         '(YYYY-MM-DD, default: now)'),
+        make_option('--batch-size',
+                    action='store',
+                    type='int',
+                    dest='batch_size',
+                    default=1000,
+                    help='The number of objects to process at a time'))
+
+    def handle(self, *args, **options):
+        try:
+            instance = Instance.objects.get(pk=options['instance'])
+        except Instance.DoesNotExist:
+            raise CommandError('Specify a valid instance with --instance')
+
+        if options.get('date'):
+            try:
+                when = datetime.strptime(options['date'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('--date must be formatted as YYYY-MM-DD')
+            when = timezone.make_aware(when, timezone.get_default_timezone())
+        else:
+            when = timezone.now()
+
+        snapshot = take_snapshot(instance, when, options['batch_size'])
+
+        self.stdout.write('Created a snapshot of %s objects for "%s" at %s'
+                          % (snapshot.auditsnapshotentry_set.count(),
+                             instance.url_name, when))
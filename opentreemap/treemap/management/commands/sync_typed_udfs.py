@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from treemap.models import Instance, Plot, Tree
+from treemap.udf import rebuild_typed_udf_values
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the typed copies of the numeric, date and choice UDF values
+    used for sorting and range filters when UDF_TYPED_STORAGE is on
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    help='Only sync UDF values for this instance id'),
+        make_option('--batch-size',
+                    action='store',
+                    type='int',
+                    dest='batch_size',
+                    default=1000,
+                    help='Number of objects to sync at once'))
+
+    def handle(self, *args, **options):
+        if options.get('instance'):
+            instances = Instance.objects.filter(pk=options['instance'])
+        else:
+            instances = Instance.objects.all()
+
+        for instance in instances.order_by('pk'):
+            for model_class in (Plot, Tree):
+                n = rebuild_typed_udf_values(instance, model_class,
+                                             options['batch_size'])
+                self.stdout.write('Synced UDF values of %s %s objects '
+                                  'for "%s"' % (n, model_class.__name__,
+                                                instance.url_name))
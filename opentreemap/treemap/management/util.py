@@ -9,6 +9,7 @@ from django.core.management.base import BaseCommand
 
 from treemap.models import (Instance, User, Plot, Tree,
                             FieldPermission, Role, InstanceUser)
+from treemap.audit import sync_field_permissions
 
 
 class InstanceDataCommand(BaseCommand):
@@ -46,27 +47,16 @@ class InstanceDataCommand(BaseCommand):
             instance_user.save_with_user(user)
             self.stdout.write('Added system user to instance with global role')
 
-        for field in Plot._meta.get_all_field_names():
-            _, c = FieldPermission.objects.get_or_create(
-                model_name='Plot',
-                field_name=field,
-                role=instance_user.role,
-                instance=instance,
-                permission_level=FieldPermission.WRITE_DIRECTLY)
-            if c:
-                self.stdout.write('Created plot permission for field "%s"'
-                                  % field)
+        permissions = [(Model.__name__, field,
+                        FieldPermission.WRITE_DIRECTLY)
+                       for Model in (Plot, Tree)
+                       for field in Model._meta.get_all_field_names()]
+        created, _ = sync_field_permissions(instance_user.role, permissions,
+                                            instance=instance)
 
-        for field in Tree._meta.get_all_field_names():
-            _, c = FieldPermission.objects.get_or_create(
-                model_name='Tree',
-                field_name=field,
-                role=instance_user.role,
-                instance=instance,
-                permission_level=FieldPermission.WRITE_DIRECTLY)
-            if c:
-                self.stdout.write('Created tree permission for field "%s"'
-                                  % field)
+        for perm in created:
+            self.stdout.write('Created %s permission for field "%s"'
+                              % (perm.model_name.lower(), perm.field_name))
 
         dt = 0
         dp = 0
@@ -3,8 +3,12 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import copy
 import hashlib
 import re
+import string
+import threading
+import time
 
 from django.conf import settings
 from django.core.mail import send_mail
@@ -13,6 +17,8 @@ from django.core import validators
 from django.contrib.gis.db import models
 from django.contrib.gis.measure import D
 from django.db import IntegrityError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as trans
 
@@ -23,8 +29,9 @@ from treemap.species import ITREE_REGIONS
 
 from treemap.audit import (Auditable, Authorizable, FieldPermission, Role,
                            Dictable, Audit, AuthorizableQuerySet,
-                           AuthorizableManager)
+                           AuthorizableManager, ReputationLedgerEntry)
 from treemap.util import save_uploaded_image
+from treemap.json_field import JSONField
 from treemap.units import Convertible
 from treemap.udf import UDFModel, GeoHStoreUDFManager, GeoHStoreUDFQuerySet
 from treemap.instance import Instance
@@ -325,8 +332,16 @@ class User(Auditable, AbstractUniqueEmailUser):
                 'username': self.username}
 
     def get_instance_user(self, instance):
+        if self.pk is None or instance.pk is None:
+            return self._load_instance_user(instance)
+
+        return instance_user_cache.get(
+            self, instance, lambda: self._load_instance_user(instance))
+
+    def _load_instance_user(self, instance):
         try:
-            return InstanceUser.objects.get(user=self, instance=instance)
+            return InstanceUser.objects.select_related('role')\
+                                       .get(user=self, instance=instance)
         except InstanceUser.DoesNotExist:
             return None
         except MultipleObjectsReturned:
@@ -357,6 +372,13 @@ class User(Auditable, AbstractUniqueEmailUser):
             perms = perms.filter(model_name=model_name)
         return perms
 
+    def get_permission_matrix(self, instance, model_name):
+        """
+        The compiled field permissions of the user's role on a model
+        (see PermissionMatrix)
+        """
+        return self.get_role(instance).permission_matrix(model_name)
+
     def get_role(self, instance):
         iuser = self.get_instance_user(instance)
         role = iuser.role if iuser else instance.default_role
@@ -364,7 +386,7 @@ class User(Auditable, AbstractUniqueEmailUser):
 
     def get_reputation(self, instance):
         iuser = self.get_instance_user(instance)
-        reputation = iuser.reputation if iuser else 0
+        reputation = iuser.current_reputation() if iuser else 0
         return reputation
 
     def clean(self):
@@ -447,6 +469,109 @@ class Species(UDFModel, Authorizable, Auditable):
         verbose_name_plural = "Species"
 
 
+def _species_tokens(sdict):
+    # Split names by space so that "el" will match common_name="Delaware Elm"
+    tokens = set()
+    for name in (sdict['common_name'], sdict['genus'],
+                 sdict['species'], sdict['cultivar']):
+        if name:
+            tokens.update(name.split())
+
+    # Names are sometimes in quotes, which should be stripped
+    return {token.strip(string.punctuation) for token in tokens}
+
+
+class SpeciesIndex(object):
+    """
+    The species of an instance prepared for the species typeahead, in
+    common name order, with their display names and name tokens, and a
+    prefix trie of the (lowercased) tokens for server side searches
+    """
+    def __init__(self, instance):
+        species_values = instance.scope_model(Species)\
+                                 .order_by('common_name')\
+                                 .values('common_name', 'genus',
+                                         'species', 'cultivar', 'id')
+        self.species = []
+        # Each trie node maps a character to the next node, and None to
+        # the positions of the species with a token starting there
+        self._trie = {}
+
+        for position, sdict in enumerate(species_values):
+            sci_name = Species.get_scientific_name(sdict['genus'],
+                                                   sdict['species'],
+                                                   sdict['cultivar'])
+            sdict.update({
+                'scientific_name': sci_name,
+                'value': "%s [%s]" % (sdict['common_name'], sci_name),
+                'tokens': _species_tokens(sdict)})
+            self.species.append(sdict)
+
+            for token in sdict['tokens']:
+                node = self._trie
+                for char in token.lower():
+                    node = node.setdefault(char, {})
+                    node.setdefault(None, set()).add(position)
+
+    def _positions_with_prefix(self, prefix):
+        node = self._trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return set()
+        return node.get(None, set())
+
+    def search(self, query, max_items=None):
+        """
+        The species with a token starting with every word of the query
+        (ignoring case), in common name order
+        """
+        words = [word.strip(string.punctuation)
+                 for word in query.lower().split()]
+        words = [word for word in words if word]
+        if not words:
+            return []
+
+        positions = None
+        for word in words:
+            matches = self._positions_with_prefix(word)
+            positions = matches if positions is None else positions & matches
+
+        return [self.species[position]
+                for position in sorted(positions)[:max_items]]
+
+
+class SpeciesIndexCache(object):
+    """
+    Cache the SpeciesIndex of each instance. An index is rebuilt when
+    the species_rev of the instance changes, and all of them are
+    dropped whenever a species is saved or deleted in this process.
+    The species dicts are shared by every request, so they must not be
+    changed.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cache = {}
+
+    def get(self, instance):
+        entry = self.cache.get(instance.pk)
+        if entry is None or entry[0] != instance.species_rev:
+            entry = (instance.species_rev, SpeciesIndex(instance))
+            self.cache[instance.pk] = entry
+        return entry[1]
+
+
+species_index_cache = SpeciesIndexCache()
+
+
+@receiver(post_save, sender=Species)
+@receiver(post_delete, sender=Species)
+def invalidate_species_index_cache(*args, **kwargs):
+    species_index_cache.reset()
+
+
 class InstanceUser(Auditable, models.Model):
     instance = models.ForeignKey(Instance)
     user = models.ForeignKey(User)
@@ -454,19 +579,50 @@ class InstanceUser(Auditable, models.Model):
     reputation = models.IntegerField(default=0)
     admin = models.BooleanField(default=False)
 
+    # The reputation including ledger entries that haven't been rolled
+    # up yet. Reputation can't drop below zero, so this may be a little
+    # higher than the total the entries will roll up to.
+    _LEADERBOARD_REPUTATION_SQL = (
+        'GREATEST(0, treemap_instanceuser.reputation + COALESCE('
+        '(SELECT SUM(l.delta) FROM treemap_reputationledgerentry l '
+        'WHERE l.instance_id = treemap_instanceuser.instance_id '
+        'AND l.user_id = treemap_instanceuser.user_id), 0))')
+
+    def current_reputation(self):
+        """
+        The stored reputation plus any changes in the reputation ledger
+        that haven't been rolled up yet
+        """
+        deltas = ReputationLedgerEntry.objects\
+            .filter(instance_id=self.instance_id, user_id=self.user_id)\
+            .order_by('pk')\
+            .values_list('delta', flat=True)
+
+        return ReputationLedgerEntry.apply_deltas(self.reputation, deltas)
+
+    @classmethod
+    def reputation_leaderboard(clz, instance, limit=10):
+        """
+        The instance users with the highest reputation, each with a
+        'leaderboard_reputation' attribute, using the stored reputations
+        rather than recomputing them from audits
+        """
+        leaders = clz.objects\
+            .filter(instance=instance)\
+            .select_related('user')\
+            .extra(select={'leaderboard_reputation':
+                           clz._LEADERBOARD_REPUTATION_SQL})\
+            .order_by('-leaderboard_reputation', 'user__username')
+
+        return leaders[:limit]
+
     def can_add_photos_to_tree(self):
         # Users can add photos only if they have all
         # WRITE_DIRECTLY or WRITE_WITH_AUDIT permissions
         # on tree photo
         fields = {'tree', 'image', 'thumbnail', 'id'}
 
-        perms = self.user.get_instance_permissions(
-            self.instance, 'TreePhoto')
-
-        fieldperms = {perm.field_name
-                      for perm
-                      in perms
-                      if perm.allows_writes}
+        fieldperms = self.role.permission_matrix('TreePhoto').writable
 
         enabled = self.instance.feature_enabled('tree_image_upload')
         return enabled and fieldperms == fields
@@ -483,6 +639,104 @@ class InstanceUser(Auditable, models.Model):
         return '%s/%s' % (self.user.get_username(), self.instance.name)
 
 
+class InstanceUserCache(object):
+    """
+    Cache the InstanceUser (and role) of each user in each instance,
+    which are looked up several times while handling a request.
+
+    Lookups are cached for the rest of the request between
+    begin_request and end_request (see InstanceUserCacheMiddleware),
+    and across requests for INSTANCE_USER_CACHE_TTL seconds. Both are
+    dropped whenever an InstanceUser or FieldPermission is saved or
+    deleted in this process. Changes made by other processes (or by
+    queryset updates) are seen once the cached lookup expires.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._local = threading.local()
+        self.generation = 0
+        self.lookups = 0
+        self.saved_lookups = 0
+        self.reset()
+
+    def reset(self):
+        self.cache = {}
+
+    def invalidate(self):
+        # Lookups remembered by requests in other threads are
+        # recognized as out of date by their generation
+        self.generation += 1
+        self.reset()
+
+    def begin_request(self):
+        self._local.memo = {}
+        self._local.lookups = 0
+        self._local.saved_lookups = 0
+
+    def end_request(self):
+        """
+        Stop caching lookups for the current request. Returns the
+        number of lookups made during the request and the number of
+        those that were answered from the cache.
+        """
+        stats = (getattr(self._local, 'lookups', 0),
+                 getattr(self._local, 'saved_lookups', 0))
+        self._local.memo = None
+        return stats
+
+    def _count(self, saved):
+        self.lookups += 1
+        self._local.lookups = getattr(self._local, 'lookups', 0) + 1
+        if saved:
+            self.saved_lookups += 1
+            self._local.saved_lookups = \
+                getattr(self._local, 'saved_lookups', 0) + 1
+
+    def get(self, user, instance, load):
+        key = (user.pk, instance.pk)
+        generation = self.generation
+        memo = getattr(self._local, 'memo', None)
+
+        if memo is not None and key in memo:
+            memo_generation, instance_user = memo[key]
+            if memo_generation == generation:
+                self._count(saved=True)
+                return instance_user
+
+        ttl = settings.INSTANCE_USER_CACHE_TTL
+        now = time.time()
+        entry = self.cache.get(key)
+
+        if ttl and entry and entry[0] == generation and entry[1] > now:
+            self._count(saved=True)
+            # Callers may change the instance user they get back, so
+            # each request gets its own copy
+            instance_user = copy.copy(entry[2])
+        else:
+            self._count(saved=False)
+            instance_user = load()
+            if ttl:
+                if len(self.cache) >= self.max_size:
+                    self.reset()
+                self.cache[key] = (generation, now + ttl,
+                                   copy.copy(instance_user))
+
+        if memo is not None:
+            memo[key] = (generation, instance_user)
+
+        return instance_user
+
+instance_user_cache = InstanceUserCache()
+
+
+@receiver(post_save, sender=InstanceUser)
+@receiver(post_delete, sender=InstanceUser)
+@receiver(post_save, sender=FieldPermission)
+@receiver(post_delete, sender=FieldPermission)
+def invalidate_instance_user_cache(*args, **kwargs):
+    instance_user_cache.invalidate()
+
+
 class MapFeature(Convertible, UDFModel, Authorizable, Auditable):
     "Superclass for map feature subclasses like Plot, RainBarrel, etc."
     instance = models.ForeignKey(Instance)
@@ -594,13 +848,10 @@ class Plot(MapFeature):
         Get a list of all tree ids that were ever assigned
         to this plot
         """
-        return Audit.objects.filter(instance=self.instance)\
-                            .filter(model='Tree')\
-                            .filter(field='plot')\
-                            .filter(current_value=self.pk)\
-                            .order_by('-model_id', '-updated')\
-                            .distinct('model_id')\
-                            .values_list('model_id', flat=True)
+        return PlotTreeHistory.objects.filter(instance=self.instance)\
+                                      .filter(plot_id=self.pk)\
+                                      .order_by('-tree_id')\
+                                      .values_list('tree_id', flat=True)
 
     def current_tree(self):
         """
@@ -740,6 +991,107 @@ class Tree(Convertible, UDFModel, Authorizable, Auditable):
         super(Tree, self).delete_with_user(user, *args, **kwargs)
 
 
+class PlotTreeHistory(models.Model):
+    """
+    Every tree that has been assigned to a plot, along with when it was
+    assigned and when it was moved off of the plot or deleted.
+
+    Rows are maintained from the 'plot' audits written for trees (see
+    ``record_audit``) so that a plot's history doesn't need to be
+    recovered from the audit table. Trees and plots may be deleted,
+    so both are stored as plain ids rather than foreign keys.
+
+    Pending plot assignments are recorded as well, matching the set of
+    trees that used to be found by scanning the audit table.
+    """
+    instance = models.ForeignKey(Instance)
+    plot_id = models.IntegerField(db_index=True)
+    tree_id = models.IntegerField(db_index=True)
+    assigned_at = models.DateTimeField()
+    removed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('plot_id', 'tree_id')
+
+    @staticmethod
+    def record_audit(audit):
+        if audit.model != 'Tree':
+            return
+
+        history = PlotTreeHistory.objects.filter(tree_id=audit.model_id)
+
+        assignment_actions = {Audit.Type.Insert, Audit.Type.Update,
+                              Audit.Type.PendingApprove}
+
+        if ((audit.field == 'plot' and audit.current_value is not None
+             and audit.action in assignment_actions)):
+            try:
+                plot_id = int(audit.current_value)
+            except ValueError:
+                return
+
+            is_applied = (not audit.requires_auth or
+                          audit.action == Audit.Type.PendingApprove)
+
+            if is_applied:
+                history.filter(removed_at__isnull=True)\
+                       .exclude(plot_id=plot_id)\
+                       .update(removed_at=audit.created)
+
+            entry, created = PlotTreeHistory.objects.get_or_create(
+                plot_id=plot_id, tree_id=audit.model_id,
+                defaults={'instance_id': audit.instance_id,
+                          'assigned_at': audit.created})
+
+            if not created and is_applied and entry.removed_at is not None:
+                entry.removed_at = None
+                entry.save()
+
+        elif ((audit.action == Audit.Type.Delete or
+               (audit.action == Audit.Type.ReviewReject and
+                audit.field == 'id'))):
+            history.filter(removed_at__isnull=True)\
+                   .update(removed_at=audit.created)
+
+
+@receiver(post_save, sender=Audit)
+def update_plot_tree_history(sender, instance, created, **kwargs):
+    if created:
+        PlotTreeHistory.record_audit(instance)
+
+
+class AuditSnapshot(models.Model):
+    """
+    A checkpoint of the state of every plot and tree in an instance, as
+    rebuilt from the audit log at ``taken_at``.
+
+    Reconstructing an object as of a given time only needs to replay
+    the audits made since the most recent earlier snapshot. See
+    treemap.history
+    """
+    instance = models.ForeignKey(Instance)
+    taken_at = models.DateTimeField(db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return '%s at %s' % (self.instance, self.taken_at)
+
+
+class AuditSnapshotEntry(models.Model):
+    """
+    The state of one object in a snapshot, stored as a dictionary of
+    field name to the string value found in the audit log. Objects that
+    didn't exist when the snapshot was taken have no entry.
+    """
+    snapshot = models.ForeignKey(AuditSnapshot)
+    model = models.CharField(max_length=255)
+    model_id = models.IntegerField()
+    data = JSONField(blank=True)
+
+    class Meta:
+        unique_together = ('snapshot', 'model', 'model_id')
+
+
 class TreePhoto(models.Model, Authorizable, Auditable):
     tree = models.ForeignKey(Tree)
 
@@ -840,6 +1192,15 @@ class ITreeRegion(models.Model):
     objects = models.GeoManager()
 
 
+@receiver(post_save, sender=ITreeRegion)
+@receiver(post_delete, sender=ITreeRegion)
+def update_instances_supporting_ecobenefits(*args, **kwargs):
+    # Regions are rarely changed, and a changed region may no longer
+    # intersect instances it used to, so every instance is checked
+    for instance in Instance.objects.all():
+        instance.update_supports_ecobenefits()
+
+
 class ITreeCodeOverride(models.Model, Auditable):
     instance_species = models.ForeignKey(Species)
     region = models.ForeignKey(ITreeRegion)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Compile the theme SCSS with the colors chosen by an instance.
+
+Compiled CSS is identified by a hash of the SCSS sources and of the
+(normalized) color variables, and is cached in memory and, when
+SCSS_CACHE_ROOT is set, on disk, so each theme is only compiled once
+per deploy. The compile_scss command fills the disk cache for every
+instance ahead of time.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import hashlib
+import os
+import re
+import tempfile
+
+import sass
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+_scss_var_name_re = re.compile('^[_a-zA-Z][-_a-zA-Z0-9]*$')
+_color_re = re.compile(r'^(?:[0-9a-fA-F]{3}|[0-9a-fA-F]{6})$')
+
+# Added to the stylesheet URL (see Instance.scss_query_string) so that
+# browsers fetch the CSS again when the sources change
+SCSS_VERSION_PARAM = 'v'
+
+_sources_hash = None
+
+
+def normalize_scss_variables(variables):
+    """
+    Check that every variable is a color and return them as a sorted
+    list of (name, lowercase color) pairs. Raises ValidationError for
+    anything else, so that libsass doesn't explode.
+    """
+    normalized = []
+    for key, value in variables.items():
+        if _scss_var_name_re.match(key) and _color_re.match(value):
+            normalized.append((key, value.lower()))
+        else:
+            raise ValidationError("Invalid SCSS values %s: %s" % (key, value))
+    return sorted(normalized)
+
+
+def scss_sources_hash():
+    """
+    A hash of every .scss file under SCSS_ROOT. Sources only change
+    with a deploy, so it is worked out once per process (or on every
+    call when DEBUG is on).
+    """
+    global _sources_hash
+
+    if _sources_hash is None or settings.DEBUG:
+        sha = hashlib.sha1()
+        for root, _, files in sorted(os.walk(settings.SCSS_ROOT)):
+            for name in sorted(files):
+                if name.endswith('.scss'):
+                    path = os.path.join(root, name)
+                    sha.update(os.path.relpath(path, settings.SCSS_ROOT)
+                               .encode('utf-8'))
+                    with open(path, 'rb') as f:
+                        sha.update(f.read())
+        _sources_hash = sha.hexdigest()
+
+    return _sources_hash
+
+
+def scss_version():
+    return scss_sources_hash()[:12]
+
+
+def _scss_string(variables):
+    scss = ''.join('$%s: #%s;\n' % (key, value) for key, value in variables)
+    scss += '@import "%s";' % settings.SCSS_ENTRY
+    return scss.encode('utf-8')
+
+
+def css_cache_key(variables):
+    """
+    The key of the CSS compiled from the current sources with the
+    given normalized variables
+    """
+    sha = hashlib.sha1(scss_sources_hash())
+    sha.update(_scss_string(variables))
+    return sha.hexdigest()
+
+
+class CompiledCssCache(object):
+    """
+    Cache compiled CSS by css_cache_key, in memory and in files named
+    after the key in SCSS_CACHE_ROOT (shared by every process)
+    """
+    def __init__(self, max_size=200):
+        self.max_size = max_size
+        self.compilations = 0
+        self.reset()
+
+    def reset(self):
+        self.cache = {}
+
+    def _path(self, key):
+        if settings.SCSS_CACHE_ROOT:
+            return os.path.join(settings.SCSS_CACHE_ROOT, '%s.css' % key)
+        return None
+
+    def _read(self, key):
+        path = self._path(key)
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    return f.read().decode('utf-8')
+            except (IOError, OSError):
+                # The disk cache is only an optimization
+                pass
+        return None
+
+    def _write(self, key, css):
+        path = self._path(key)
+        if not path:
+            return
+        try:
+            if not os.path.isdir(settings.SCSS_CACHE_ROOT):
+                os.makedirs(settings.SCSS_CACHE_ROOT)
+            # Write to a temporary file first so other processes never
+            # read a partly written file
+            fd, tmp_path = tempfile.mkstemp(dir=settings.SCSS_CACHE_ROOT)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(css.encode('utf-8'))
+            # mkstemp creates files only their owner can read, but the
+            # web workers may run as another user than compile_scss
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            # The disk cache is only an optimization
+            pass
+
+    def get(self, variables):
+        """
+        The key and CSS of the theme with the given normalized
+        variables, compiling it if it isn't cached
+        """
+        key = css_cache_key(variables)
+
+        css = self.cache.get(key)
+        if css is None:
+            css = self._read(key)
+            if css is None:
+                self.compilations += 1
+                css = sass.compile(string=_scss_string(variables),
+                                   include_paths=[settings.SCSS_ROOT])
+                if isinstance(css, bytes):
+                    css = css.decode('utf-8')
+                self._write(key, css)
+
+            if len(self.cache) >= self.max_size:
+                self.reset()
+            self.cache[key] = css
+
+        return key, css
+
+
+compiled_css_cache = CompiledCssCache()
+
+
+def get_compiled_css(variables):
+    """
+    The CSS for a dict of SCSS color variables (see compile_scss in
+    treemap.views)
+    """
+    _, css = compiled_css_cache.get(normalize_scss_variables(variables))
+    return css
@@ -21,6 +21,7 @@ from django.contrib.gis.geos import Point, Polygon, MultiPolygon
 from django.contrib.auth.models import AnonymousUser
 
 from treemap.models import User, InstanceUser
+from treemap.audit import sync_field_permissions
 from treemap.util import leaf_subclasses
 
 from djcelery.contrib.test_runner import CeleryTestSuiteRunner
@@ -96,12 +97,7 @@ def make_simple_polygon(n=1):
 
 def _add_permissions(instance, role, permissions):
     if permissions:
-        for perm in permissions:
-            model_name, field_name, permission_level = perm
-            FieldPermission.objects.get_or_create(
-                model_name=model_name, field_name=field_name,
-                permission_level=permission_level, role=role,
-                instance=instance)
+        sync_field_permissions(role, permissions, instance=instance)
 
 
 def make_loaded_role(instance, name, rep_thresh, permissions):
@@ -406,6 +402,7 @@ from middleware import *      # NOQA
 from json_field import *      # NOQA
 from units import *           # NOQA
 from management import *      # NOQA
+from history import *         # NOQA
 from ecobenefits import *   # NOQA
 from ui.basic import *        # NOQA
 from ui.map import *          # NOQA
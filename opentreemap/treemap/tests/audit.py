@@ -5,12 +5,15 @@ from __future__ import division
 
 import psycopg2
 import json
+from datetime import datetime
 
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.test.utils import override_settings
 from django.core.exceptions import (FieldError, ValidationError,
                                     ObjectDoesNotExist)
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 
 from django.db import IntegrityError, connection
 from django.contrib.gis.geos import Point
@@ -21,10 +24,19 @@ from treemap.models import (Tree, Plot, FieldPermission, User, InstanceUser,
                             Instance)
 from treemap.audit import (Audit, Role, UserTrackingException,
                            AuthorizeException, ReputationMetric,
+                           ReputationLedgerEntry,
+                           PendingEditCount,
                            approve_or_reject_audits_and_apply,
                            approve_or_reject_audit_and_apply,
                            approve_or_reject_existing_edit,
-                           get_id_sequence_name)
+                           get_id_sequence_name, archive_audits,
+                           _ModelIdPool,
+                           bulk_approve_or_reject_audits_and_apply,
+                           bulk_approve_or_reject_existing_edits,
+                           revert_user_edits, compact_insert_audits,
+                           compact_audits, CompactedInsert,
+                           permission_matrix_cache, sync_field_permissions)
+from treemap.history import reconstruct_as_of
 from treemap.udf import UserDefinedFieldDefinition
 from treemap.tests import (make_instance, make_user_with_default_role,
                            make_user_and_role, make_commander_user,
@@ -228,6 +240,31 @@ class AuditTest(TestCase):
         self.assertEqual(get_id_sequence_name(Plot),
                          'treemap_mapfeature_id_seq')
 
+    @override_settings(MODEL_ID_RESERVATION_BLOCK_SIZE=3)
+    def test_model_ids_are_reserved_in_blocks(self):
+        pool = _ModelIdPool()
+
+        with self.assertNumQueries(1):
+            ids = [pool.take(Tree) for __ in range(3)]
+
+        self.assertEqual(len(set(ids)), 3)
+
+        with self.assertNumQueries(1):
+            next_id = pool.take(Tree)
+
+        self.assertNotIn(next_id, ids)
+
+    @override_settings(MODEL_ID_RESERVATION_BLOCK_SIZE=3)
+    def test_model_id_pool_is_not_shared_after_fork(self):
+        pool = _ModelIdPool()
+        first_id = pool.take(Tree)
+
+        # Simulate being in a forked child process
+        pool._pid = -1
+
+        with self.assertNumQueries(1):
+            self.assertNotEqual(pool.take(Tree), first_id)
+
 
 class ReviewTest(TestCase):
     def setUp(self):
@@ -508,6 +545,224 @@ class PendingTest(TestCase):
                          Plot.objects.get(pk=self.plot.pk).hash)
 
 
+class BulkModerationTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.commander_user = make_commander_user(self.instance)
+        self.pending_user = make_apprentice_user(self.instance)
+        self.p1 = Point(-7615441.0, 5953519.0)
+
+    def _pending_audits(self):
+        return Audit.objects.filter(requires_auth=True, ref__isnull=True)
+
+    def test_bulk_approve_creates_pending_inserts(self):
+        plot = Plot(geom=self.p1, instance=self.instance, length=5)
+        plot.save_with_user(self.pending_user)
+        tree = Tree(plot=plot, instance=self.instance, diameter=3)
+        tree.save_with_user(self.pending_user)
+
+        n_pending = self._pending_audits().count()
+
+        reviews = bulk_approve_or_reject_audits_and_apply(
+            self._pending_audits(), self.commander_user, True)
+
+        self.assertEqual(len(reviews), n_pending)
+        self.assertEqual(self._pending_audits().count(), 0)
+
+        self.assertEqual(Plot.objects.get(pk=plot.pk).length, 5)
+        tree = Tree.objects.get(pk=tree.pk)
+        self.assertEqual(tree.plot_id, plot.pk)
+        self.assertEqual(tree.diameter, 3)
+
+        for audit in Audit.objects.filter(requires_auth=True):
+            self.assertEqual(audit.ref.action, Audit.Type.PendingApprove)
+            self.assertEqual(audit.ref.user, self.commander_user)
+
+    def test_bulk_approve_applies_net_change(self):
+        plot = Plot(geom=self.p1, instance=self.instance)
+        plot.save_with_user(self.commander_user)
+
+        plot.length = 5
+        plot.save_with_user(self.pending_user)
+        plot = Plot.objects.get(pk=plot.pk)
+        plot.length = 6
+        plot.save_with_user(self.pending_user)
+
+        bulk_approve_or_reject_audits_and_apply(
+            self._pending_audits(), self.commander_user, True)
+
+        self.assertEqual(Plot.objects.get(pk=plot.pk).length, 6)
+
+    def test_rejecting_insert_rejects_related_audits(self):
+        plot = Plot(geom=self.p1, instance=self.instance, length=5)
+        plot.save_with_user(self.pending_user)
+
+        id_audit = self._pending_audits().filter(field='id')
+
+        bulk_approve_or_reject_audits_and_apply(
+            id_audit, self.commander_user, False)
+
+        self.assertEqual(self._pending_audits().count(), 0)
+        self.assertFalse(Plot.objects.filter(pk=plot.pk).exists())
+
+    def test_bulk_reject_existing_edits(self):
+        plot = Plot(geom=self.p1, instance=self.instance, length=5)
+        plot.save_with_user(self.commander_user)
+        plot.length = 6
+        plot.save_with_user(self.commander_user)
+
+        latest = Audit.objects.filter(model='Plot', model_id=plot.pk,
+                                      field='length')\
+                              .order_by('-created')[:1]
+
+        reviews = bulk_approve_or_reject_existing_edits(
+            latest, self.commander_user, False)
+
+        self.assertEqual(len(reviews), 1)
+        self.assertEqual(reviews[0].action, Audit.Type.ReviewReject)
+        self.assertEqual(Plot.objects.get(pk=plot.pk).length, 5)
+
+        id_audit = Audit.objects.filter(model='Plot', model_id=plot.pk,
+                                        field='id')
+
+        bulk_approve_or_reject_existing_edits(
+            id_audit, self.commander_user, False)
+
+        self.assertFalse(Plot.objects.filter(pk=plot.pk).exists())
+
+
+class RevertUserEditsTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.commander_user = make_commander_user(self.instance)
+        self.vandal = make_commander_user(self.instance, username='vandal')
+
+        self.plot = Plot(geom=Point(0, 0), instance=self.instance,
+                         length=5, width=1)
+        self.plot.save_with_user(self.commander_user)
+
+        self.start = timezone.now()
+
+    def revert(self, **kwargs):
+        return revert_user_edits(self.vandal, self.instance, self.start,
+                                 timezone.now(), self.commander_user,
+                                 **kwargs)
+
+    def test_reverts_net_change(self):
+        self.plot.length = 6
+        self.plot.geom = Point(10, 10)
+        self.plot.save_with_user(self.vandal)
+        self.plot.length = 7
+        self.plot.save_with_user(self.vandal)
+
+        progress = []
+        reviews = self.revert(progress=lambda *args: progress.append(args))
+
+        plot = Plot.objects.get(pk=self.plot.pk)
+        self.assertEqual(plot.length, 5)
+        self.assertEqual(plot.geom, Point(0, 0, srid=3857))
+
+        self.assertEqual(len(reviews), 3)
+        self.assertEqual(progress[-1], (3, 3))
+        self.assertFalse(Audit.objects.filter(user=self.vandal,
+                                              ref__isnull=True).exists())
+
+    def test_deletes_created_objects(self):
+        plot = Plot(geom=Point(0, 0), instance=self.instance)
+        plot.save_with_user(self.vandal)
+        tree = Tree(plot=self.plot, instance=self.instance)
+        tree.save_with_user(self.vandal)
+
+        self.revert()
+
+        self.assertFalse(Plot.objects.filter(pk=plot.pk).exists())
+        self.assertFalse(Tree.objects.filter(pk=tree.pk).exists())
+        self.assertTrue(Plot.objects.filter(pk=self.plot.pk).exists())
+
+    def test_later_edits_by_others_are_kept(self):
+        self.plot.length = 6
+        self.plot.width = 2
+        self.plot.save_with_user(self.vandal)
+
+        plot = Plot.objects.get(pk=self.plot.pk)
+        plot.width = 3
+        plot.save_with_user(self.commander_user)
+
+        self.revert()
+
+        plot = Plot.objects.get(pk=self.plot.pk)
+        self.assertEqual(plot.length, 5)
+        self.assertEqual(plot.width, 3)
+
+    def test_rejects_pending_edits(self):
+        apprentice = make_apprentice_user(self.instance)
+        self.vandal = apprentice
+
+        self.plot.length = 6
+        self.plot.save_with_user(apprentice)
+
+        reviews = self.revert()
+
+        self.assertEqual([review.action for review in reviews],
+                         [Audit.Type.PendingReject])
+        self.assertEqual(Plot.objects.get(pk=self.plot.pk).length, 5)
+
+
+class PendingEditCountTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.commander_user = make_commander_user(self.instance)
+        self.pending_user = make_apprentice_user(self.instance)
+        self.p1 = Point(-7615441.0, 5953519.0)
+
+    def _pending_audits(self):
+        return Audit.objects.filter(requires_auth=True, ref__isnull=True)
+
+    def test_counts_follow_pending_audits(self):
+        plot = Plot(geom=self.p1, instance=self.instance)
+        plot.save_with_user(self.commander_user)
+
+        self.assertEqual(
+            PendingEditCount.total_for_instance(self.instance), 0)
+
+        plot.length = 5
+        plot.width = 6
+        plot.save_with_user(self.pending_user)
+
+        entry = PendingEditCount.objects.get(instance=self.instance)
+        self.assertEqual(entry.model, 'Plot')
+        self.assertEqual(entry.model_id, plot.pk)
+        self.assertEqual(entry.pending_count, 2)
+        self.assertEqual(
+            PendingEditCount.total_for_instance(self.instance), 2)
+
+        approve_or_reject_audit_and_apply(
+            self._pending_audits().get(field='length'),
+            self.commander_user, True)
+
+        self.assertEqual(
+            PendingEditCount.objects.get(pk=entry.pk).pending_count, 1)
+
+        bulk_approve_or_reject_audits_and_apply(
+            self._pending_audits(), self.commander_user, False)
+
+        self.assertFalse(
+            PendingEditCount.objects.filter(instance=self.instance).exists())
+
+    def test_pending_audits_for_entries(self):
+        plot = Plot(geom=self.p1, instance=self.instance, length=5)
+        plot.save_with_user(self.pending_user)
+
+        entries = PendingEditCount.objects.filter(instance=self.instance)
+        audits_by_object = PendingEditCount.pending_audits_for_entries(
+            entries)
+
+        self.assertEqual(audits_by_object.keys(), [('Plot', plot.pk)])
+        self.assertEqual(
+            {audit.pk for audit in audits_by_object[('Plot', plot.pk)]},
+            set(self._pending_audits().values_list('pk', flat=True)))
+
+
 class PendingInsertTest(TestCase):
 
     def setUp(self):
@@ -810,6 +1065,8 @@ class ReputationTest(TestCase):
                          self.unprivileged_user.get_reputation(self.instance))
 
     def _test_negative_adjustment(self, initial, adjusted):
+        ReputationLedgerEntry.roll_up()
+
         iuser = self.unprivileged_user.get_instance_user(self.instance)
         iuser.reputation = initial
         iuser.save_base()
@@ -835,6 +1092,11 @@ class ReputationTest(TestCase):
         audit.ref = review_audit
         audit.save()
 
+        self.assertEqual(adjusted,
+                         self.unprivileged_user.get_reputation(self.instance))
+
+        ReputationLedgerEntry.roll_up()
+
         # requery iuser
         iuser = self.unprivileged_user.get_instance_user(self.instance)
         self.assertEqual(adjusted, iuser.reputation)
@@ -844,6 +1106,86 @@ class ReputationTest(TestCase):
         self._test_negative_adjustment(5, 0)
         self._test_negative_adjustment(3, 0)
 
+    def test_adjustments_are_recorded_in_ledger(self):
+        t = Tree(plot=self.plot, instance=self.instance, readonly=True)
+        t.save_with_user(self.privileged_user)
+
+        iuser = self.privileged_user.get_instance_user(self.instance)
+        self.assertEqual(iuser.reputation, 0)
+        self.assertGreater(ReputationLedgerEntry.objects.count(), 0)
+
+        reputation = self.privileged_user.get_reputation(self.instance)
+        self.assertGreater(reputation, 0)
+
+        ReputationLedgerEntry.roll_up(self.instance)
+
+        self.assertEqual(ReputationLedgerEntry.objects.count(), 0)
+        iuser = self.privileged_user.get_instance_user(self.instance)
+        self.assertEqual(iuser.reputation, reputation)
+        self.assertEqual(
+            self.privileged_user.get_reputation(self.instance), reputation)
+
+    def test_roll_up_never_drops_below_zero(self):
+        for delta in [3, -5, 20]:
+            ReputationLedgerEntry.objects.create(
+                instance=self.instance, user=self.unprivileged_user,
+                delta=delta)
+
+        self.assertEqual(
+            self.unprivileged_user.get_reputation(self.instance), 20)
+        ReputationLedgerEntry.roll_up()
+        iuser = self.unprivileged_user.get_instance_user(self.instance)
+        self.assertEqual(iuser.reputation, 20)
+
+    def test_metrics_are_cached(self):
+        audit = Audit(model='Tree', model_id=1,
+                      action=Audit.Type.Insert,
+                      instance=self.instance, field='readonly',
+                      previous_value=None,
+                      current_value=True,
+                      user=self.unprivileged_user)
+
+        ReputationMetric.reputation_change(audit)
+        with self.assertNumQueries(0):
+            self.assertEqual(ReputationMetric.reputation_change(audit), 2)
+
+        rm = ReputationMetric.objects.get(instance=self.instance)
+        rm.direct_write_score = 3
+        rm.save()
+
+        self.assertEqual(ReputationMetric.reputation_change(audit), 3)
+
+    def test_cached_metrics_expire(self):
+        audit = Audit(model='Tree', model_id=1,
+                      action=Audit.Type.Insert,
+                      instance=self.instance, field='readonly',
+                      previous_value=None,
+                      current_value=True,
+                      user=self.unprivileged_user)
+
+        with self.settings(REPUTATION_METRIC_CACHE_TTL=0):
+            self.assertEqual(ReputationMetric.reputation_change(audit), 2)
+
+            # Queryset updates don't send signals, as with changes made
+            # by other processes
+            ReputationMetric.objects.filter(instance=self.instance)\
+                                    .update(direct_write_score=3)
+
+            self.assertEqual(ReputationMetric.reputation_change(audit), 3)
+
+    def test_leaderboard(self):
+        ReputationLedgerEntry.objects.create(
+            instance=self.instance, user=self.unprivileged_user, delta=5)
+        ReputationLedgerEntry.objects.create(
+            instance=self.instance, user=self.privileged_user, delta=2)
+
+        leaders = InstanceUser.reputation_leaderboard(self.instance, 2)
+
+        self.assertEqual([iuser.user for iuser in leaders],
+                         [self.unprivileged_user, self.privileged_user])
+        self.assertEqual([iuser.leaderboard_reputation for iuser in leaders],
+                         [5, 2])
+
 
 class UserRoleFieldPermissionTest(TestCase):
     def setUp(self):
@@ -978,6 +1320,34 @@ class UserRoleFieldPermissionTest(TestCase):
         plot = Plot.mask_queryset(plots, self.observer)[0]
         self.assertEqual(None, plot.width)
 
+    def test_masking_queryset_as_it_is_loaded(self):
+        self.plot.width = 5
+        self.plot.length = 6
+        self.plot.save_base()
+
+        plots = Plot.objects.filter(pk=self.plot.pk)\
+                            .mask_unauthorized_fields(self.observer)
+        plot = plots[0]
+        self.assertEqual(None, plot.width)
+        self.assertEqual(6, plot.length)
+
+        self.assertRaises(AuthorizeException,
+                          plot.save_with_user, self.commander)
+
+    def test_masking_queryset_reads_permissions_once(self):
+        for __ in range(2):
+            Plot(geom=self.p1, instance=self.instance, width=5).save_base()
+        plots = list(Plot.objects.filter(instance=self.instance))
+        self.assertEqual(len(plots), 3)
+
+        permission_matrix_cache.reset()
+
+        # The instance, the observer's role and its permissions
+        with self.assertNumQueries(3):
+            Plot.mask_queryset(plots, self.observer)
+
+        self.assertEqual([plot.width for plot in plots], [None] * 3)
+
     def test_write_fails_if_any_fields_cant_be_written(self):
         """ If a user tries to modify several fields simultaneously,
         only some of which s/he has access to, the write will fail
@@ -1004,6 +1374,67 @@ class UserRoleFieldPermissionTest(TestCase):
                             110)
 
 
+class PermissionMatrixTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.officer = make_officer_user(self.instance)
+        self.observer = make_observer_user(self.instance)
+
+        self.plot = Plot(geom=Point(0, 0), instance=self.instance)
+        self.plot.save_with_user(self.officer)
+
+    def test_matrix_sets(self):
+        perms = self.officer.get_permission_matrix(self.instance, 'Plot')
+
+        self.assertIn('length', perms.readable)
+        self.assertIn('length', perms.writable)
+        self.assertIn('length', perms.direct)
+        self.assertNotIn('width', perms.writable)
+        self.assertEqual(perms.permission_level('length'),
+                         FieldPermission.WRITE_DIRECTLY)
+        self.assertEqual(perms.permission_level('not a field'),
+                         FieldPermission.NONE)
+
+        perms = self.observer.get_permission_matrix(self.instance, 'Plot')
+        self.assertIn('length', perms.readable)
+        self.assertEqual(perms.writable, frozenset())
+
+    def test_matrix_is_cached(self):
+        permission_matrix_cache.reset()
+        self.plot.field_is_visible(self.officer, 'length')
+
+        # Only the role of the user is looked up
+        with self.assertNumQueries(1):
+            self.assertTrue(self.plot.field_is_visible(self.officer,
+                                                       'length'))
+
+    def test_permission_changes_invalidate_matrix(self):
+        self.assertFalse(self.plot.field_is_editable(self.observer,
+                                                     'length'))
+
+        role = self.observer.get_role(self.instance)
+        FieldPermission.objects.filter(role=role, model_name='Plot',
+                                       field_name='length')\
+                               .update(permission_level=
+                                       FieldPermission.WRITE_DIRECTLY)
+
+        self.assertTrue(self.plot.field_is_editable(self.observer,
+                                                    'length'))
+
+    def test_saving_stale_role_keeps_revision(self):
+        role = self.observer.get_role(self.instance)
+        self.plot.field_is_editable(self.observer, 'length')
+
+        FieldPermission.objects.filter(role=role, model_name='Plot',
+                                       field_name='length')\
+                               .update(permission_level=
+                                       FieldPermission.WRITE_DIRECTLY)
+        role.save()
+
+        self.assertTrue(self.plot.field_is_editable(self.observer,
+                                                    'length'))
+
+
 class FieldPermMgmtTest(TestCase):
     def setUp(self):
         self.instance = make_instance()
@@ -1031,6 +1462,54 @@ class FieldPermMgmtTest(TestCase):
     def test_invalid_field_name_unit(self):
         self.assertInvalidFPRaises(model_name='Tree', field_name='model_name')
 
+    def test_sync_creates_and_updates_permissions(self):
+        created, n_updated = sync_field_permissions(
+            self.new_role, [('Plot', 'length', FieldPermission.READ_ONLY),
+                            ('Plot', 'width', FieldPermission.READ_ONLY)])
+        self.assertEqual(len(created), 2)
+        self.assertEqual(n_updated, 0)
+
+        # A single query to find the existing permissions, one insert
+        # and one update per permission level
+        with self.assertNumQueries(3):
+            created, n_updated = sync_field_permissions(
+                self.new_role,
+                [('Plot', 'length', FieldPermission.WRITE_DIRECTLY),
+                 ('Plot', 'width', FieldPermission.READ_ONLY),
+                 ('Tree', 'diameter', FieldPermission.WRITE_DIRECTLY)])
+
+        self.assertEqual([(perm.model_name, perm.field_name)
+                          for perm in created], [('Tree', 'diameter')])
+        self.assertEqual(n_updated, 1)
+
+        perms = self.new_role.permission_matrix('Plot')
+        self.assertEqual(perms.direct, frozenset(['length']))
+        self.assertEqual(perms.readable, frozenset(['length', 'width']))
+        self.assertEqual(self.new_role.fieldpermission_set.count(), 3)
+
+    def test_sync_ignores_permissions_of_other_instances(self):
+        other_instance = make_instance()
+        FieldPermission.objects.create(
+            model_name='Plot', field_name='length',
+            permission_level=FieldPermission.READ_ONLY,
+            role=self.new_role, instance=other_instance)
+
+        created, n_updated = sync_field_permissions(
+            self.new_role,
+            [('Plot', 'length', FieldPermission.WRITE_DIRECTLY)],
+            instance=self.instance)
+
+        self.assertEqual(len(created), 1)
+        self.assertEqual(n_updated, 0)
+        other_perm = FieldPermission.objects.get(instance=other_instance)
+        self.assertEqual(other_perm.permission_level,
+                         FieldPermission.READ_ONLY)
+
+    def test_sync_validates_new_permissions(self):
+        self.assertRaises(ValidationError, sync_field_permissions,
+                          self.new_role,
+                          [('Tree', 'model_name', FieldPermission.READ_ONLY)])
+
 
 class AuthorizableManagerTest(TestCase):
 
@@ -1112,3 +1591,139 @@ class AuditDetailTagTest(TestCase):
         audit.model_id = -1000
 
         self.assertIsNone(audit_detail_link(audit))
+
+
+class AuditArchiveTest(TestCase):
+    def setUp(self):
+        self.before_long_ago = datetime(1999, 1, 1, tzinfo=timezone.utc)
+        self.long_ago = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        self.cutoff = datetime(2001, 1, 1, tzinfo=timezone.utc)
+
+        self.instance = make_instance()
+        self.commander = make_commander_user(self.instance)
+        self.pending_user = make_apprentice_user(self.instance)
+
+        self.plot = Plot(geom=Point(0, 0), instance=self.instance)
+        self.plot.save_with_user(self.commander)
+
+        self.plot.length = 10
+        self.plot.save_with_user(self.pending_user)
+
+        # Push every audit into the past so they are all candidates
+        Audit.objects.all().update(created=self.long_ago)
+
+    def _hot_audit_count(self):
+        cursor = connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM ONLY treemap_audit '
+                       "WHERE model = 'Plot' AND model_id = %s",
+                       [self.plot.pk])
+        return cursor.fetchone()[0]
+
+    def test_archived_audits_are_still_visible(self):
+        n_audits = self.plot.audits().count()
+
+        archive_audits(self.instance, self.cutoff)
+
+        self.assertEqual(self.plot.audits().count(), n_audits)
+
+    def test_only_pending_audits_stay_behind(self):
+        n_pending = self.plot.get_active_pending_audits().count()
+        self.assertEqual(n_pending, 1)
+        n_audits = Audit.objects.filter(instance=self.instance).count()
+
+        n_archived = archive_audits(self.instance, self.cutoff)
+
+        self.assertEqual(n_archived, n_audits - n_pending)
+        self.assertEqual(self._hot_audit_count(), n_pending)
+
+    def test_recent_audits_are_not_archived(self):
+        n_archived = archive_audits(self.instance, self.before_long_ago)
+
+        self.assertEqual(n_archived, 0)
+        self.assertEqual(self._hot_audit_count(),
+                         self.plot.audits().count())
+
+    def test_audits_referenced_by_hot_audits_are_not_archived(self):
+        pending = self.plot.get_active_pending_audits()[0]
+        review = approve_or_reject_audit_and_apply(pending, self.commander,
+                                                   True)
+        Audit.objects.filter(pk=review.pk)\
+                     .update(created=self.long_ago)
+        Audit.objects.filter(pk=pending.pk)\
+                     .update(created=timezone.now())
+
+        archive_audits(self.instance, self.cutoff)
+
+        self.assertTrue(Audit.objects.filter(pk=review.pk).exists())
+        self.assertEqual(self._hot_audit_count(), 2)
+
+
+class CompactAuditsTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.commander = make_commander_user(self.instance)
+
+    def _insert_audits(self, obj):
+        return Audit.objects.filter(model=obj._model_name, model_id=obj.pk,
+                                    action=Audit.Type.Insert)
+
+    def _expanded_fields(self, obj):
+        audits = self._insert_audits(obj).order_by('pk')
+        return {audit.field: audit.current_value
+                for audit in Audit.expand_compacted(audits)}
+
+    def test_compact_mode_writes_one_insert_audit(self):
+        with compact_insert_audits():
+            plot = Plot(geom=Point(0, 0), instance=self.instance, length=5)
+            plot.save_with_user(self.commander)
+
+        self.assertEqual([audit.field for audit in self._insert_audits(plot)],
+                         ['id'])
+
+        fields = self._expanded_fields(plot)
+        self.assertEqual(fields['id'], str(plot.pk))
+        self.assertEqual(float(fields['length']), 5)
+
+        plot_then = reconstruct_as_of(Plot, self.instance, plot.pk,
+                                      timezone.now())
+        self.assertEqual(plot_then.length, 5)
+
+    def test_tree_plot_is_not_compacted(self):
+        plot = Plot(geom=Point(0, 0), instance=self.instance)
+        plot.save_with_user(self.commander)
+
+        with compact_insert_audits():
+            tree = Tree(plot=plot, instance=self.instance, diameter=3)
+            tree.save_with_user(self.commander)
+
+        self.assertEqual(
+            sorted(audit.field for audit in self._insert_audits(tree)),
+            ['id', 'plot'])
+
+    def test_compact_existing_audits(self):
+        plot = Plot(geom=Point(0, 0), instance=self.instance, length=5)
+        plot.save_with_user(self.commander)
+        fields = self._expanded_fields(plot)
+        n_audits = self._insert_audits(plot).count()
+
+        removed = compact_audits(self.instance)
+
+        self.assertEqual(removed, n_audits - 1)
+        self.assertEqual(self._insert_audits(plot).count(), 1)
+        self.assertEqual(self._expanded_fields(plot), fields)
+
+        self.assertEqual(compact_audits(self.instance), 0)
+
+    def test_reviewed_audits_are_not_compacted(self):
+        plot = Plot(geom=Point(0, 0), instance=self.instance, length=5)
+        plot.save_with_user(self.commander)
+
+        length_audit = self._insert_audits(plot).get(field='length')
+        approve_or_reject_existing_edit(length_audit, self.commander, True)
+
+        compact_audits(self.instance)
+
+        self.assertTrue(Audit.objects.filter(pk=length_audit.pk).exists())
+        compacted = CompactedInsert.objects.get(
+            audit_id=self._insert_audits(plot).get(field='id').pk)
+        self.assertNotIn('length', [field for field, __ in compacted.values])
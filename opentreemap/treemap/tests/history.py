@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import json
+
+from django.test import TestCase
+from django.contrib.gis.geos import Point
+from django.utils import timezone
+
+from treemap.models import Plot, Tree, AuditSnapshot
+from treemap.audit import Audit, approve_or_reject_audits_and_apply
+from treemap.udf import UserDefinedFieldDefinition
+from treemap.history import (reconstruct_as_of, take_snapshot,
+                             iter_snapshot_objects)
+from treemap.tests import (make_instance, make_commander_user,
+                           make_apprentice_user, add_field_permissions)
+
+
+class ReconstructionTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+
+        UserDefinedFieldDefinition.objects.create(
+            instance=self.instance,
+            model_type='Plot',
+            datatype=json.dumps({'type': 'string'}),
+            iscollection=False,
+            name='Test string')
+
+        self.commander_user = make_commander_user(self.instance)
+        add_field_permissions(self.instance, self.commander_user,
+                              'Plot', ['udf:Test string'])
+        self.pending_user = make_apprentice_user(self.instance)
+
+        self.before_create = timezone.now()
+
+        self.plot = Plot(geom=Point(0, 0), instance=self.instance, length=5)
+        self.plot.udfs['Test string'] = 'first'
+        self.plot.save_with_user(self.commander_user)
+        self.after_create = timezone.now()
+
+        self.plot.length = 6
+        self.plot.udfs['Test string'] = 'second'
+        self.plot.save_with_user(self.commander_user)
+        self.after_update = timezone.now()
+
+    def assert_plot_as_of(self, when, length, udf_value):
+        plot = reconstruct_as_of(Plot, self.instance, self.plot.pk, when)
+        self.assertEqual(plot.pk, self.plot.pk)
+        self.assertEqual(plot.length, length)
+        self.assertEqual(plot.udfs['Test string'], udf_value)
+
+    def test_reconstructs_past_state(self):
+        self.assertIsNone(reconstruct_as_of(
+            Plot, self.instance, self.plot.pk, self.before_create))
+
+        self.assert_plot_as_of(self.after_create, 5, 'first')
+        self.assert_plot_as_of(self.after_update, 6, 'second')
+
+    def test_reconstructs_from_snapshot(self):
+        take_snapshot(self.instance, self.after_create)
+
+        self.plot.length = 7
+        self.plot.save_with_user(self.commander_user)
+
+        self.assert_plot_as_of(self.after_create, 5, 'first')
+        self.assert_plot_as_of(self.after_update, 6, 'second')
+        self.assert_plot_as_of(timezone.now(), 7, 'second')
+
+    def test_deleted_objects(self):
+        tree = Tree(plot=self.plot, instance=self.instance, diameter=3)
+        tree.save_with_user(self.commander_user)
+        after_tree = timezone.now()
+
+        tree.delete_with_user(self.commander_user)
+
+        old_tree = reconstruct_as_of(Tree, self.instance, tree.pk, after_tree)
+        self.assertEqual(old_tree.diameter, 3)
+        self.assertEqual(old_tree.plot_id, self.plot.pk)
+
+        self.assertIsNone(reconstruct_as_of(
+            Tree, self.instance, tree.pk, timezone.now()))
+
+    def test_pending_edits_apply_once_approved(self):
+        self.plot.length = 8
+        self.plot.save_with_user(self.pending_user)
+        after_pending = timezone.now()
+
+        pending = Audit.objects.filter(requires_auth=True, ref__isnull=True)
+        approve_or_reject_audits_and_apply(pending, self.commander_user, True)
+
+        self.assert_plot_as_of(after_pending, 6, 'second')
+        self.assert_plot_as_of(timezone.now(), 8, 'second')
+
+    def test_snapshot_contains_existing_objects(self):
+        plot2 = Plot(geom=Point(0, 0), instance=self.instance)
+        plot2.save_with_user(self.commander_user)
+
+        # Build each snapshot on the previous one, one object at a time
+        take_snapshot(self.instance, self.after_create, batch_size=1)
+        snapshot = take_snapshot(self.instance, self.after_update,
+                                 batch_size=1)
+
+        plots = list(iter_snapshot_objects(snapshot, Plot))
+        self.assertEqual([plot.pk for plot in plots], [self.plot.pk])
+        self.assertEqual(plots[0].length, 6)
+
+        snapshot = take_snapshot(self.instance, timezone.now(),
+                                 batch_size=1)
+        self.assertEqual(
+            sorted(plot.pk for plot in iter_snapshot_objects(snapshot, Plot)),
+            sorted([self.plot.pk, plot2.pk]))
+        self.assertEqual(AuditSnapshot.objects.count(), 3)
@@ -5,8 +5,10 @@ from __future__ import division
 
 from django.test import TestCase
 
+from treemap.models import Instance
 from treemap.tests import make_instance
-from treemap.json_field import get_attr_from_json_field, set_attr_on_json_field
+from treemap.json_field import (get_attr_from_json_field,
+                                set_attr_on_json_field, get_raw_json)
 
 
 class JsonFieldTests(TestCase):
@@ -51,3 +53,21 @@ class JsonFieldTests(TestCase):
                           self.instance, "config.a.no", "1")
         self.assertRaises(KeyError, set_attr_on_json_field,
                           self.instance, "config.b.c.no", "1")
+
+    def test_get_does_not_parse(self):
+        self._assert_get(self.instance, "config.b.c", "y")
+        self.assertIsNotNone(get_raw_json(self.instance, "config"))
+
+        self.instance.config = '{"b":{"c":"z"}}'
+        self._assert_get(self.instance, "config.b.c", "z")
+
+        # Once read, the field may have been changed in place
+        self.instance.config["b.c"] = "w"
+        self.assertIsNone(get_raw_json(self.instance, "config"))
+        self._assert_get(self.instance, "config.b.c", "w")
+
+    def test_save_without_reading(self):
+        self.instance.save()
+
+        reloaded = Instance.objects.get(pk=self.instance.pk)
+        self.assertEqual(reloaded.config, {"a": "x", "b": {"c": "y"}})
@@ -7,8 +7,10 @@ from StringIO import StringIO
 
 from django.core.management import call_command
 from django.test import TestCase
+from django.contrib.gis.geos import Point
 
-from treemap.models import Instance, Plot, Tree, Species
+from treemap.models import (Instance, Plot, Tree, Species, PlotTreeHistory,
+                            AuditSnapshot, Audit)
 from treemap.tests import (make_instance, make_user, make_commander_user)
 
 
@@ -76,3 +78,101 @@ class RandomTreesManagementTest(TestCase):
         self.run_command(n=1, delete=True, ptree=100, pspecies=100)
         tree = self.instance.scope_model(Tree).get()
         self.assertIsNotNone(tree.species)
+
+
+class BackfillTreeHistoryManagementTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_commander_user(instance=self.instance)
+
+        self.plot1 = Plot(instance=self.instance, geom=Point(0, 0))
+        self.plot1.save_with_user(self.user)
+        self.plot2 = Plot(instance=self.instance, geom=Point(0, 0))
+        self.plot2.save_with_user(self.user)
+
+        self.tree = Tree(plot=self.plot1, instance=self.instance)
+        self.tree.save_with_user(self.user)
+        self.tree.plot = self.plot2
+        self.tree.save_with_user(self.user)
+
+    def test_backfill_matches_maintained_history(self):
+        def history():
+            return list(PlotTreeHistory.objects
+                        .order_by('plot_id')
+                        .values_list('plot_id', 'tree_id', 'assigned_at',
+                                     'removed_at'))
+
+        expected = history()
+        PlotTreeHistory.objects.all().delete()
+
+        call_command('backfill_tree_history', stdout=StringIO(),
+                     instance=self.instance.pk)
+
+        self.assertEqual(history(), expected)
+        self.assertEqual(list(self.plot1.get_tree_history()),
+                         [self.tree.pk])
+
+
+class SnapshotInstanceManagementTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_commander_user(instance=self.instance)
+
+        self.plot = Plot(instance=self.instance, geom=Point(0, 0))
+        self.plot.save_with_user(self.user)
+
+    def test_snapshot_of_current_state(self):
+        call_command('snapshot_instance', stdout=StringIO(),
+                     instance=self.instance.pk)
+
+        snapshot = AuditSnapshot.objects.get(instance=self.instance)
+        entries = snapshot.auditsnapshotentry_set.all()
+        self.assertEqual([(entry.model, entry.model_id) for entry in entries],
+                         [('Plot', self.plot.pk)])
+
+    def test_snapshot_before_any_edits(self):
+        call_command('snapshot_instance', stdout=StringIO(),
+                     instance=self.instance.pk, date='2000-01-01')
+
+        snapshot = AuditSnapshot.objects.get(instance=self.instance)
+        self.assertEqual(snapshot.auditsnapshotentry_set.count(), 0)
+
+
+class RevertUserEditsManagementTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_commander_user(instance=self.instance)
+        self.vandal = make_commander_user(instance=self.instance,
+                                          username='vandal')
+
+        self.plot = Plot(instance=self.instance, geom=Point(0, 0), length=5)
+        self.plot.save_with_user(self.user)
+
+    def test_reverts_users_edits(self):
+        self.plot.length = 6
+        self.plot.save_with_user(self.vandal)
+        vandal_plot = Plot(instance=self.instance, geom=Point(0, 0))
+        vandal_plot.save_with_user(self.vandal)
+
+        call_command('revert_user_edits', stdout=StringIO(),
+                     instance=self.instance.pk, user='vandal',
+                     reviewer=self.user.username)
+
+        self.assertEqual(Plot.objects.get(pk=self.plot.pk).length, 5)
+        self.assertFalse(Plot.objects.filter(pk=vandal_plot.pk).exists())
+
+
+class CompactAuditsManagementTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_commander_user(instance=self.instance)
+
+        self.plot = Plot(instance=self.instance, geom=Point(0, 0), length=5)
+        self.plot.save_with_user(self.user)
+
+    def test_compacts_insert_audits(self):
+        call_command('compact_audits', stdout=StringIO(),
+                     instance=self.instance.pk)
+
+        audits = Audit.objects.filter(model='Plot', model_id=self.plot.pk)
+        self.assertEqual([audit.field for audit in audits], ['id'])
@@ -3,13 +3,17 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import json
+
 from django.test import TestCase
 from django.test.utils import override_settings
-from django.contrib.gis.geos import Point, MultiPolygon
+from django.contrib.gis.geos import Point, Polygon, MultiPolygon
 from django.core.exceptions import ValidationError
 
 from treemap.models import (Tree, Instance, Plot, FieldPermission, Species,
-                            ITreeRegion, MapFeature)
+                            ITreeRegion, MapFeature, PlotTreeHistory,
+                            instance_user_cache)
+from treemap.instance import instance_cache
 from treemap.audit import Audit, ReputationMetric
 from treemap.tests import (make_instance, make_commander_user,
                            make_user_with_default_role, make_user,
@@ -268,6 +272,31 @@ class PlotTest(TestCase):
 
         self.assertEqual(list(p.get_tree_history()), [t3.pk, t2.pk, tpk])
 
+    def test_moving_tree_closes_plot_history(self):
+        p1 = Plot(instance=self.instance, geom=self.p)
+        p1.save_with_user(self.user)
+        p2 = Plot(instance=self.instance, geom=self.p)
+        p2.save_with_user(self.user)
+
+        t = Tree(plot=p1, instance=self.instance)
+        t.save_with_user(self.user)
+
+        t.plot = p2
+        t.save_with_user(self.user)
+
+        self.assertEqual(list(p1.get_tree_history()), [t.pk])
+        self.assertEqual(list(p2.get_tree_history()), [t.pk])
+
+        old_entry = PlotTreeHistory.objects.get(plot_id=p1.pk, tree_id=t.pk)
+        new_entry = PlotTreeHistory.objects.get(plot_id=p2.pk, tree_id=t.pk)
+        self.assertIsNotNone(old_entry.removed_at)
+        self.assertIsNone(new_entry.removed_at)
+
+        t.delete_with_user(self.user)
+
+        new_entry = PlotTreeHistory.objects.get(plot_id=p2.pk, tree_id=t.pk)
+        self.assertIsNotNone(new_entry.removed_at)
+
     def test_street_address_only(self):
         self.plot.address_street = '1234 market st'
         self.assertEqual('1234 market st', self.plot.address_full)
@@ -318,6 +347,61 @@ class InstanceUserModelTest(TestCase):
         self.assertEqual(user.get_instance_user(self.instance), None)
 
 
+class InstanceUserCacheTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_user_with_default_role(self.instance, 'user')
+        self.commander = make_commander_user(self.instance)
+
+        instance_user_cache.begin_request()
+
+    def tearDown(self):
+        instance_user_cache.end_request()
+
+    def test_lookups_are_cached_within_request(self):
+        iuser = self.user.get_instance_user(self.instance)
+
+        with self.assertNumQueries(0):
+            self.assertIs(self.user.get_instance_user(self.instance), iuser)
+            self.user.get_role(self.instance)
+
+        self.assertEqual(instance_user_cache.end_request(), (3, 2))
+
+    def test_missing_instance_user_is_cached(self):
+        user = make_user(username='joe', password='pw')
+        user.get_instance_user(self.instance)
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(user.get_instance_user(self.instance))
+
+    def test_saving_instance_user_invalidates_cache(self):
+        iuser = self.user.get_instance_user(self.instance)
+        iuser.role = make_commander_role(self.instance)
+        iuser.save_with_user(self.commander)
+
+        self.assertEqual(self.user.get_role(self.instance).pk,
+                         iuser.role.pk)
+
+    def test_no_caching_outside_requests(self):
+        instance_user_cache.end_request()
+        self.user.get_instance_user(self.instance)
+
+        with self.assertNumQueries(1):
+            self.user.get_instance_user(self.instance)
+
+    @override_settings(INSTANCE_USER_CACHE_TTL=60)
+    def test_lookups_are_cached_across_requests(self):
+        iuser = self.user.get_instance_user(self.instance)
+        instance_user_cache.end_request()
+        instance_user_cache.begin_request()
+
+        with self.assertNumQueries(0):
+            cached = self.user.get_instance_user(self.instance)
+
+        self.assertIsNot(cached, iuser)
+        self.assertEqual(cached.pk, iuser.pk)
+
+
 class InstanceTest(TestCase):
 
     def test_force_url_name_downcase(self):
@@ -404,3 +488,65 @@ class InstanceTest(TestCase):
         ITreeRegion.objects.create(geometry=MultiPolygon((p1.buffer(10))))
 
         self.assertEqual(instance.has_itree_region(), True)
+
+    def test_bounds_geometry_is_stored(self):
+        instance = make_instance(point=Point(0, 0))
+        self.assertEqual(instance.bounds_center, instance.bounds.centroid)
+        self.assertEqual(json.loads(instance.extent_as_json),
+                         {'xmin': 0, 'ymin': 0, 'xmax': 20, 'ymax': 10})
+
+        instance.bounds = MultiPolygon(
+            Polygon.from_bbox((90, 90, 110, 110)))
+        instance.save()
+
+        reloaded = Instance.objects.get(pk=instance.pk)
+        self.assertEqual(reloaded.center, reloaded.bounds.centroid)
+        self.assertTrue(reloaded.center_lat_lng.equals_exact(
+            reloaded.bounds.centroid.transform(4326, clone=True), 1e-9))
+        self.assertEqual(json.loads(reloaded.extent_as_json),
+                         {'xmin': 90, 'ymin': 90, 'xmax': 110, 'ymax': 110})
+
+    def test_supports_ecobenefits_is_stored(self):
+        instance = make_instance()
+        self.assertFalse(instance.supports_ecobenefits)
+
+        instance.itree_region_default = 'PiedmtCLT'
+        instance.save()
+        self.assertTrue(
+            Instance.objects.get(pk=instance.pk).supports_ecobenefits)
+
+    def test_supports_ecobenefits_follows_regions(self):
+        p1 = Point(0, 0)
+        instance = make_instance(point=p1)
+
+        region = ITreeRegion.objects.create(
+            code='NoEastXXX', geometry=MultiPolygon((p1.buffer(10))))
+        self.assertTrue(
+            Instance.objects.get(pk=instance.pk).supports_ecobenefits)
+
+        region.delete()
+        self.assertFalse(
+            Instance.objects.get(pk=instance.pk).supports_ecobenefits)
+
+    def test_instance_cache(self):
+        instance = make_instance(url_name='cached')
+        instance_cache.reset()
+
+        cached = instance_cache.get('Cached')
+        self.assertEqual(cached.pk, instance.pk)
+
+        # Changes to the returned copies are not seen by later lookups
+        cached.config['foo'] = 'bar'
+        saved_lookups = instance_cache.saved_lookups
+        self.assertNotIn('foo', instance_cache.get('cached').config)
+        self.assertEqual(instance_cache.saved_lookups, saved_lookups + 1)
+
+        # Changes made by other processes are seen through config_rev
+        instance.is_public = not instance.is_public
+        Instance.objects.filter(pk=instance.pk)\
+                        .update(is_public=instance.is_public)
+        self.assertEqual(instance_cache.get('cached').is_public,
+                         instance.is_public)
+
+        with self.assertRaises(Instance.DoesNotExist):
+            instance_cache.get('nothere')
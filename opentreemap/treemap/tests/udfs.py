@@ -12,18 +12,22 @@ from django.test import TestCase
 from django.db import connection
 from django.db.models import Q
 from django.core.exceptions import ValidationError
+from django.test.utils import override_settings
+from django.utils import timezone
 
 from django.contrib.gis.geos import Point, Polygon
 
 from treemap.tests import (make_instance, make_commander_user,
-                           make_officer_user,
+                           make_officer_user, make_apprentice_user,
                            add_field_permissions)
 
-from treemap.udf import UserDefinedFieldDefinition
-from treemap.models import Plot
-from treemap.audit import (AuthorizeException, FieldPermission,
+from treemap.udf import (UserDefinedFieldDefinition, UDFDCache,
+                         TypedUDFValue, rebuild_typed_udf_values)
+from treemap.models import Plot, Instance
+from treemap.audit import (Audit, AuthorizeException, FieldPermission,
                            approve_or_reject_audit_and_apply,
-                           approve_or_reject_audits_and_apply)
+                           approve_or_reject_audits_and_apply,
+                           revert_user_edits)
 
 
 class ScalarUDFFilterTest(TestCase):
@@ -760,6 +764,265 @@ class ScalarUDFTest(TestCase):
         self.assertRaises(KeyError,
                           lambda: self.plot.udfs['RaNdoName'])
 
+    def test_values_are_cleaned_once(self):
+        self.plot.udfs['Test user'] = self.commander_user
+        self.plot.save_with_user(self.commander_user)
+
+        plot = Plot.objects.get(pk=self.plot.pk)
+        plot.udfs['Test string']  # Load the definitions
+
+        with self.assertNumQueries(1):
+            self.assertEqual(plot.udfs['Test user'], self.commander_user)
+            self.assertEqual(plot.udfs['Test user'], self.commander_user)
+
+    def test_setting_value_replaces_cleaned_value(self):
+        self.plot.udfs['Test int'] = 4
+        self.assertEqual(self.plot.udfs['Test int'], 4)
+
+        self.plot.udfs['Test int'] = 5
+        self.assertEqual(self.plot.udfs['Test int'], 5)
+
+    def test_resolve_user_udfs(self):
+        self.plot.udfs['Test user'] = self.commander_user
+        self.plot.save_with_user(self.commander_user)
+
+        plot2 = Plot(geom=self.p, instance=self.instance)
+        plot2.udfs['Test user'] = self.commander_user
+        plot2.save_with_user(self.commander_user)
+
+        plots = list(Plot.objects.filter(instance=self.instance)
+                                 .resolve_user_udfs())
+
+        with self.assertNumQueries(0):
+            self.assertEqual([plot.udfs['Test user'] for plot in plots],
+                             [self.commander_user] * 2)
+
+
+@override_settings(UDF_TYPED_STORAGE=True)
+class TypedUDFStorageTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.commander_user = make_commander_user(self.instance)
+        add_field_permissions(self.instance, self.commander_user,
+                              'Plot', ['udf:Test int', 'udf:Test date',
+                                       'udf:Test string'])
+
+        for name, datatype in (('Test int', 'int'),
+                               ('Test date', 'date'),
+                               ('Test string', 'string')):
+            UserDefinedFieldDefinition.objects.create(
+                instance=self.instance,
+                model_type='Plot',
+                datatype=json.dumps({'type': datatype}),
+                iscollection=False,
+                name=name)
+
+        self.p = Point(-8515941.0, 4953519.0)
+        self.plots = {}
+        for n in (9, 10, 100):
+            plot = Plot(geom=self.p, instance=self.instance)
+            plot.udfs['Test int'] = n
+            plot.udfs['Test date'] = datetime(2000 + n, 1, 1)
+            plot.udfs['Test string'] = str(n)
+            plot.save_with_user(self.commander_user)
+            self.plots[n] = plot
+
+    def _ns(self, plots):
+        return [plot.udfs['Test int'] for plot in plots]
+
+    def test_values_are_mirrored_on_save(self):
+        self.assertEqual(TypedUDFValue.objects.count(), 6)
+
+        plot = self.plots[9]
+        plot.udfs['Test int'] = 11
+        plot.save_with_user(self.commander_user)
+
+        value = TypedUDFValue.objects.get(field_definition__name='Test int',
+                                          model_id=plot.pk)
+        self.assertEqual(value.value_number, 11)
+
+        plot.delete_with_user(self.commander_user)
+        self.assertFalse(
+            TypedUDFValue.objects.filter(model_id=plot.pk).exists())
+
+    def test_numbers_sort_by_value(self):
+        plots = Plot.objects.order_by('MapFeature.udf:Test int')
+        self.assertEqual(self._ns(plots), [9, 10, 100])
+
+        plots = Plot.objects.order_by('-MapFeature.udf:Test int')
+        self.assertEqual(self._ns(plots), [100, 10, 9])
+
+        # Untyped UDFs still sort by their strings
+        plots = Plot.objects.order_by('MapFeature.udf:Test string')
+        self.assertEqual(self._ns(plots), [10, 100, 9])
+
+    def test_range_filters(self):
+        plots = Plot.objects.filter(**{'udf:Test int__gte': 10})
+        self.assertEqual(sorted(self._ns(plots)), [10, 100])
+
+        plots = Plot.objects.filter(**{'udf:Test int__gt': 9,
+                                       'udf:Test int__lt': 100})
+        self.assertEqual(self._ns(plots), [10])
+
+        plots = Plot.objects.filter(
+            **{'udf:Test date__lte': datetime(2010, 1, 1)})
+        self.assertEqual(sorted(self._ns(plots)), [9, 10])
+
+    def test_approved_pending_values_are_mirrored(self):
+        apprentice = make_apprentice_user(self.instance)
+        FieldPermission.objects.create(
+            model_name='Plot', field_name='udf:Test int',
+            permission_level=FieldPermission.WRITE_WITH_AUDIT,
+            role=apprentice.get_role(self.instance), instance=self.instance)
+
+        plot = Plot.objects.get(pk=self.plots[9].pk)
+        plot.udfs['Test int'] = 50
+        plot.save_with_user(apprentice)
+
+        plots = Plot.objects.filter(**{'udf:Test int__gte': 50})
+        self.assertEqual(self._ns(plots), [100])
+
+        pending = plot.audits().get(requires_auth=True)
+        approve_or_reject_audit_and_apply(pending, self.commander_user, True)
+
+        plots = Plot.objects.filter(**{'udf:Test int__gte': 50})
+        self.assertEqual(sorted(self._ns(plots)), [50, 100])
+
+    def test_reverted_values_are_mirrored(self):
+        start = timezone.now()
+        plot = self.plots[9]
+        plot.udfs['Test int'] = 50
+        plot.save_with_user(self.commander_user)
+
+        revert_user_edits(self.commander_user, self.instance, start,
+                          timezone.now(), self.commander_user)
+
+        plots = Plot.objects.filter(**{'udf:Test int__lt': 10})
+        self.assertEqual(self._ns(plots), [9])
+
+    def test_rebuild(self):
+        TypedUDFValue.objects.all().delete()
+
+        self.assertEqual(rebuild_typed_udf_values(self.instance, Plot), 3)
+        self.assertEqual(TypedUDFValue.objects.count(), 6)
+
+
+class UDFAggregateTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.commander_user = make_commander_user(self.instance)
+        add_field_permissions(self.instance, self.commander_user, 'Plot',
+                              ['udf:Test int', 'udf:Test choice',
+                               'udf:Stewardship'])
+
+        UserDefinedFieldDefinition.objects.create(
+            instance=self.instance,
+            model_type='Plot',
+            datatype=json.dumps({'type': 'int'}),
+            iscollection=False,
+            name='Test int')
+
+        UserDefinedFieldDefinition.objects.create(
+            instance=self.instance,
+            model_type='Plot',
+            datatype=json.dumps({'type': 'choice',
+                                 'choices': ['a', 'b']}),
+            iscollection=False,
+            name='Test choice')
+
+        UserDefinedFieldDefinition.objects.create(
+            instance=self.instance,
+            model_type='Plot',
+            datatype=json.dumps([{'type': 'string', 'name': 'action'},
+                                 {'type': 'date', 'name': 'date'}]),
+            iscollection=True,
+            name='Stewardship')
+
+        self.p = Point(-8515941.0, 4953519.0)
+
+        for n, choice, months in ((2, 'a', [1, 1, 2]),
+                                  (4, 'a', [2]),
+                                  (9, 'b', [])):
+            plot = Plot(geom=self.p, instance=self.instance, width=n)
+            plot.udfs['Test int'] = n
+            plot.udfs['Test choice'] = choice
+            plot.udfs['Stewardship'] = [
+                {'action': 'water', 'date': '2013-%02d-01 00:00:00' % month}
+                for month in months]
+            plot.save_with_user(self.commander_user)
+
+        Plot(geom=self.p, instance=self.instance)\
+            .save_with_user(self.commander_user)
+
+        self.plots = Plot.objects.filter(instance=self.instance)
+
+    def test_scalar_aggregates(self):
+        def aggregate(function):
+            return self.plots.udf_aggregate('Test int', function,
+                                            instance=self.instance)
+
+        self.assertEqual(aggregate('sum'), [{'group': None, 'value': 15}])
+        self.assertEqual(aggregate('avg'), [{'group': None, 'value': 5}])
+        self.assertEqual(aggregate('max'), [{'group': None, 'value': 9}])
+        self.assertEqual(aggregate('count'), [{'group': None, 'value': 3}])
+
+    def test_grouped_aggregate(self):
+        results = self.plots.udf_aggregate('Test int', 'avg',
+                                           group_by='width',
+                                           instance=self.instance)
+        self.assertEqual([(r['group'], r['value']) for r in results],
+                         [(2, 2), (4, 4), (9, 9), (None, None)])
+
+    def test_histograms(self):
+        results = self.plots.udf_aggregate('Test choice', 'histogram',
+                                           instance=self.instance)
+        self.assertEqual([(r['value'], r['count']) for r in results],
+                         [('a', 2), ('b', 1)])
+
+        results = self.plots.udf_aggregate('Test int', 'histogram',
+                                           bucket_size=5,
+                                           instance=self.instance)
+        self.assertEqual([(r['value'], r['count']) for r in results],
+                         [(0, 2), (5, 1)])
+
+    def test_invalid_aggregates(self):
+        self.assertRaises(ValidationError, self.plots.udf_aggregate,
+                          'Test choice', 'avg')
+        self.assertRaises(ValidationError, self.plots.udf_aggregate,
+                          'Test int', 'median')
+        self.assertRaises(ValidationError, self.plots.udf_aggregate,
+                          'Missing', 'count')
+        self.assertRaises(ValidationError, self.plots.udf_aggregate,
+                          'Test int', 'count', group_by='udf:Test choice')
+
+    def test_other_instances_fields_are_ignored(self):
+        other_instance = make_instance()
+        UserDefinedFieldDefinition.objects.create(
+            instance=other_instance,
+            model_type='Plot',
+            datatype=json.dumps({'type': 'string'}),
+            iscollection=False,
+            name='Test int')
+
+        self.assertRaises(ValidationError, self.plots.udf_aggregate,
+                          'Test int', 'sum')
+        self.assertEqual(
+            self.plots.udf_aggregate('Test int', 'sum',
+                                     instance=self.instance),
+            [{'group': None, 'value': 15}])
+
+    def test_collection_counts(self):
+        self.assertEqual(
+            self.plots.udf_collection_counts('Stewardship',
+                                             instance=self.instance),
+            [{'group': None, 'count': 4}])
+
+        results = self.plots.udf_collection_counts(
+            'Stewardship', key='date', date_trunc='month',
+            instance=self.instance)
+        self.assertEqual([(r['group'].month, r['count']) for r in results],
+                         [(1, 2), (2, 2)])
+
 
 class CollectionUDFTest(TestCase):
 
@@ -830,6 +1093,48 @@ class CollectionUDFTest(TestCase):
         self.assertEqual(newest_stews[0]['action'], 'prune')
         self.assertEqual(newest_stews[0]['height'], 12)
 
+    def test_saves_changes_in_bulk(self):
+        self.plot.udfs['Stewardship'] = [{'action': 'water',
+                                          'height': 42},
+                                         {'action': 'prune',
+                                          'height': 12}]
+        self.plot.save_with_user(self.commander_user)
+
+        plot = Plot.objects.get(pk=self.plot.pk)
+        water, prune = plot.udfs['Stewardship']
+        audits = Audit.objects.filter(model__startswith='udf:')
+        old_audit_ids = set(audits.values_list('pk', flat=True))
+
+        # Saving unchanged values doesn't write or audit anything
+        plot.udfs['Stewardship'] = [water, prune]
+        plot.save_with_user(self.commander_user)
+        self.assertEqual(audits.count(), len(old_audit_ids))
+
+        # Update one value, remove the other and add a new one
+        water['height'] = 43
+        mulch = {'action': 'mulch', 'height': 1}
+        plot.udfs['Stewardship'] = [water, mulch]
+        plot.save_with_user(self.commander_user)
+
+        self.assertIn('id', mulch)
+
+        stews = Plot.objects.get(pk=self.plot.pk).udfs['Stewardship']
+        self.assertEqual(
+            sorted((stew['id'], stew['action'], stew['height'])
+                   for stew in stews),
+            sorted([(water['id'], 'water', 43),
+                    (mulch['id'], 'mulch', 1)]))
+
+        new_audits = audits.exclude(pk__in=old_audit_ids)
+        self.assertEqual(
+            {(audit.model_id, audit.field, audit.action)
+             for audit in new_audits
+             if audit.action == Audit.Type.Update},
+            {(water['id'], 'udf:height', Audit.Type.Update)})
+        self.assertIn((mulch['id'], 'id'),
+                      {(audit.model_id, audit.field)
+                       for audit in new_audits})
+
     # Collection fields used the same validation logic as scalar
     # udfs the point of this section is prove that the code is hooked
     # up, not to exhaustively test datatype validation
@@ -853,3 +1158,100 @@ class CollectionUDFTest(TestCase):
             ValidationError,
             self.plot.save_with_user,
             self.commander_user)
+
+    def test_prefetch_collection_udfs(self):
+        self.plot.udfs['Stewardship'] = [{'action': 'water',
+                                          'height': 42}]
+        self.plot.save_with_user(self.commander_user)
+
+        plot2 = Plot(geom=self.p, instance=self.instance)
+        plot2.udfs['Stewardship'] = [{'action': 'prune',
+                                      'height': 12},
+                                     {'action': 'mulch',
+                                      'height': 3}]
+        plot2.save_with_user(self.commander_user)
+
+        plot3 = Plot(geom=self.p, instance=self.instance)
+        plot3.save_with_user(self.commander_user)
+
+        plots = list(Plot.objects.filter(instance=self.instance)
+                                 .prefetch_collection_udfs()
+                                 .order_by('pk'))
+
+        with self.assertNumQueries(0):
+            stews = [plot.udfs['Stewardship'] for plot in plots]
+
+        self.assertEqual(
+            [[(stew['action'], stew['height']) for stew in plot_stews]
+             for plot_stews in stews],
+            [[('water', 42)], [('prune', 12), ('mulch', 3)], []])
+
+        # The prefetched values are the same ones loaded lazily
+        for plot, plot_stews in zip(plots, stews):
+            reloaded_plot = Plot.objects.get(pk=plot.pk)
+            self.assertEqual(reloaded_plot.udfs['Stewardship'], plot_stews)
+
+
+class UDFDCacheTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.cache = UDFDCache(max_size=2)
+
+    def _make_udf(self, name):
+        return UserDefinedFieldDefinition.objects.create(
+            instance=self.instance,
+            model_type='Plot',
+            datatype=json.dumps({'type': 'string'}),
+            iscollection=False,
+            name=name)
+
+    def test_least_recently_used_definitions_are_dropped(self):
+        self.cache.get_defs_for_model('Plot', self.instance.pk)
+        self.cache.get_defs_for_model('Tree', self.instance.pk)
+        self.cache.get_defs_for_model('Plot', self.instance.pk)
+        self.cache.get_defs_for_model('Species', self.instance.pk)
+
+        self.assertEqual(self.cache.cache.keys(),
+                         [('Plot', self.instance.pk),
+                          ('Species', self.instance.pk)])
+
+    def test_udf_changes_bump_instance_revision(self):
+        rev = Instance.objects.get(pk=self.instance.pk).udf_rev
+
+        udf = self._make_udf('Test string')
+        self.assertEqual(Instance.objects.get(pk=self.instance.pk).udf_rev,
+                         rev + 1)
+
+        udf.delete()
+        self.assertEqual(Instance.objects.get(pk=self.instance.pk).udf_rev,
+                         rev + 2)
+
+    def test_validation_drops_definitions_changed_elsewhere(self):
+        self.cache.validate_instance(
+            Instance.objects.get(pk=self.instance.pk))
+        self.assertEqual(
+            self.cache.get_defs_for_model('Plot', self.instance.pk), [])
+
+        # As if another process had added the field
+        self._make_udf('Test string')
+        self.assertEqual(
+            len(self.cache.get_defs_for_model('Plot', self.instance.pk)), 0)
+
+        self.cache.validate_instance(
+            Instance.objects.get(pk=self.instance.pk))
+        self.assertEqual(
+            len(self.cache.get_defs_for_model('Plot', self.instance.pk)), 1)
+
+    def test_newer_revisions_drop_definitions(self):
+        rev = Instance.objects.get(pk=self.instance.pk).udf_rev
+        self.assertEqual(
+            self.cache.get_defs_for_model('Plot', self.instance.pk, rev), [])
+
+        self._make_udf('Test string')
+        # A stale revision can't tell that the definitions changed
+        self.assertEqual(
+            self.cache.get_defs_for_model('Plot', self.instance.pk, rev), [])
+
+        new_rev = Instance.objects.get(pk=self.instance.pk).udf_rev
+        self.assertEqual(len(self.cache.get_defs_for_model(
+            'Plot', self.instance.pk, new_rev)), 1)
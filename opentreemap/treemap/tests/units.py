@@ -8,8 +8,10 @@ from django.test.utils import override_settings
 from django.contrib.gis.geos import Point
 
 from treemap.units import (is_convertible, is_formattable, get_display_value,
-                           is_convertible_or_formattable, get_storage_value)
-from treemap.models import Plot, Tree
+                           is_convertible_or_formattable, get_storage_value,
+                           get_display_values, get_converter,
+                           unit_converter_cache)
+from treemap.models import Plot, Tree, Instance
 from treemap.json_field import set_attr_on_json_field
 from treemap.tests import make_instance, make_commander_user
 
@@ -78,6 +80,33 @@ class UnitConverterTest(TestCase):
         self.assertAlmostEqual(1, get_storage_value(self.instance, 'test',
                                                     'unit_only', 12))
 
+    def test_get_display_values(self):
+        set_attr_on_json_field(
+            self.instance, 'config.value_display.test.both.units', 'in')
+        self.assertEqual(
+            get_display_values(self.instance, 'test', 'both', [1, None, 2]),
+            [(12, '12.000'), (None, None), (24, '24.000')])
+
+    def test_converter_follows_config(self):
+        converter = get_converter(self.instance)
+        self.assertIs(converter, get_converter(make_instance()))
+        self.assertEqual(converter.units('test', 'both'), 'ft')
+
+        set_attr_on_json_field(
+            self.instance, 'config.value_display.test.both.units', 'in')
+        self.assertEqual(get_converter(self.instance).units('test', 'both'),
+                         'in')
+
+    def test_unread_configs_are_cached_by_revision(self):
+        instance = Instance.objects.get(pk=self.instance.pk)
+        converter = get_converter(instance)
+
+        key = (instance.pk, instance.config_rev)
+        self.assertIs(unit_converter_cache.instance_cache[key][2],
+                      converter)
+        self.assertIs(get_converter(Instance.objects.get(pk=instance.pk)),
+                      converter)
+
 
 INTEGRATION_TEST_DISPLAY_DEFAULTS = {
     'plot': {
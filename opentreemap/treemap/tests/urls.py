@@ -181,9 +181,21 @@ class TreemapUrlTests(UrlTestCase):
         self.assert_template(
             self.prefix + 'edits/', 'treemap/edits.html')
 
+    def test_pending_edits(self):
+        make_commander_user(self.instance)
+        self.client.login(username='commander', password='password')
+        self.assert_200(self.prefix + 'pending-edits/')
+
+    def test_pending_edits_requires_login(self):
+        self.assert_401(self.prefix + 'pending-edits/')
+
     def test_species_list(self):
         self.assert_200(self.prefix + 'species/')
 
+    def test_udf_aggregate_unknown_udf(self):
+        self.assert_status_code(
+            self.prefix + 'udfs/aggregate/?udf=Missing', 400)
+
     def test_tree_list(self):
         self.assert_template(self.prefix + 'map/', 'treemap/map.html')
 
@@ -29,15 +29,18 @@ from treemap.audit import (Role, Audit, approve_or_reject_audit_and_apply,
 from treemap.models import (Instance, Species, User, Plot, Tree, TreePhoto,
                             InstanceUser, BenefitCurrencyConversion,
                             StaticPage, ITreeRegion)
-from treemap.views import (species_list, boundary_to_geojson, plot_detail,
+from treemap.views import (species_list, species_search,
+                           boundary_to_geojson, plot_detail,
                            boundary_autocomplete, edits, user_audits,
                            search_tree_benefits, user, instance_user_view,
                            update_plot_and_tree, update_user, add_tree_photo,
                            root_settings_js_view, instance_settings_js_view,
-                           compile_scss, approve_or_reject_photo,
+                           compile_scss, scss_view, approve_or_reject_photo,
                            upload_user_photo, static_page,
                            delete_plot, delete_tree)
 
+from treemap.scss import compiled_css_cache
+from treemap.exceptions import HttpBadRequestException
 from treemap.tests import (ViewTestCase, make_instance, make_officer_user,
                            make_commander_user, make_apprentice_user,
                            make_simple_boundary, make_request, make_user,
@@ -1401,6 +1404,38 @@ class SpeciesViewTests(ViewTestCase):
             species_list(make_request({'max_items': 3}), self.instance),
             self.species_json[:3])
 
+    def test_invalid_max_items(self):
+        for max_items in ['0', '-1', 'many']:
+            self.assertRaises(HttpBadRequestException, species_list,
+                              make_request({'max_items': max_items}),
+                              self.instance)
+
+    def test_search_species(self):
+        def search(params):
+            return [species['common_name'] for species
+                    in species_search(make_request(params), self.instance)]
+
+        self.assertEqual(search({'q': 'cher'}),
+                         ['asian cherry', 'cherrytree'])
+        self.assertEqual(search({'q': 'ASIAN cherrit'}), ['cherrytree'])
+        self.assertEqual(search({'q': 'devil'}), ["apple 'Red Devil'"])
+        self.assertEqual(search({'q': 'cher', 'max_items': 1}),
+                         ['asian cherry'])
+        self.assertEqual(search({'q': 'maple'}), [])
+        self.assertEqual(search({}), [])
+
+    def test_species_index_follows_changes(self):
+        species_list(make_request(), self.instance)
+
+        species = Species(common_name='maple', genus='acer', otm_code='M',
+                          instance=self.instance)
+        species.save_with_user(self.commander)
+
+        self.assertEqual(
+            [s['id'] for s in species_search(make_request({'q': 'acer'}),
+                                             self.instance)],
+            [species.pk])
+
 
 class SearchTreeBenefitsTests(ViewTestCase):
 
@@ -1713,6 +1748,44 @@ class ScssCompilationTests(ViewTestCase):
         with self.assertRaises(ValidationError):
             compile_scss(request)
 
+    def test_compiled_css_is_cached(self):
+        compiled_css_cache.reset()
+        compilations = compiled_css_cache.compilations
+
+        css1 = compile_scss(self.factory.get("", {"primary-color": "FFF",
+                                                  "secondary-color": "000"}))
+        css2 = compile_scss(self.factory.get("", {"secondary-color": "000",
+                                                  "primary-color": "fff",
+                                                  "v": "1"}))
+
+        self.assertEqual(css1, css2)
+        self.assertEqual(compiled_css_cache.compilations, compilations + 1)
+
+    def test_compiled_css_is_shared_on_disk(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(SCSS_CACHE_ROOT=cache_dir):
+                request = self.factory.get("", {"primary-color": "123456"})
+                css = compile_scss(request)
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+                compiled_css_cache.reset()
+                compilations = compiled_css_cache.compilations
+                self.assertEqual(compile_scss(request), css)
+                self.assertEqual(compiled_css_cache.compilations,
+                                 compilations)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_scss_view_sends_etag(self):
+        response = scss_view(self.factory.get("", {"primary-color": "fff"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age', response['Cache-Control'])
+
+        request = self.factory.get("", {"primary-color": "fff"},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(scss_view(request).status_code, 304)
+
 
 class DeleteViewTests(ViewTestCase):
     def setUp(self):
@@ -5,16 +5,24 @@ from __future__ import division
 
 import json
 import re
+from decimal import Decimal
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from itertools import islice
 
+from django.conf import settings
 from django.core.exceptions import ValidationError, FieldError
 from django.utils.translation import ugettext_lazy as trans
 from django.contrib.gis.db import models
+from django.db import transaction, connection, connections
 from django.db.models import Q
 from django.db.models.base import ModelBase
+from django.db.models.query import ITER_CHUNK_SIZE
 from django.db.models.sql.constants import ORDER_PATTERN
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 
 from django.contrib.gis.db.models.sql.where import GeoWhereNode
 from django.contrib.gis.db.models.sql.query import GeoQuery
@@ -24,8 +32,9 @@ from djorm_hstore.models import HStoreManager, HStoreQueryset
 
 from treemap.instance import Instance
 from treemap.audit import (UserTrackable, Audit, UserTrackingException,
-                           _reserve_model_id, FieldPermission,
-                           AuthorizeException)
+                           _reserve_model_id, _reserve_model_ids,
+                           FieldPermission, AuthorizeException,
+                           bulk_create_audits)
 from treemap.util import safe_get_model_class
 
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
@@ -125,20 +134,15 @@ class UserDefinedCollectionValue(UserTrackable, models.Model):
         else:
             audit_type = Audit.Type.Update
 
-        field_perm = None
         model = self.field_definition.model_type
         field = 'udf:%s' % self.field_definition.name
-        perms = user.get_instance_permissions(self.field_definition.instance,
-                                              model_name=model)
-        for perm in perms:
-            if perm.field_name == field and perm.allows_writes:
-                field_perm = perm
-                break
-
-        if field_perm is None:
+        perms = user.get_permission_matrix(self.field_definition.instance,
+                                           model)
+
+        if field not in perms.writable:
             raise AuthorizeException('')
 
-        if field_perm.permission_level == FieldPermission.WRITE_WITH_AUDIT:
+        if field not in perms.direct:
             model_id = _reserve_model_id(UserDefinedCollectionValue)
             pending = True
             for field, (oldval, _) in updated_fields.iteritems():
@@ -165,6 +169,140 @@ class UserDefinedCollectionValue(UserTrackable, models.Model):
                 requires_auth=pending)
 
 
+def _collection_data_string(value):
+    """
+    The string a collection sub-field value is stored as
+    """
+    if value is None:
+        return None
+    elif hasattr(value, 'pk'):
+        return unicode(value.pk)
+    else:
+        return unicode(value)
+
+
+def _update_collection_values(values):
+    """
+    Save the data of stored collection values with a single UPDATE
+    """
+    if not values:
+        return
+
+    field = UserDefinedCollectionValue._meta.get_field('data')
+    sql = ('UPDATE %s t SET %s = v.data FROM (VALUES %s) AS v (id, data) '
+           'WHERE t.id = v.id'
+           % (UserDefinedCollectionValue._meta.db_table, field.column,
+              ', '.join(['(%s, CAST(%s AS hstore))'] * len(values))))
+
+    params = []
+    for value in values:
+        params += [value.pk, field.get_db_prep_value(value.data, connection)]
+
+    connection.cursor().execute(sql, params)
+
+
+def save_collection_values(obj, field_definition, entries, user):
+    """
+    Make the stored values of a collection udf on 'obj' match 'entries'
+    (a list of dicts, which have an 'id' if they were already stored)
+    with a fixed number of queries:
+
+    - one to load the stored values to diff the entries against
+    - one to delete the values that were removed
+    - one to update the changed values
+    - one to insert the new values
+    - one to write the audits of the changes
+
+    Entries whose data is unchanged are neither written nor audited.
+    If the user's edits to the udf must be approved, only the audits
+    are written (removed values are still deleted).
+    """
+    perms = user.get_permission_matrix(obj.instance,
+                                       field_definition.model_type)
+    field = field_definition.canonical_name
+
+    if field not in perms.writable:
+        raise AuthorizeException('')
+
+    pending = field not in perms.direct
+
+    stored = {value.pk: value for value in
+              field_definition.userdefinedcollectionvalue_set
+                              .filter(model_id=obj.pk)}
+
+    unchanged_ids = set()
+    changes = []
+
+    for entry in entries:
+        data = {key: _collection_data_string(value)
+                for key, value in entry.iteritems() if key != 'id'}
+
+        if 'id' in entry:
+            try:
+                value = stored[int(entry['id'])]
+            except (KeyError, TypeError, ValueError):
+                raise UserDefinedCollectionValue.DoesNotExist(
+                    'No %s value with id %s' % (field, entry['id']))
+
+            action = Audit.Type.Update
+        else:
+            value = UserDefinedCollectionValue(
+                field_definition=field_definition, model_id=obj.pk)
+            action = Audit.Type.Insert
+
+        value.data = data
+        updated_fields = value._updated_fields()
+
+        if updated_fields or action == Audit.Type.Insert:
+            changes.append((entry, value, action, updated_fields))
+        else:
+            unchanged_ids.add(value.pk)
+
+    inserts = [changed for _, changed, change_action, _ in changes
+               if change_action == Audit.Type.Insert]
+    updates = [changed for _, changed, change_action, _ in changes
+               if change_action == Audit.Type.Update]
+
+    new_ids = _reserve_model_ids(UserDefinedCollectionValue, len(inserts))
+    for value, new_id in zip(inserts, new_ids):
+        value.pk = new_id
+
+    deleted_ids = set(stored) - unchanged_ids - \
+        {changed.pk for changed in updates}
+
+    if deleted_ids:
+        UserDefinedCollectionValue.objects\
+                                  .filter(pk__in=deleted_ids)\
+                                  .delete()
+
+    if not pending and changes:
+        _update_collection_values(updates)
+        UserDefinedCollectionValue.objects.bulk_create(inserts)
+
+        for entry, value, _, _ in changes:
+            value.populate_previous_state()
+            entry['id'] = value.pk
+
+    audits = []
+    for _, value, action, updated_fields in changes:
+        if action == Audit.Type.Insert:
+            updated_fields['id'] = [None, value.pk]
+
+        for field_name, (old_val, new_val) in updated_fields.iteritems():
+            audits.append(Audit(
+                current_value=new_val,
+                previous_value=old_val,
+                model='udf:%s' % field_definition.pk,
+                model_id=value.pk,
+                field=field_name,
+                instance_id=field_definition.instance_id,
+                user=user,
+                action=action,
+                requires_auth=pending))
+
+    bulk_create_audits(audits)
+
+
 class UserDefinedFieldDefinition(models.Model):
     """
     These models represent user defined fields that are attached to
@@ -443,6 +581,297 @@ class UserDefinedFieldDefinition(models.Model):
         return 'udf:%s' % self.name
 
 
+# The scalar UDF datatypes mirrored into TypedUDFValue when
+# settings.UDF_TYPED_STORAGE is on, and the column storing their values
+TYPED_UDF_COLUMNS = {
+    'float': 'value_number',
+    'int': 'value_number',
+    'date': 'value_date',
+    'choice': 'value_text',
+}
+
+
+class TypedUDFValue(models.Model):
+    """
+    A copy of the value of a numeric, date or choice scalar UDF in a
+    typed and indexed column, so sorting and range filters on the UDF
+    compare values instead of strings and don't have to cast the
+    hstore value of every row.
+
+    The 'udfs' column stays the source of truth. These rows are only
+    written while settings.UDF_TYPED_STORAGE is on, so after turning
+    it on run the sync_typed_udfs command.
+    """
+    field_definition = models.ForeignKey(UserDefinedFieldDefinition)
+    model_id = models.IntegerField()
+
+    value_number = models.FloatField(null=True, blank=True)
+    value_date = models.DateTimeField(null=True, blank=True)
+    value_text = models.TextField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('field_definition', 'model_id')
+
+
+def _typed_udf_column(field_definition):
+    if field_definition.iscollection:
+        return None
+
+    return TYPED_UDF_COLUMNS.get(field_definition.datatype_dict['type'])
+
+
+def _typed_value(column, value):
+    """
+    The value to store in 'column', or None if 'value' (a cleaned UDF
+    value) doesn't belong there
+    """
+    if column == 'value_number':
+        if isinstance(value, (int, long, float)):
+            return value
+    elif column == 'value_date':
+        if isinstance(value, datetime):
+            # Naive dates are stored and compared as UTC so they come
+            # back unchanged whatever the time zone
+            if timezone.is_naive(value):
+                value = timezone.make_aware(value, timezone.utc)
+            return value
+    elif isinstance(value, basestring) and value:
+        return value
+
+    return None
+
+
+def sync_typed_udf_values(objs):
+    """
+    Replace the TypedUDFValue rows of UDF model objects (all of the same
+    model) with their current UDF values
+    """
+    field_definition_ids = set()
+    model_ids = set()
+    rows = []
+
+    for obj in objs:
+        model_ids.add(obj.pk)
+
+        for udf in obj.get_user_defined_fields():
+            column = _typed_udf_column(udf)
+            if column is None:
+                continue
+
+            field_definition_ids.add(udf.pk)
+            value = _typed_value(column, obj.udfs[udf.name])
+
+            if value is not None:
+                rows.append(TypedUDFValue(field_definition=udf,
+                                          model_id=obj.pk,
+                                          **{column: value}))
+
+    if field_definition_ids:
+        TypedUDFValue.objects\
+                     .filter(field_definition__in=field_definition_ids,
+                             model_id__in=model_ids)\
+                     .delete()
+        TypedUDFValue.objects.bulk_create(rows)
+
+
+@transaction.commit_on_success
+def rebuild_typed_udf_values(instance, model_class, batch_size=1000):
+    """
+    Rebuild the TypedUDFValue rows of every 'model_class' object in the
+    instance, 'batch_size' objects at a time. Returns the number of
+    objects synced.
+    """
+    TypedUDFValue.objects.filter(field_definition__instance=instance,
+                                 field_definition__model_type=(
+                                     model_class.__name__))\
+                         .delete()
+
+    objs = model_class.objects.filter(instance=instance).order_by('pk')
+    n = 0
+    last_pk = None
+
+    while True:
+        batch = objs if last_pk is None else objs.filter(pk__gt=last_pk)
+        batch = list(batch[:batch_size])
+
+        if not batch:
+            return n
+
+        sync_typed_udf_values(batch)
+        n += len(batch)
+        last_pk = batch[-1].pk
+
+
+def _udf_model_types(model_class):
+    """
+    The names of 'model_class' and its subclasses, which are the model
+    types of the UDFs whose values are stored in its table
+    """
+    names = [model_class.__name__]
+    for subclass in model_class.__subclasses__():
+        names += _udf_model_types(subclass)
+    return names
+
+
+def _collection_datatypes(field_definition):
+    """
+    Map each sub-field name of a collection UDF to its datatype dict
+    """
+    return {datatype_dict['name']: datatype_dict
+            for datatype_dict in field_definition.datatype_dict}
+
+
+def _load_users(values):
+    """
+    Look up the users referenced by the raw values of user udfs with
+    a single query, as {value: User}. Values that aren't the id of
+    a user are left out.
+    """
+    from treemap.models import User  # Circular ref issue
+
+    pks = {}
+    for value in values:
+        try:
+            pks[value] = int(value)
+        except (TypeError, ValueError):
+            pass
+
+    if not pks:
+        return {}
+
+    users = User.objects.in_bulk(set(pks.values()))
+
+    return {value: users[pk] for value, pk in pks.iteritems()
+            if pk in users}
+
+
+def _group_collection_values(values, udfs_by_id):
+    """
+    Clean a sequence of UserDefinedCollectionValues and group them as
+    {(model type, model_id): {udf name: [cleaned data, ...]}}
+
+    'udfs_by_id' maps the field definition ids of the values to their
+    definitions, so the datatypes of each definition are only parsed
+    once no matter how many values there are.
+    """
+    values = list(values)
+    datatypes_by_id = {}
+    user_values = set()
+
+    for value in values:
+        field_definition = udfs_by_id[value.field_definition_id]
+
+        if field_definition.pk not in datatypes_by_id:
+            datatypes_by_id[field_definition.pk] = \
+                _collection_datatypes(field_definition)
+        datatypes = datatypes_by_id[field_definition.pk]
+
+        for subfield_name, sub_value in value.data.iteritems():
+            datatype = datatypes.get(subfield_name)
+            if datatype and datatype['type'] == 'user':
+                user_values.add(sub_value)
+
+    users = _load_users(user_values)
+    grouped = {}
+
+    for value in values:
+        field_definition = udfs_by_id[value.field_definition_id]
+        datatypes = datatypes_by_id[field_definition.pk]
+
+        cleaned_data = {}
+        for subfield_name in value.data:
+            sub_value = value.data.get(subfield_name, None)
+            if datatypes[subfield_name]['type'] == 'user':
+                sub_value = users.get(sub_value, sub_value)
+            try:
+                sub_value = field_definition.clean_value(
+                    sub_value, datatypes[subfield_name])
+            except ValidationError:
+                # If there was an error coming from the database
+                # just continue with whatever the value was.
+                pass
+
+            cleaned_data[subfield_name] = sub_value
+
+        cleaned_data['id'] = value.pk
+
+        key = (field_definition.model_type, value.model_id)
+        collection_fields = grouped.setdefault(key, {})
+        collection_fields.setdefault(field_definition.name, [])\
+                         .append(cleaned_data)
+
+    return grouped
+
+
+def resolve_user_udfs(objs):
+    """
+    Look up the users referenced by the scalar user udfs of several UDF
+    model objects with a single query and cache them on each object's
+    UDFDictionary, instead of one query per object and udf.
+    Returns the objects.
+    """
+    objs = list(objs)
+    user_udf_names = {}
+    references = []
+
+    for obj in objs:
+        key = (obj._model_name, obj.instance_id)
+        if key not in user_udf_names:
+            user_udf_names[key] = [
+                udf.name for udf in obj.get_user_defined_fields()
+                if (not udf.iscollection and
+                    udf.datatype_dict['type'] == 'user')]
+
+        for name in user_udf_names[key]:
+            value = obj.udfs.raw_value(name)
+            if value is not None:
+                references.append((obj, name, value))
+
+    users = _load_users(value for _, _, value in references)
+
+    for obj, name, value in references:
+        if value in users:
+            obj.udfs.set_cleaned_value(name, users[value])
+
+    return objs
+
+
+def prefetch_collection_udfs(objs):
+    """
+    Load the collection UDF values of several UDF model objects with a
+    single query and attach them to each object's UDFDictionary, so
+    reading them doesn't cost a query per object.
+
+    Objects without a primary key or whose collection values were
+    already loaded are left alone. Returns the objects.
+    """
+    objs = list(objs)
+    to_load = [obj for obj in objs
+               if obj.pk is not None and
+               not obj.udfs.collection_data_loaded]
+
+    udfs_by_id = {}
+    for obj in to_load:
+        for udf in obj.get_user_defined_fields():
+            if udf.iscollection:
+                udfs_by_id[udf.pk] = udf
+
+    if udfs_by_id:
+        values = UserDefinedCollectionValue.objects\
+            .filter(field_definition__in=udfs_by_id.keys(),
+                    model_id__in={obj.pk for obj in to_load})\
+            .order_by('pk')
+        grouped = _group_collection_values(values, udfs_by_id)
+    else:
+        grouped = {}
+
+    for obj in to_load:
+        obj.udfs.set_collection_fields(
+            grouped.get((obj._model_name, obj.pk), {}))
+
+    return objs
+
+
 class UDFDictionary(HStoreDictionary):
 
     def __init__(self, value, field, obj, *args, **kwargs):
@@ -451,12 +880,22 @@ class UDFDictionary(HStoreDictionary):
         self.instance = obj
 
         self._fields = None
+        self._fields_by_name = None
         self._collection_fields = None
 
+        # Cleaned values of scalar udfs, by name
+        self._cleaned = {}
+
     @property
     def collection_data_loaded(self):
         return self._collection_fields is not None
 
+    def set_collection_fields(self, collection_fields):
+        """
+        Set already loaded collection values, see prefetch_collection_udfs
+        """
+        self._collection_fields = collection_fields
+
     @property
     def collection_fields(self):
         """
@@ -464,42 +903,15 @@ class UDFDictionary(HStoreDictionary):
         """
 
         if self._collection_fields is None:
-            self._collection_fields = {}
             udfs_on_model = self.instance.get_user_defined_fields()
 
             values = UserDefinedCollectionValue.objects.filter(
                 model_id=self.instance.pk,
                 field_definition__in=udfs_on_model)
 
-            for value in values:
-                name = value.field_definition.name
-
-                # Grab each datatype and assign the sub-name to the
-                # definition. These are used to clean the data
-                datatypes_raw = value.field_definition.datatype_dict
-                datatypes = {}
-
-                for datatype_dict in datatypes_raw:
-                    datatypes[datatype_dict['name']] = datatype_dict
-
-                if name not in self._collection_fields:
-                    self._collection_fields[name] = []
-
-                cleaned_data = {}
-                for subfield_name in value.data:
-                    sub_value = value.data.get(subfield_name, None)
-                    try:
-                        sub_value = value.field_definition.clean_value(
-                            sub_value, datatypes[subfield_name])
-                    except ValidationError:
-                        # If there was an error coming from the database
-                        # just continue with whatever the value was.
-                        pass
-
-                    cleaned_data[subfield_name] = sub_value
-
-                cleaned_data['id'] = value.pk
-                self._collection_fields[name].append(cleaned_data)
+            self._collection_fields = _group_collection_values(
+                values, {udf.pk: udf for udf in udfs_on_model}
+            ).get((self.instance._model_name, self.instance.pk), {})
 
         return self._collection_fields
 
@@ -526,30 +938,56 @@ class UDFDictionary(HStoreDictionary):
 
         return self._fields
 
-    def _get_udf_or_error(self, key):
-        for field in self.fields:
-            if field.name == key:
-                return field
+    @property
+    def fields_by_name(self):
+        if self._fields_by_name is None:
+            self._fields_by_name = {field.name: field
+                                    for field in self.fields}
+
+        return self._fields_by_name
 
-        raise KeyError("Couldn't find UDF for field '%s'" % key)
+    def _get_udf_or_error(self, key):
+        try:
+            return self.fields_by_name[key]
+        except KeyError:
+            raise KeyError("Couldn't find UDF for field '%s'" % key)
 
     def __contains__(self, key):
-        return key in [field.name for field in self.fields]
+        return key in self.fields_by_name
+
+    def raw_value(self, key):
+        """
+        The string stored for a scalar udf, without cleaning it
+        """
+        if super(UDFDictionary, self).__contains__(key):
+            return super(UDFDictionary, self).__getitem__(key)
+        else:
+            return None
+
+    def set_cleaned_value(self, key, value):
+        """
+        Set the already cleaned value of a scalar udf, see
+        resolve_user_udfs
+        """
+        self._cleaned[key] = value
 
     def __getitem__(self, key):
         udf = self._get_udf_or_error(key)
 
         if udf.iscollection:
             return self.collection_fields.get(key, [])
+        elif key in self._cleaned:
+            return self._cleaned[key]
         else:
-            if super(UDFDictionary, self).__contains__(key):
-                v = super(UDFDictionary, self).__getitem__(key)
+            v = self.raw_value(key)
+            if v is not None:
                 try:
-                    return udf.clean_value(v)
+                    v = udf.clean_value(v)
                 except:
-                    return v
-            else:
-                return None
+                    pass
+
+            self._cleaned[key] = v
+            return v
 
     def __setitem__(self, key, val):
         udf = self._get_udf_or_error(key)
@@ -560,8 +998,13 @@ class UDFDictionary(HStoreDictionary):
         else:
             val = udf.reverse_clean(val)
 
+            self._cleaned.pop(key, None)
             super(UDFDictionary, self).__setitem__(key, val)
 
+    def __delitem__(self, key):
+        self._cleaned.pop(key, None)
+        super(UDFDictionary, self).__delitem__(key)
+
 
 class UDFField(DictionaryField):
 
@@ -601,6 +1044,9 @@ class UDFModelBase(ModelBase):
                     udf, udfname = name.split(':', 1)
                     field, model, direct, m2m = orig('udfs')
                     field = _UDFProxy(udfname)
+                    # Used to look up typed values, see UDFWhereNode
+                    field.udf_model = new
+                    field.udf_table_model = model or new
                     return (field, model, direct, m2m)
                 else:
                     raise
@@ -611,47 +1057,95 @@ class UDFModelBase(ModelBase):
 
 class UDFDCache(object):
     """
-    Cache user defined field defintions
+    Cache user defined field defintions, keyed by model name and
+    instance id. When the cache is full the least recently used
+    definitions are dropped.
+
+    Instance.udf_rev is bumped by a database trigger whenever a UDF
+    definition of the instance changes. validate_instance is called
+    with the freshly loaded instance at the start of each request, and
+    get_defs_for_model checks the revision it is given, so definitions
+    changed by other processes are dropped from this one.
     """
     def __init__(self, max_size=10000):
-        self.reset()
         self.max_size = max_size
+        self._lock = threading.Lock()
+        self.reset()
 
     def reset(self):
-        self.cache = {}
+        with self._lock:
+            self.cache = OrderedDict()
+            self.revs = {}
 
     def put(self, k, v):
-        if len(self.cache) == self.max_size:
-            self.reset()
+        with self._lock:
+            self.cache.pop(k, None)
+            while len(self.cache) >= self.max_size:
+                self.cache.popitem(last=False)
 
-        self.cache[k] = v
+            self.cache[k] = v
         return v
 
     def _cache_key(self, model_name, instance_id):
         return (model_name, instance_id)
 
-    def get_defs_for_model(self, model_name, instance_id=None):
+    def invalidate_instance(self, instance_id):
+        """
+        Drop the definitions of an instance (and the definitions
+        cached across all instances)
+        """
+        with self._lock:
+            for key in self.cache.keys():
+                if key[1] in (instance_id, None):
+                    del self.cache[key]
+
+            self.revs.pop(instance_id, None)
+
+    def validate_instance(self, instance):
+        if self.revs.get(instance.pk) != instance.udf_rev:
+            self.invalidate_instance(instance.pk)
+            self.revs[instance.pk] = instance.udf_rev
+
+    def get_defs_for_model(self, model_name, instance_id=None,
+                           udf_rev=None):
+        """
+        The definitions of a model's UDFs in an instance (or in every
+        instance if no instance id is given). If the udf_rev of the
+        instance is given and is newer than the revision the cached
+        definitions were validated against, they are loaded again.
+        """
+        if instance_id and udf_rev is not None:
+            known_rev = self.revs.get(instance_id)
+            if known_rev is None or known_rev < udf_rev:
+                self.invalidate_instance(instance_id)
+                self.revs[instance_id] = udf_rev
+
         key = self._cache_key(model_name, instance_id)
 
-        if key not in self.cache:
-            udfs = UserDefinedFieldDefinition.objects.filter(
-                model_type=model_name)
+        with self._lock:
+            defs = self.cache.pop(key, None)
+            if defs is not None:
+                # Mark the definitions as the most recently used
+                self.cache[key] = defs
+                return defs
 
-            if instance_id:
-                udfs = udfs.filter(instance__pk=instance_id)
+        udfs = UserDefinedFieldDefinition.objects.filter(
+            model_type=model_name)
 
-            # Iterating over a queryset isn't theadsafe
-            # so we need to force it here
-            return self.put(key, list(udfs))
-        else:
-            return self.cache[key]
+        if instance_id:
+            udfs = udfs.filter(instance__pk=instance_id)
+
+        # Iterating over a queryset isn't theadsafe
+        # so we need to force it here
+        return self.put(key, list(udfs))
 
 udf_cache = UDFDCache()
 
 
 @receiver(post_save, sender=UserDefinedFieldDefinition)
-def clear_udf_cache(*args, **kwargs):
-    udf_cache.reset()
+@receiver(post_delete, sender=UserDefinedFieldDefinition)
+def clear_udf_cache(sender, instance, **kwargs):
+    udf_cache.invalidate_instance(instance.instance_id)
 
 
 class UDFModel(UserTrackable, models.Model):
@@ -682,8 +1176,13 @@ class UDFModel(UserTrackable, models.Model):
         return normal_fields or self.dirty_collection_udfs
 
     def get_user_defined_fields(self):
+        # Only check the instance's UDF revision if the instance is
+        # already loaded (Django caches it as '_instance_cache')
+        instance = getattr(self, '_instance_cache', None)
+        udf_rev = instance.udf_rev if instance is not None else None
+
         return udf_cache.get_defs_for_model(
-            self._model_name, self.instance_id)
+            self._model_name, self.instance_id, udf_rev)
 
     def audits(self):
         regular_audits = Q(model=self._model_name,
@@ -765,39 +1264,16 @@ class UDFModel(UserTrackable, models.Model):
         # We may need to get a primary key here before we continue
         super(UDFModel, self).save_with_user(user, *args, **kwargs)
 
-        collection_values = self.udfs.collection_fields
-
-        fields = {field.name: field
-                  for field in self.get_user_defined_fields()}
-
-        for field_name, values in collection_values.iteritems():
-            field = fields[field_name]
-
-            ids_specified = []
-            for value_dict in values:
-                if 'id' in value_dict:
-                    id = value_dict['id']
-                    del value_dict['id']
-
-                    udcv = UserDefinedCollectionValue.objects.get(
-                        pk=id,
-                        field_definition=field,
-                        model_id=self.pk)
-                else:
-                    udcv = UserDefinedCollectionValue(
-                        field_definition=field,
-                        model_id=self.pk)
-
-                udcv.data = value_dict
-                udcv.save_with_user(user)
+        # Collection values that were never loaded can't have changed
+        if self.udfs.collection_data_loaded:
+            collection_values = self.udfs.collection_fields
 
-                ids_specified.append(udcv.pk)
+            fields = {field.name: field
+                      for field in self.get_user_defined_fields()}
 
-            # Delete all values that weren't presented here
-            field.userdefinedcollectionvalue_set\
-                 .filter(model_id=self.pk)\
-                 .exclude(id__in=ids_specified)\
-                 .delete()
+            for field_name, values in collection_values.iteritems():
+                save_collection_values(self, fields[field_name], values,
+                                       user)
 
         self.dirty_collection_udfs = False
 
@@ -860,6 +1336,26 @@ class UDFModel(UserTrackable, models.Model):
             raise ValidationError(errors)
 
 
+# Receivers rather than overrides of save_with_user and delete_with_user,
+# so that values written by reviews, reverts and plain saves are
+# mirrored too
+@receiver(post_save)
+def sync_typed_udf_values_on_save(sender, instance, raw=False, **kwargs):
+    if (settings.UDF_TYPED_STORAGE and not raw
+            and issubclass(sender, UDFModel)):
+        sync_typed_udf_values([instance])
+
+
+@receiver(post_delete)
+def delete_typed_udf_values(sender, instance, **kwargs):
+    if settings.UDF_TYPED_STORAGE and issubclass(sender, UDFModel):
+        TypedUDFValue.objects\
+                     .filter(field_definition__in=(
+                         instance.get_user_defined_fields()),
+                         model_id=instance.pk)\
+                     .delete()
+
+
 def quotesingle(string):
     "Quote a string with ' characters, replacing them with ''"
     return string.replace("'", "''")
@@ -952,6 +1448,44 @@ class UDFWhereNode(GeoWhereNode):
         else:
             return ''
 
+    def make_typed_atom(self, constraint, lookup, param_or_value, qn):
+        """
+        Compare the value of a numeric or date UDF with its typed copy,
+        so the comparison can use the TypedUDFValue indexes.
+
+        Returns None if the value isn't a number or a date.
+        """
+        values = (param_or_value if lookup == 'range'
+                  else [param_or_value])
+
+        if isinstance(values[0], datetime):
+            column = 'value_date'
+        elif isinstance(values[0], (int, long, float)):
+            column = 'value_number'
+        else:
+            return None
+
+        params = [_typed_value(column, value) for value in values]
+        if None in params:
+            return None
+
+        field = constraint.field
+        udffieldname = constraint.col[1]
+        model_types = _udf_model_types(field.udf_model)
+
+        sql = ('%s.%s IN (SELECT t.model_id FROM %s t'
+               ' INNER JOIN %s d ON d.id = t.field_definition_id'
+               ' WHERE d.name = %%s AND d.model_type IN (%s)'
+               ' AND t.%s %s)' %
+               (qn(constraint.alias),
+                qn(field.udf_table_model._meta.pk.column),
+                qn(TypedUDFValue._meta.db_table),
+                qn(UserDefinedFieldDefinition._meta.db_table),
+                ', '.join(['%s'] * len(model_types)),
+                column, TYPED_UDF_LOOKUPS[lookup]))
+
+        return sql, [udffieldname] + model_types + params
+
     def make_atom(self, child, qn, connection):
         """
         Add type information to udf definitions
@@ -965,6 +1499,14 @@ class UDFWhereNode(GeoWhereNode):
         """
         constraint, lookup, _, param_or_value = child
 
+        if ((settings.UDF_TYPED_STORAGE and
+             lookup in TYPED_UDF_LOOKUPS and
+             self.get_udf_if_field_is_udf(constraint.col))):
+            typed_atom = self.make_typed_atom(constraint, lookup,
+                                              param_or_value, qn)
+            if typed_atom:
+                return typed_atom
+
         # Note that 'isnull' means that `param_or_value` will always
         # be boolean (True, False). If this is the case, we don't
         # want to update the datatype
@@ -974,6 +1516,16 @@ class UDFWhereNode(GeoWhereNode):
 
         return super(UDFWhereNode, self).make_atom(child, qn, connection)
 
+# Lookups that are made against the TypedUDFValue copies of UDF values
+# when settings.UDF_TYPED_STORAGE is on
+TYPED_UDF_LOOKUPS = {
+    'gt': '> %s',
+    'gte': '>= %s',
+    'lt': '< %s',
+    'lte': '<= %s',
+    'range': 'BETWEEN %s AND %s',
+}
+
 UDF_ORDER_PATTERN = re.compile(r'(-?)([a-zA-Z]+)\.udf\:(.+)$')
 
 
@@ -1005,7 +1557,8 @@ class UDFQuery(GeoQuery):
 
         WARNING: Since we don't know the datatype of a sort field
         we cannot cast it. Dates will sort correctly since dates are
-        lexicographically ordered. Numbers will not.
+        lexicographically ordered. Numbers will not, unless
+        settings.UDF_TYPED_STORAGE is on (see typed_udf_ordering).
         """
         udf = UDF_ORDER_PATTERN.match(field)
 
@@ -1024,6 +1577,51 @@ class UDFQuery(GeoQuery):
         else:
             return False
 
+    def typed_udf_ordering(self, field):
+        """
+        Sort by the TypedUDFValue copy of a numeric, date or choice UDF,
+        added to the query as an extra select.
+
+        Returns the ordering for the extra select, or False if 'field'
+        isn't a UDF or the UDF's values aren't typed.
+        """
+        udf = UDF_ORDER_PATTERN.match(field)
+
+        if not udf:
+            return False
+
+        sign, model, udffield = udf.groups()
+
+        model_class = safe_get_udf_model_class(model)
+        model_types = _udf_model_types(model_class)
+
+        datatypes = UserDefinedFieldDefinition.objects\
+            .filter(model_type__in=model_types, name=udffield,
+                    iscollection=False)\
+            .values_list('datatype', flat=True)
+        columns = {TYPED_UDF_COLUMNS.get(json.loads(datatype)['type'])
+                   for datatype in datatypes}
+
+        if len(columns) != 1 or None in columns:
+            return False
+
+        alias = 'udf_order_%s' % len(self.extra)
+        select = ('(SELECT t.%s FROM %s t'
+                  ' INNER JOIN %s d ON d.id = t.field_definition_id'
+                  ' WHERE d.name = %%s AND d.model_type IN (%s)'
+                  ' AND t.model_id = %s.%s)' %
+                  (columns.pop(),
+                   TypedUDFValue._meta.db_table,
+                   UserDefinedFieldDefinition._meta.db_table,
+                   ', '.join(['%s'] * len(model_types)),
+                   model_class._meta.db_table,
+                   model_class._meta.pk.column))
+
+        self.add_extra({alias: select}, [udffield] + model_types,
+                       None, None, None, None)
+
+        return (sign or '') + alias
+
     def add_ordering(self, *ordering):
         """
         This method was copied and modified from django core. In
@@ -1033,7 +1631,9 @@ class UDFQuery(GeoQuery):
         fields = []
         errors = []
         for item in ordering:
-            udf = self.process_as_udf(item)
+            udf = (settings.UDF_TYPED_STORAGE and
+                   self.typed_udf_ordering(item)) or \
+                self.process_as_udf(item)
             if udf:
                 fields.append(udf)
             elif ORDER_PATTERN.match(item):
@@ -1048,6 +1648,66 @@ class UDFQuery(GeoQuery):
             self.default_ordering = False
 
 
+# SQL casts of the scalar udf datatypes that can be aggregated as
+# something other than text
+UDF_AGGREGATE_CASTS = {
+    'float': 'numeric',
+    'int': 'numeric',
+    'date': 'timestamp',
+}
+
+UDF_AGGREGATE_FUNCTIONS = {
+    'sum': {'numeric'},
+    'avg': {'numeric'},
+    'min': {'numeric', 'timestamp'},
+    'max': {'numeric', 'timestamp'},
+    'count': {'numeric', 'timestamp', 'text'},
+    'histogram': {'numeric', 'timestamp', 'text'},
+}
+
+UDF_DATE_TRUNC_UNITS = ('day', 'week', 'month', 'year')
+
+
+def _udf_definitions(model_class, udf_name, iscollection, instance=None):
+    definitions = UserDefinedFieldDefinition.objects.filter(
+        model_type=model_class.__name__, name=udf_name,
+        iscollection=iscollection)
+
+    if instance is not None:
+        definitions = definitions.filter(instance=instance)
+
+    definitions = list(definitions)
+
+    if not definitions:
+        raise ValidationError(
+            trans('%(model)s has no %(kind)s field named "%(name)s"') %
+            {'model': model_class.__name__,
+             'kind': trans('collection') if iscollection else trans('scalar'),
+             'name': udf_name})
+
+    return definitions
+
+
+def _aggregate_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    else:
+        return value
+
+
+def _load_in_chunks(objs, loaders):
+    while True:
+        chunk = list(islice(objs, ITER_CHUNK_SIZE))
+        if not chunk:
+            return
+
+        for loader in loaders:
+            loader(chunk)
+
+        for obj in chunk:
+            yield obj
+
+
 class UDFQuerySet(models.query.GeoQuerySet):
     """
     A query set that supports udf-based filter queries
@@ -1066,7 +1726,205 @@ class GeoHStoreUDFQuerySet(HStoreQueryset, UDFQuerySet):
     Merges hstore with the UDFQuerySet which includes the standard
     GeoQuerySet
     """
-    pass
+    def prefetch_collection_udfs(self):
+        """
+        Return a queryset that loads the collection UDF values of its
+        objects in bulk, one query for each chunk of objects
+        """
+        return self._clone(_prefetch_collection_udfs=True)
+
+    def resolve_user_udfs(self):
+        """
+        Return a queryset that looks up the users referenced by the
+        scalar user udfs of its objects in bulk, one query for each
+        chunk of objects
+        """
+        return self._clone(_resolve_user_udfs=True)
+
+    def _aggregate_sql(self, *fields):
+        """
+        The SQL and params of this query selecting only 'fields'
+        """
+        qs = self.order_by().values_list(*fields)
+        return qs.query.get_compiler(using=qs.db).as_sql()
+
+    def _fetch_aggregate(self, sql, params):
+        cursor = connections[self.db].cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def udf_aggregate(self, udf_name, function, group_by=None,
+                      bucket_size=None, instance=None):
+        """
+        Aggregate the values of a scalar udf over this query in the
+        database, without loading the objects. The udf is looked up in
+        'instance', or in every instance if it isn't given.
+
+        'function' is one of sum, avg, min or max (numeric udfs, and
+        min or max of dates), count (the objects with a value) or
+        histogram (the number of objects with each value, or in each
+        'bucket_size' wide bucket for numeric udfs).
+
+        Returns a list of {'group': ..., 'value': ...} dicts, one for
+        each value of the 'group_by' field if there is one. Histograms
+        also have a 'count' for each value.
+        """
+        if function not in UDF_AGGREGATE_FUNCTIONS:
+            raise ValidationError(
+                trans('Invalid aggregate function "%(function)s"') %
+                {'function': function})
+
+        model_fields = [field.name for field in self.model._meta.fields]
+        if group_by and group_by not in model_fields:
+            raise ValidationError(
+                trans('%(model)s has no field named "%(name)s"') %
+                {'model': self.model.__name__, 'name': group_by})
+
+        definitions = _udf_definitions(self.model, udf_name, False,
+                                       instance)
+        casts = {UDF_AGGREGATE_CASTS.get(udf.datatype_dict['type'], 'text')
+                 for udf in definitions}
+
+        if len(casts) != 1:
+            raise ValidationError(
+                trans('The "%(name)s" fields have different types') %
+                {'name': udf_name})
+
+        cast = casts.pop()
+        if cast not in UDF_AGGREGATE_FUNCTIONS[function]:
+            raise ValidationError(
+                trans('Can not compute the %(function)s of "%(name)s"') %
+                {'function': function, 'name': udf_name})
+
+        value = "NULLIF(q.udfs -> %%s, '')::%s" % cast
+        params = [udf_name]
+
+        # The first column is the group and the second the value (or
+        # the bucket of a histogram)
+        if function == 'histogram':
+            if bucket_size:
+                if cast != 'numeric':
+                    raise ValidationError(
+                        trans('Only numeric fields have buckets'))
+                value = 'FLOOR(%s / %%s) * %%s' % value
+                params += [bucket_size, bucket_size]
+
+            select = '%s, COUNT(*)' % value
+            grouping = ['2']
+        else:
+            select = '%s(%s)' % (function.upper(), value)
+            grouping = []
+
+        if group_by:
+            inner_sql, inner_params = self._aggregate_sql(group_by, 'udfs')
+            sql = 'SELECT q.grp, %s FROM (%s) AS q (grp, udfs)'
+            grouping.insert(0, '1')
+        else:
+            inner_sql, inner_params = self._aggregate_sql('udfs')
+            sql = 'SELECT NULL, %s FROM (%s) AS q (udfs)'
+
+        sql = sql % (select, inner_sql)
+        params += inner_params
+
+        if function == 'histogram':
+            sql += " WHERE NULLIF(q.udfs -> %s, '') IS NOT NULL"
+            params.append(udf_name)
+        if grouping:
+            grouping = ', '.join(grouping)
+            sql += ' GROUP BY %s ORDER BY %s' % (grouping, grouping)
+
+        rows = self._fetch_aggregate(sql, params)
+
+        if function == 'histogram':
+            return [{'group': _aggregate_value(row_group),
+                     'value': _aggregate_value(bucket),
+                     'count': count}
+                    for row_group, bucket, count in rows]
+        else:
+            return [{'group': _aggregate_value(row_group),
+                     'value': _aggregate_value(row_value)}
+                    for row_group, row_value in rows]
+
+    def udf_collection_counts(self, udf_name, key=None, date_trunc=None,
+                              instance=None):
+        """
+        Count the entries of a collection udf on the objects of this
+        query in the database, without loading the objects. The udf is
+        looked up in 'instance', or in every instance if it isn't given.
+
+        Entries are grouped by the value of their 'key' sub-field if
+        given. For date sub-fields, 'date_trunc' (day, week, month or
+        year) groups the dates by that unit.
+
+        Returns a list of {'group': ..., 'count': ...} dicts.
+        """
+        definitions = _udf_definitions(self.model, udf_name, True, instance)
+
+        if key:
+            datatypes = set()
+            for udf in definitions:
+                subfields = _collection_datatypes(udf)
+                if key in subfields:
+                    datatypes.add(subfields[key]['type'])
+
+            if len(datatypes) != 1:
+                raise ValidationError(
+                    trans('"%(name)s" has no "%(key)s" field') %
+                    {'name': udf_name, 'key': key})
+
+            if date_trunc:
+                if ((date_trunc not in UDF_DATE_TRUNC_UNITS or
+                     datatypes.pop() != 'date')):
+                    raise ValidationError(
+                        trans('Only dates can be grouped by %(unit)s') %
+                        {'unit': date_trunc})
+                group = "date_trunc(%s, NULLIF(v.data -> %s, '')::timestamp)"
+                group_params = [date_trunc, key]
+            else:
+                group = 'v.data -> %s'
+                group_params = [key]
+        else:
+            group = 'NULL'
+            group_params = []
+
+        inner_sql, inner_params = self._aggregate_sql('pk')
+
+        sql = ('SELECT %s, COUNT(*) FROM %s v'
+               ' WHERE v.field_definition_id IN (%s)'
+               ' AND v.model_id IN (%s)' %
+               (group, UserDefinedCollectionValue._meta.db_table,
+                ', '.join(['%s'] * len(definitions)), inner_sql))
+        params = (group_params + [udf.pk for udf in definitions] +
+                  list(inner_params))
+
+        if key:
+            sql += ' GROUP BY 1 ORDER BY 1'
+
+        rows = self._fetch_aggregate(sql, params)
+
+        return [{'group': row_group, 'count': count}
+                for row_group, count in rows]
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_prefetch_collection_udfs',
+                          getattr(self, '_prefetch_collection_udfs', False))
+        kwargs.setdefault('_resolve_user_udfs',
+                          getattr(self, '_resolve_user_udfs', False))
+        return super(GeoHStoreUDFQuerySet, self)._clone(*args, **kwargs)
+
+    def iterator(self):
+        objs = super(GeoHStoreUDFQuerySet, self).iterator()
+
+        loaders = []
+        if getattr(self, '_prefetch_collection_udfs', False):
+            loaders.append(prefetch_collection_udfs)
+        if getattr(self, '_resolve_user_udfs', False):
+            loaders.append(resolve_user_udfs)
+
+        if loaders:
+            return _load_in_chunks(objs, loaders)
+        else:
+            return objs
 
 
 class GeoHStoreUDFManager(models.GeoManager, HStoreManager):
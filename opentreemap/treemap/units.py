@@ -3,6 +3,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import json
 from functools import partial
 from numbers import Number
 
@@ -10,19 +11,22 @@ from django.conf import settings
 from django.utils.translation import ugettext as trans
 from django.utils.formats import number_format
 
-from treemap.json_field import get_attr_from_json_field
+from treemap.json_field import (get_attr_from_json_field, get_json_value,
+                                get_raw_json)
 
 
 class Convertible(object):
     def clean(self):
         super(Convertible, self).clean()
+        if not self.instance:
+            return
         model = self._meta.object_name.lower()
-        for field in self._meta.get_all_field_names():
-            if self.instance and is_convertible(model, field):
+        converter = get_converter(self.instance)
+        for field in converter.convertible_values(model):
+            if hasattr(self, field):
                 value = getattr(self, field)
-                converted_value = get_storage_value(self.instance, model,
-                                                    field, value)
-                setattr(self, field, converted_value)
+                setattr(self, field,
+                        converter.storage_value(model, field, value))
 
 
 _unit_names = {
@@ -46,6 +50,167 @@ _unit_conversions = {
 }
 
 
+class UnitConverter(object):
+    """
+    The units, digits and conversion factors of every value in
+    DISPLAY_DEFAULTS for one instance value display configuration,
+    worked out once so converting and formatting a value only takes a
+    dictionary lookup. Get one with get_converter.
+    """
+    def __init__(self, defaults, value_display):
+        # (category, value) -> (units, digits, conversion factor)
+        self.values = {}
+        self._convertible = {}
+        self._display_digits = {}
+
+        for category_name, values in defaults.iteritems():
+            self._convertible[category_name] = []
+            configured = value_display.get(category_name) or {}
+
+            for value_name, display in values.iteritems():
+                config = configured.get(value_name) or {}
+                units = config.get('units') or display.get('units')
+                digits = config.get('digits') or display.get('digits')
+
+                if 'units' in display:
+                    self._convertible[category_name].append(value_name)
+                    factor = _unit_conversions.get(
+                        display['units'], {}).get(units)
+                else:
+                    factor = 1
+
+                self.values[(category_name, value_name)] = (
+                    units, digits, factor)
+                if 'digits' in display:
+                    self._display_digits[(category_name, value_name)] = \
+                        int(digits)
+
+    def convertible_values(self, category_name):
+        return self._convertible.get(category_name, [])
+
+    def units(self, category_name, value_name):
+        return self.values[(category_name, value_name)][0]
+
+    def digits(self, category_name, value_name):
+        return self.values[(category_name, value_name)][1]
+
+    def _factor(self, category_name, value_name):
+        units, _, factor = self.values.get((category_name, value_name),
+                                           (None, None, None))
+        if factor is None:
+            storage_unit = _get_display_default(category_name, value_name,
+                                                'units')
+            raise Exception("Cannot convert from [%s] to [%s]"
+                            % (storage_unit, units))
+        return factor
+
+    def display_values(self, category_name, value_name, values):
+        """
+        Convert and format a list of stored values, returning a list of
+        (converted value, formatted value) like get_display_value
+        """
+        key = (category_name, value_name)
+        factor = self._factor(*key) if key in self.values else 1
+        digits = self._display_digits.get(key, 1)
+
+        results = []
+        for value in values:
+            if not isinstance(value, Number):
+                results.append((value, value))
+            else:
+                converted_value = value * factor
+                rounded_value = round(converted_value, digits)
+                results.append((converted_value,
+                                number_format(rounded_value,
+                                              decimal_pos=digits)))
+        return results
+
+    def display_value(self, category_name, value_name, value):
+        return self.display_values(category_name, value_name, [value])[0]
+
+    def storage_values(self, category_name, value_name, values):
+        """
+        Convert a list of values in the instance units to the units
+        they are stored in
+        """
+        factor = None
+        results = []
+        for value in values:
+            if isinstance(value, Number):
+                if factor is None:
+                    factor = self._factor(category_name, value_name)
+                value = value / factor
+            results.append(value)
+        return results
+
+    def storage_value(self, category_name, value_name, value):
+        return self.storage_values(category_name, value_name, [value])[0]
+
+
+class UnitConverterCache(object):
+    """
+    Cache a UnitConverter for each distinct value display configuration,
+    so instances share a converter until their configuration (or
+    DISPLAY_DEFAULTS) changes.
+
+    The converter of an instance whose config hasn't been read (and so
+    can't have been changed) since it was loaded is also remembered by
+    the instance's id and config_rev, so looking it up again doesn't
+    serialize the configuration.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.reset()
+
+    def reset(self):
+        self.cache = {}
+        self.instance_cache = {}
+
+    def _put(self, cache, key, entry):
+        if len(cache) >= self.max_size:
+            cache.clear()
+        cache[key] = entry
+
+    def _get_for_value_display(self, defaults, value_display):
+        key = json.dumps(value_display, sort_keys=True)
+
+        entry = self.cache.get(key)
+        if entry is None or entry[0] is not defaults:
+            entry = (defaults, UnitConverter(defaults, value_display))
+            self._put(self.cache, key, entry)
+
+        return entry[1]
+
+    def get(self, instance):
+        defaults = settings.DISPLAY_DEFAULTS
+        raw = get_raw_json(instance, 'config')
+        key = (instance.pk, getattr(instance, 'config_rev', None))
+
+        if raw is not None and instance.pk is not None:
+            entry = self.instance_cache.get(key)
+            if (entry and entry[0] is defaults
+                    and (entry[1] is raw or entry[1] == raw)):
+                return entry[2]
+
+        value_display = get_json_value(instance, 'config.value_display') \
+            or {}
+        converter = self._get_for_value_display(defaults, value_display)
+
+        if raw is not None and instance.pk is not None:
+            self._put(self.instance_cache, key, (defaults, raw, converter))
+
+        return converter
+
+
+unit_converter_cache = UnitConverterCache()
+
+
+def get_converter(instance):
+    if not instance:
+        raise Exception("Need an instance to convert values")
+    return unit_converter_cache.get(instance)
+
+
 def get_unit_name(abbrev):
     return _unit_names[abbrev]
 
@@ -90,12 +255,18 @@ def get_digits_if_formattable(instance, category_name, value_name):
 
 
 def get_units(instance, category_name, value_name):
+    converter = get_converter(instance)
+    if (category_name, value_name) in converter.values:
+        return converter.units(category_name, value_name)
     _, units = get_value_display_attr(
         instance, category_name, value_name, 'units')
     return units
 
 
 def get_digits(instance, category_name, value_name):
+    converter = get_converter(instance)
+    if (category_name, value_name) in converter.values:
+        return converter.digits(category_name, value_name)
     _, digits = get_value_display_attr(
         instance, category_name, value_name, 'digits')
     return digits
@@ -116,40 +287,24 @@ is_convertible = partial(_is_configured_for, {'units'})
 is_formattable = partial(_is_configured_for, {'digits'})
 
 
-def _get_conversion_factor(instance, category_name, value_name):
-    storage_unit = _get_display_default(category_name, value_name, 'units')
-    instance_unit = get_units(instance, category_name, value_name)
-    conversion_dict = _unit_conversions.get(storage_unit)
-
-    if instance_unit not in conversion_dict.keys():
-        raise Exception("Cannot convert from [%s] to [%s]"
-                        % (storage_unit, instance_unit))
-
-    return conversion_dict[instance_unit]
-
-
 def get_display_value(instance, category_name, value_name, value):
     if not isinstance(value, Number):
         return value, value
-    if is_convertible(category_name, value_name):
-        conversion_factor = _get_conversion_factor(instance, category_name,
-                                                   value_name)
-        converted_value = value * conversion_factor
-    else:
-        converted_value = value
-
-    if is_formattable(category_name, value_name):
-        digits = int(get_digits(instance, category_name, value_name))
-    else:
-        digits = 1
+    return get_converter(instance).display_value(category_name, value_name,
+                                                 value)
 
-    rounded_value = round(converted_value, digits)
 
-    return converted_value, number_format(rounded_value, decimal_pos=digits)
+def get_display_values(instance, category_name, value_name, values):
+    """
+    get_display_value for a list of values, e.g. for every row of a list
+    or export, converting them all with the same units and digits
+    """
+    return get_converter(instance).display_values(category_name,
+                                                  value_name, values)
 
 
 def get_storage_value(instance, category_name, value_name, value):
     if not isinstance(value, Number):
         return value
-    return value / _get_conversion_factor(instance, category_name,
-                                          value_name)
+    return get_converter(instance).storage_value(category_name, value_name,
+                                                 value)
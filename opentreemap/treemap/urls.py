@@ -12,6 +12,7 @@ from treemap.views import (boundary_to_geojson_view, index_view, map_view,
                            delete_plot_view, delete_tree_view,
                            instance_settings_js_view, edits_view,
                            search_tree_benefits_view, species_list_view,
+                           species_search_view,
                            boundary_autocomplete_view, instance_user_view,
                            plot_popup_view, instance_user_audits,
                            plot_accordion_view, add_plot_view,
@@ -19,7 +20,8 @@ from treemap.views import (boundary_to_geojson_view, index_view, map_view,
                            approve_or_reject_photo_view, next_photo_endpoint,
                            photo_review_partial_endpoint, get_plot_eco_view,
                            edit_plot_detail_view, static_page_view,
-                           get_plot_sidebar_view)
+                           get_plot_sidebar_view, pending_edits_endpoint,
+                           udf_aggregate_view)
 
 # Testing notes:
 # We want to test that every URL succeeds (200) or fails with bad data (404).
@@ -37,10 +39,13 @@ urlpatterns = patterns(
         boundary_to_geojson_view),
     url(r'^boundaries/$', boundary_autocomplete_view),
     url(r'^edits/$', edits_view, name='edits'),
+    url(r'^pending-edits/$', pending_edits_endpoint, name='pending_edits'),
     url(r'^photo_review/$', photo_review_endpoint),
     url(r'^photo_review/next$', next_photo_endpoint),
     url(r'^photo_review/partial$', photo_review_partial_endpoint),
     url(r'^species/$', species_list_view),
+    url(r'^species/search/$', species_search_view, name='species_search'),
+    url(r'^udfs/aggregate/$', udf_aggregate_view, name='udf_aggregate'),
     url(r'^map/$', map_view, name='map'),
     url(r'^plots/(?P<plot_id>\d+)/$',
         route(GET=get_plot_detail_view, PUT=update_plot_detail_view,
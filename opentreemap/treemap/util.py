@@ -13,7 +13,7 @@ from cStringIO import StringIO
 
 from urlparse import urlparse
 from django.shortcuts import get_object_or_404, resolve_url
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 from django.utils.encoding import force_str, force_text
 from django.utils.functional import Promise
 from django.core.serializers.json import DjangoJSONEncoder
@@ -25,7 +25,7 @@ from django.core.files.uploadedfile import SimpleUploadedFile, File
 from django.db.models.fields.files import ImageFieldFile
 from django.contrib.gis.geos import Point
 
-from treemap.instance import Instance
+from treemap.instance import Instance, instance_cache
 
 
 def safe_get_model_class(model_string):
@@ -51,6 +51,11 @@ def safe_get_model_class(model_string):
 def add_visited_instance(request, instance):
     visited_instances = request.session.get('visited_instances', OrderedDict())
 
+    # Only the order of the visits is used, so there is nothing to save
+    # when the instance is already the most recently visited one
+    if visited_instances and next(reversed(visited_instances)) == instance.pk:
+        return
+
     if instance.pk in visited_instances:
         del visited_instances[instance.pk]
     visited_instances[instance.pk] = datetime.datetime.now()
@@ -96,6 +101,13 @@ def get_instance_or_404(**kwargs):
     return get_object_or_404(Instance, **new_kwargs)
 
 
+def get_cached_instance_or_404(url_name):
+    try:
+        return instance_cache.get(url_name)
+    except Instance.DoesNotExist:
+        raise Http404('No instance matches the given query.')
+
+
 def bad_request_json_response(message=None, validation_error_dict=None):
     if message is None:
         message = 'One or more of the specified values are invalid.'
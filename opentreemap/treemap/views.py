@@ -3,21 +3,19 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
-import string
-import re
 import urllib
 import json
 import hashlib
 import datetime
 
 from PIL import Image
-import sass
 
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.views.decorators.http import etag
+from django.views.decorators.cache import cache_control
 from django.conf import settings
 from django.contrib.gis.geos.point import Point
 from django.contrib.auth.decorators import login_required
@@ -35,11 +33,15 @@ from treemap.util import (package_validation_errors,
                           bad_request_json_response,
                           save_image_from_request)
 from treemap.search import create_filter
-from treemap.audit import (Audit, approve_or_reject_existing_edit,
+from treemap.audit import (Audit, PendingEditCount,
+                           approve_or_reject_existing_edit,
                            approve_or_reject_audits_and_apply)
 from treemap.models import (Plot, Tree, User, Species, Instance,
-                            TreePhoto, StaticPage)
+                            TreePhoto, StaticPage, species_index_cache)
+from treemap.exceptions import HttpBadRequestException
 from treemap.units import get_units, get_display_value
+from treemap.scss import (SCSS_VERSION_PARAM, normalize_scss_variables,
+                          css_cache_key, get_compiled_css)
 
 from treemap.ecobenefits import (benefits_for_trees, get_benefit_label)
 
@@ -295,7 +297,8 @@ def context_dict_for_plot(instance, plot,
                     kwargs={'instance_url_name': instance.url_name,
                             'plot_id': plot.pk})
 
-    if user and user.is_authenticated():
+    # Plots from lists may have been masked in bulk already
+    if user and user.is_authenticated() and not plot._has_been_masked:
         plot.mask_unauthorized_fields(user)
 
     context['plot'] = plot
@@ -532,11 +535,65 @@ def _get_audits(logged_in_user, instance, query_vars, user, models,
         query_vars['page'] = page - 1
         prev_page = "?" + urllib.urlencode(query_vars)
 
+    # Pages are counted in stored audits, so a page that includes
+    # compacted inserts can hold more than page_size audits
+    audits = list(Audit.expand_compacted(audits))
+
     return {'audits': audits,
             'next_page': next_page,
             'prev_page': prev_page}
 
 
+def pending_edits(request, instance):
+    """
+    Page through the moderation inbox of an instance, with the pending
+    edits grouped by the object they were made to. Objects with the
+    most recent pending edits come first.
+    Params:
+       - model
+         Only show pending edits to this model (e.g. "Plot")
+
+       - page_size
+         Number of objects on each page (up to PAGE_MAX)
+       - page
+         The page to return
+    """
+    PAGE_MAX = 100
+    PAGE_DEFAULT = 20
+
+    r = request.REQUEST
+
+    page_size = min(int(r.get('page_size', PAGE_DEFAULT)), PAGE_MAX)
+    page = int(r.get('page', 0))
+
+    start_pos = page * page_size
+    end_pos = start_pos + page_size
+
+    entries = PendingEditCount.objects.filter(instance=instance)
+
+    model = r.get('model', None)
+    if model:
+        entries = entries.filter(model=model)
+
+    total_objects = entries.count()
+    entries = list(entries.order_by('-updated', 'id')[start_pos:end_pos])
+
+    audits_by_object = PendingEditCount.pending_audits_for_entries(entries)
+
+    objects = [{'model': entry.model,
+                'model_id': entry.model_id,
+                'pending_count': entry.pending_count,
+                'audits': [audit.dict() for audit in
+                           audits_by_object[(entry.model, entry.model_id)]]}
+               for entry in entries]
+
+    return {'total_pending': PendingEditCount.total_for_instance(instance),
+            'total_objects': total_objects,
+            'page': page,
+            'has_next': end_pos < total_objects,
+            'objects': objects}
+
+
 def _get_audits_params(request):
     PAGE_MAX = 100
     PAGE_DEFAULT = 20
@@ -633,6 +690,18 @@ def _plot_audits(user, instance, plot):
     for afilter in [tree_filter, tree_delete_filter, plot_filter]:
         audits += list(iaudit.filter(afilter).order_by('-updated')[:5])
 
+    # Fields of compacted inserts are only found through the 'id' audit
+    insert_filter = ((Q(model='Plot', model_id=plot.pk) |
+                      Q(model='Tree', model_id__in=tree_history)) &
+                     Q(field='id', action=Audit.Type.Insert))
+    visible_fields = {'Plot': readable_plot_fields,
+                      'Tree': tree_visible_fields}
+
+    audits += [audit for audit in
+               Audit.expand_compacted(iaudit.filter(insert_filter))
+               if audit.field != 'id' and
+               audit.field in visible_fields[audit.model]]
+
     audits = sorted(audits, key=lambda audit: audit.updated, reverse=True)[:5]
 
     return audits
@@ -682,55 +751,116 @@ def boundary_autocomplete(request, instance):
             for boundary in boundaries]
 
 
+# The most species a species search returns
+SPECIES_SEARCH_MAX_ITEMS = 50
+
+
+def _max_items(request, default=None):
+    max_items = request.GET.get('max_items', default)
+    if max_items is None:
+        return None
+    try:
+        max_items = int(max_items)
+    except ValueError:
+        raise HttpBadRequestException('max_items must be a number')
+    if max_items < 1:
+        raise HttpBadRequestException('max_items must be at least 1')
+    return max_items
+
+
 def species_list(request, instance):
-    max_items = request.GET.get('max_items', None)
+    max_items = _max_items(request)
+
+    species = species_index_cache.get(instance).species
 
-    species_qs = instance.scope_model(Species)\
-                         .order_by('common_name')\
-                         .values('common_name', 'genus',
-                                 'species', 'cultivar', 'id')
+    return species[:max_items] if max_items else species
 
-    if max_items:
-        species_qs = species_qs[:max_items]
 
-    # Split names by space so that "el" will match common_name="Delaware Elm"
-    def tokenize(species):
-        names = (species['common_name'],
-                 species['genus'],
-                 species['species'],
-                 species['cultivar'])
+def species_search(request, instance):
+    """
+    The species of the instance with a name token starting with each
+    word of the "q" parameter, so clients don't need the whole list
+    """
+    max_items = min(_max_items(request, SPECIES_SEARCH_MAX_ITEMS),
+                    SPECIES_SEARCH_MAX_ITEMS)
+
+    return species_index_cache.get(instance).search(
+        request.GET.get('q', ''), max_items)
 
-        tokens = set()
 
-        for name in names:
-            if name:
-                tokens = tokens.union(name.split())
+def _execute_filter(instance, filter_str):
+    return create_filter(filter_str).filter(instance=instance)
 
-        # Names are sometimes in quotes, which should be stripped
-        return {token.strip(string.punctuation) for token in tokens}
 
-    def annotate_species_dict(sdict):
-        sci_name = Species.get_scientific_name(sdict['genus'],
-                                               sdict['species'],
-                                               sdict['cultivar'])
+def udf_aggregate(request, instance):
+    """
+    Aggregate the values of a user defined field over the plots or trees
+    matching a search, see GeoHStoreUDFQuerySet.udf_aggregate and
+    udf_collection_counts.
+    Params:
+       - model
+         "Plot" or "Tree"
+       - udf
+         The name of the field
+       - function
+         sum, avg, min, max, count or histogram for scalar fields
+         (collection fields are always counted)
+       - group_by
+         Optional field of the model to group the results by
+       - bucket_size
+         Width of the buckets of a numeric histogram
+       - key
+         Count collection entries by the value of this sub-field
+       - date_trunc
+         Count collection entries by day, week, month or year of the
+         date in 'key'
+       - q
+         Search filter for the plots
+    """
+    r = request.GET
 
-        display_name = "%s [%s]" % (sdict['common_name'],
-                                    sci_name)
+    model_name = r.get('model', 'Plot')
+    if model_name not in ('Plot', 'Tree'):
+        return bad_request_json_response('Invalid model "%s"' % model_name)
 
-        tokens = tokenize(species)
+    udf_name = r.get('udf', '')
+    group_by = r.get('group_by') or None
 
-        sdict.update({
-            'scientific_name': sci_name,
-            'value': display_name,
-            'tokens': tokens})
+    if request.user.is_authenticated():
+        matrix = request.user.get_permission_matrix(instance, model_name)
+    else:
+        matrix = instance.default_role.permission_matrix(model_name)
 
-        return sdict
+    for field in ['udf:' + udf_name, group_by]:
+        if field and field not in matrix.readable:
+            return bad_request_json_response(
+                'Can not read %s.%s' % (model_name, field))
 
-    return [annotate_species_dict(species) for species in species_qs]
+    plots = _execute_filter(instance, r.get('q', ''))
+    if model_name == 'Plot':
+        objs = plots
+    else:
+        objs = Tree.objects.filter(instance=instance, plot_id__in=plots)
 
+    iscollection = instance.userdefinedfielddefinition_set.filter(
+        model_type=model_name, name=udf_name, iscollection=True).exists()
 
-def _execute_filter(instance, filter_str):
-    return create_filter(filter_str).filter(instance=instance)
+    try:
+        if iscollection:
+            results = objs.udf_collection_counts(
+                udf_name, r.get('key') or None, r.get('date_trunc') or None,
+                instance=instance)
+        else:
+            bucket_size = r.get('bucket_size')
+            results = objs.udf_aggregate(
+                udf_name, r.get('function', 'count'), group_by,
+                float(bucket_size) if bucket_size else None,
+                instance=instance)
+    except (ValidationError, ValueError) as e:
+        return bad_request_json_response(
+            '; '.join(getattr(e, 'messages', [unicode(e)])))
+
+    return {'results': results}
 
 
 def search_tree_benefits(request, instance):
@@ -895,8 +1025,19 @@ def profile_to_user_view(request):
     else:
         return HttpResponseRedirect(settings.LOGIN_URL)
 
-_scss_var_name_re = re.compile('^[_a-zA-Z][-_a-zA-Z0-9]*$')
-_color_re = re.compile(r'^(?:[0-9a-fA-F]{3}|[0-9a-fA-F]{6})$')
+
+def _scss_request_variables(request):
+    # The version parameter only makes the URL change with the sources
+    return {key: value for key, value in request.GET.items()
+            if key != SCSS_VERSION_PARAM}
+
+
+def _scss_etag(request):
+    try:
+        variables = normalize_scss_variables(_scss_request_variables(request))
+    except ValidationError:
+        return None
+    return css_cache_key(variables)
 
 
 def compile_scss(request):
@@ -911,16 +1052,7 @@ def compile_scss(request):
     """
     # We can probably be a bit looser with what we allow here in the future if
     # we need to, but we must do some checking so that libsass doesn't explode
-    scss = ''
-    for key, value in request.GET.items():
-        if _scss_var_name_re.match(key) and _color_re.match(value):
-            scss += '$%s: #%s;\n' % (key, value)
-        else:
-            raise ValidationError("Invalid SCSS values %s: %s" % (key, value))
-    scss += '@import "%s";' % settings.SCSS_ENTRY
-    scss = scss.encode('utf-8')
-
-    return sass.compile(string=scss, include_paths=[settings.SCSS_ROOT])
+    return get_compiled_css(_scss_request_variables(request))
 
 
 PHOTO_PAGE_SIZE = 12
@@ -994,9 +1126,13 @@ def photo_review(request, instance):
     if len(pages) > 10:
         pages = pages[0:8] + [pages[-1]]
 
+    # Load the whole page of photos at once rather than one at a time
+    photos_by_id = TreePhoto.objects.in_bulk(
+        [audit.model_id for audit in photos])
+
     return {
-        'photos': [TreePhoto.objects.get(pk=audit.model_id)
-                   for audit in photos],
+        'photos': [photos_by_id[audit.model_id] for audit in photos
+                   if audit.model_id in photos_by_id],
         'pages': pages,
         'total_pages': total_pages,
         'cur_page': page,
@@ -1159,6 +1295,12 @@ search_tree_benefits_view = instance_request(
 
 species_list_view = json_api_call(instance_request(species_list))
 
+species_search_view = json_api_call(instance_request(species_search))
+
+udf_aggregate_view = json_api_call(
+    instance_request(
+        route(GET=udf_aggregate)))
+
 user_view = render_template("treemap/user.html", user)
 
 update_user_view = require_http_method("PUT")(
@@ -1187,7 +1329,9 @@ add_tree_photo_endpoint = require_http_method("POST")(
                                 add_tree_photo_view)))))
 
 scss_view = require_http_method("GET")(
-    string_as_file_call("text/css", compile_scss))
+    etag(_scss_etag)(
+        cache_control(public=True, max_age=settings.SCSS_CACHE_MAX_AGE)(
+            string_as_file_call("text/css", compile_scss))))
 
 photo_review_endpoint = instance_request(
     route(
@@ -1204,6 +1348,11 @@ next_photo_endpoint = instance_request(
         GET=render_template("treemap/partials/photo.html",
                             next_photo)))
 
+pending_edits_endpoint = instance_request(
+    login_or_401(
+        json_api_call(
+            route(GET=pending_edits))))
+
 approve_or_reject_photo_view = login_required(
     instance_request(
         creates_instance_user(approve_or_reject_photo)))